@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Download throughput benchmark of the download engines of
+download_waveform_data, against the local FDSN stand-in server (see
+fdsn_standin_server.py) serving an already downloaded event.
+
+Reports for each engine and number of workers the wall time, the number of
+requests, stations/second and bytes/second.
+
+Usage : python benchmark_download.py -d test_python_script --latency 0.2 -j 1 8
+"""
+
+import os
+import json
+import time
+import socket
+import tempfile
+import argparse
+import multiprocessing
+from contextlib import redirect_stdout, redirect_stderr
+from urllib.request import urlopen
+
+import numpy as np
+
+from obspy.core.event import read_events
+
+from station_inventory import MyInventory, MyStation
+from download_waveform_data import download_waveform_data, engines
+from fdsn_standin_server import run_server
+
+
+#-------------------------
+# configuration
+
+data_dir = "test_python_script"
+
+workers_list = [1, 8]
+
+#-------------------------
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def server_stats(base_url):
+    with urlopen(f"{base_url}/stats") as response:
+        return json.load(response)
+
+
+def start_server(data_dir, latency, error_rate, bandwidth):
+    """Start the stand-in server in another process, return the process and its url."""
+
+    port = free_port()
+    process = multiprocessing.Process(target=run_server, args=(data_dir, port, latency, error_rate, bandwidth), daemon=True)
+    process.start()
+
+    base_url = f"http://127.0.0.1:{port}"
+
+    # wait for the data to be loaded
+    while True:
+        try:
+            server_stats(base_url)
+            break
+        except OSError:
+            time.sleep(0.5)
+
+    return process, base_url
+
+
+def stations_from_dir(stations_dir):
+    """Station list from the StationXML file names (NET.STA.xml)."""
+    stations = MyInventory()
+    for f in sorted(os.listdir(stations_dir)):
+        nw,code,_ = f.split(".")
+        stations.append(MyStation(code, nw, np.nan, np.nan))
+    return stations
+
+
+def directory_size(directory):
+    if not os.path.isdir(directory):
+        return 0
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+
+def benchmark_engine(event, stations, engine, max_workers, base_url):
+    """Download all stations in an empty directory, return the measures."""
+
+    with tempfile.TemporaryDirectory() as event_dir:
+
+        requests_before = server_stats(base_url)["requests"]
+
+        t0 = time.time()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+            summary = download_waveform_data(event, stations, max_workers=max_workers, engine=engine, base_url=base_url, manifest_file=None, event_dir=event_dir)
+        wall_time = time.time() - t0
+
+        n_bytes = directory_size(os.path.join(event_dir, "waveforms")) + directory_size(os.path.join(event_dir, "stations"))
+
+    return {
+        "engine"    : engine,
+        "workers"   : max_workers,
+        "time"      : wall_time,
+        "requests"  : server_stats(base_url)["requests"] - requests_before,
+        "ok"        : sum(status == "ok" for status,_ in summary.values()),
+        "bytes"     : n_bytes,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d",dest='data_dir', type=str, default=data_dir, help='directory with stations/ and waveforms/ directories and the event.xml file')
+
+    parser.add_argument("--url", type=str, default=None, help='FDSN server (default : start a stand-in server on data_dir)')
+
+    parser.add_argument("--engines", type=str, nargs="+", default=list(engines), choices=engines, help='download engines')
+
+    parser.add_argument("-j",dest='workers', type=int, nargs="+", default=workers_list, help='numbers of workers')
+
+    parser.add_argument("--latency", type=float, default=0., help='stand-in server latency (s)')
+
+    parser.add_argument("--error-rate", dest='error_rate', type=float, default=0., help='stand-in server error rate')
+
+    parser.add_argument("--bandwidth", type=float, default=0., help='stand-in server bandwidth per connection (bytes/s)')
+
+    args = parser.parse_args()
+
+    event = read_events(os.path.join(args.data_dir, "event.xml"))[0]
+    stations = stations_from_dir(os.path.join(args.data_dir, "stations"))
+
+    if args.url:
+        base_url = args.url
+    else:
+        server, base_url = start_server(args.data_dir, args.latency, args.error_rate, args.bandwidth)
+
+    print(f"Downloading {stations.len()} stations from {base_url} (latency {args.latency}s, error rate {args.error_rate}, bandwidth {args.bandwidth or 'unlimited'})")
+    print(f"{'engine':<8} {'workers':>7} {'time (s)':>9} {'requests':>9} {'stations':>9} {'stations/s':>11} {'MB/s':>7}")
+
+    for engine in args.engines:
+        for max_workers in args.workers:
+            res = benchmark_engine(event, stations, engine, max_workers, base_url)
+            print(f"{res['engine']:<8} {res['workers']:>7} {res['time']:>9.2f} {res['requests']:>9} {res['ok']:>9} {res['ok']/res['time']:>11.2f} {res['bytes']/1e6/res['time']:>7.2f}")
+
+    if not args.url:
+        server.terminate()
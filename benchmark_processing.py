@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Processing stages benchmark of mseed2obspy_stream on an already downloaded
+event : each batch stage is timed against the obspy per-trace method it
+replaces, on copies of the same stream, and the maximum difference between the
+two results is reported (relative to the maximum amplitude of the traces).
+
+The resampling stage is compared to obspy's interpolation on the same time
+grid, which is not anti-aliased : their results differ by the aliased high
+frequencies, and are compared again in the band of the processing.
+
+Usage : python benchmark_processing.py -d test_python_script -n 5
+"""
+
+import os
+import time
+import argparse
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from obspy import UTCDateTime
+from obspy.core.event import read_events
+
+import mseed2obspy_stream as m2o
+
+
+#-------------------------
+# configuration
+
+data_dir = "test_python_script"
+
+n_repeats = 5
+
+# period bands (s) of the multi-band stage
+bands = [(5., 10.), (10., 20.), (20., 50.), (30., 60.), (50., 100.)]
+
+#-------------------------
+
+
+def load_stream(data_dir):
+    """Stream of the event with its metadata (the input of the resampling
+    stage)."""
+
+    event = read_events(os.path.join(data_dir, "event.xml"))[0]
+    origin = event.preferred_origin()
+
+    stations = m2o.read_stations(os.path.join(data_dir, m2o.stations_dir), os.path.join(data_dir, m2o.wf_dir), origin.time)
+    st, _ = m2o.read_waveforms(os.path.join(data_dir, m2o.wf_dir))
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        m2o.add_metadata(st, stations, origin)
+    return st
+
+
+def rotated_stream(st):
+    """Resampled and rotated copy of st (the input of the filtering stage)."""
+    st = st.copy()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        m2o.resample_stream(st)
+        st._trim_common_channels()
+        m2o.rotate_ne_rt(st)
+    return st
+
+
+def time_stage(st, stage, n_repeats):
+    """Best time of the stage (applied in place on a copy of st), and its result."""
+
+    best = np.inf
+    for _ in range(n_repeats):
+        st_copy = st.copy()
+        t0 = time.perf_counter()
+        result = stage(st_copy)
+        best = min(best, time.perf_counter() - t0)
+    return best, st_copy if result is None else result
+
+
+def max_difference(st_ref, st):
+    """Maximum difference between the traces of two streams (matched by id,
+    over their common length), relative to the maximum amplitude."""
+
+    if isinstance(st, list):
+        return max(max_difference(a, b) for a,b in zip(st_ref, st))
+
+    ref = {tr.id : tr.data for tr in st_ref}
+    amplitude = max(np.abs(data).max() for data in ref.values())
+    differences = []
+    for tr in st:
+        n = min(len(tr.data), len(ref[tr.id]))
+        differences.append(np.abs(ref[tr.id][:n] - tr.data[:n]).max())
+    return max(differences) / amplitude
+
+
+def interpolate_on_grid(st):
+    """Per trace obspy interpolation on the same time grid as resample_stream
+    (without anti-alias filtering)."""
+    for tr in st:
+        tr.interpolate(m2o.sampling_rate, starttime=UTCDateTime(ns=m2o.grid_start_ns(tr.stats.starttime)))
+
+
+def bands_stages(bands):
+    frequencies = [(1/tmax, 1/tmin) for tmin,tmax in bands]
+    return (
+        lambda st: [st.copy().filter('bandpass', freqmin=freqmin, freqmax=freqmax, corners=m2o.corners) for freqmin,freqmax in frequencies],
+        lambda st: m2o.bandpass_filter_bands(st, frequencies))
+
+
+def resample_stages():
+    return (interpolate_on_grid, m2o.resample_stream)
+
+
+def filter_stages(freqmin, freqmax, zerophase):
+    return (
+        lambda st: st.filter('bandpass', freqmin=freqmin, freqmax=freqmax, corners=m2o.corners, zerophase=zerophase),
+        lambda st: m2o.bandpass_filter(st, freqmin, freqmax, zerophase=zerophase))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d",dest='data_dir', type=str, default=data_dir, help='directory with stations/ and waveforms/ directories and the event.xml file')
+
+    parser.add_argument("-n",dest='n_repeats', type=int, default=n_repeats, help='number of repetitions (best time kept)')
+
+    args = parser.parse_args()
+
+    st = load_stream(args.data_dir)
+    print(f"{len(st)} traces, {sum(tr.stats.npts for tr in st)} samples")
+    st_rotated = rotated_stream(st)
+
+    # stage -> (input stream, obspy stage, batch stage)
+    stages = {
+        "resample"              : (st, *resample_stages()),
+        "bandpass"              : (st_rotated, *filter_stages(1/m2o.ifmin, 1/m2o.ifmax, False)),
+        "bandpass (zerophase)"  : (st_rotated, *filter_stages(1/m2o.ifmin, 1/m2o.ifmax, True)),
+        f"bandpass ({len(bands)} bands)" : (st_rotated, *bands_stages(bands)),
+    }
+
+    print(f"{'stage':<24} {'obspy (s)':>10} {'batch (s)':>10} {'speedup':>8} {'max diff':>9}")
+
+    for name,(st_in,obspy_stage,batch_stage) in stages.items():
+        t_obspy, st_obspy = time_stage(st_in, obspy_stage, args.n_repeats)
+        t_batch, st_batch = time_stage(st_in, batch_stage, args.n_repeats)
+        print(f"{name:<24} {t_obspy:>10.3f} {t_batch:>10.3f} {t_obspy/t_batch:>8.1f} {max_difference(st_obspy, st_batch):>9.1e}")
+
+    # the resampled traces differ by their anti-alias filtering, compared
+    # again in the band of the processing
+    st_obspy, st_batch = st.copy(), st.copy()
+    interpolate_on_grid(st_obspy)
+    m2o.resample_stream(st_batch)
+    for st_resampled in (st_obspy, st_batch):
+        m2o.bandpass_filter(st_resampled, 1/m2o.ifmin, 1/m2o.ifmax)
+    print(f"resampled traces max diff in the {m2o.ifmax:.0f}-{m2o.ifmin:.0f} s band : {max_difference(st_obspy, st_batch):.1e}")
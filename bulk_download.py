@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Bulk download engine over the FDSN station and dataselect web services, an
+alternative to the per-station MassDownloader loop of download_waveform_data.
+
+All the stations of the inventory are requested with a few bulk POST requests
+(one per chunk of stations) over keep-alive HTTP connections :
+    1. station service (level=channel, text) : available channels
+    2. channel selection with the MassDownloader location/channel priorities
+    3. dataselect service : waveforms, split in one file per channel
+    4. station service (level=response) : one StationXML file per station
+
+The waveforms/ and stations/ directories have the same layout as with the
+MassDownloader. The base url can point to any FDSN server (e.g. a local one
+for testing).
+"""
+
+import os
+import io
+import re
+import threading
+import itertools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import obspy
+from obspy.clients.fdsn.mass_downloader import utils as mdl_utils
+
+from stationxml_cache import waveform_channels, has_channels
+
+
+#-------------------------
+# configuration
+
+fdsn_base_url = "http://service.iris.edu"
+
+# number of stations per bulk request
+chunk_size = 100
+
+# timeout of each request (seconds)
+timeout = 300.
+
+# minimum fraction of the requested time window a channel must cover
+minimum_length = 0.9
+
+#-------------------------
+
+
+Channel = namedtuple("Channel", ["location", "channel"])
+
+
+class FDSNBulkClient:
+    """Minimal FDSN client sending bulk POST requests, keeping one HTTP
+    session (keep-alive connections) per thread."""
+
+    def __init__(self, base_url=fdsn_base_url, timeout=timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.n_requests = 0
+        self.n_bytes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def query(self, service, bulk_lines, **params):
+        """POST a bulk request to service ("station" or "dataselect"),
+        return the response content or None if there is no data."""
+
+        url = f"{self.base_url}/fdsnws/{service}/1/query"
+        body = "\n".join([f"{key}={value}" for key,value in params.items()] + bulk_lines) + "\n"
+
+        response = self.session.post(url, data=body.encode(), timeout=self.timeout)
+
+        with self._lock:
+            self.n_requests += 1
+            self.n_bytes += len(response.content)
+
+        if response.status_code in (204, 404):
+            return None
+        response.raise_for_status()
+        return response.content
+
+
+def fdsn_channel_pattern(channel_priorities):
+    """Convert fnmatch channel priorities (e.g. BH[ZNE12]) to a FDSN
+    channel selection (e.g. BH?)."""
+    patterns = [re.sub(r"\[[^\]]*\]", "?", pattern) for pattern in channel_priorities]
+    return ",".join(dict.fromkeys(patterns))
+
+
+def fdsn_location(location):
+    return location if location else "--"
+
+
+def chunks(sequence, size):
+    sequence = list(sequence)
+    return [sequence[i:i+size] for i in range(0, len(sequence), size)]
+
+
+def parse_station_text(content):
+    """Parse a FDSN station text response (level=channel), return a
+    dictionnary (nw, stn) -> list of Channel."""
+
+    channels = {}
+    for line in content.decode().splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        nw, stn, loc, cha = [field.strip() for field in line.split("|")[:4]]
+        channels.setdefault((nw, stn), [])
+        if Channel(loc, cha) not in channels[(nw, stn)]:
+            channels[(nw, stn)].append(Channel(loc, cha))
+    return channels
+
+
+def select_channels(channels, location_priorities, channel_priorities):
+    """Same channel selection as the MassDownloader : channel priorities
+    applied for each location, then location priorities."""
+
+    def get_loc(x):
+        return x.location
+
+    filtered_channels = []
+    for _,_channels in itertools.groupby(sorted(channels, key=get_loc), get_loc):
+        filtered_channels.extend(mdl_utils.filter_channel_priority(
+            list(_channels), key="channel", priorities=channel_priorities))
+
+    return mdl_utils.filter_channel_priority(
+        filtered_channels, key="location", priorities=location_priorities)
+
+
+def bulk_download_waveform_data(
+        station_codes, starttime, endtime, location_priorities, channel_priorities,
+        stations_dir = "stations", wf_dir = "waveforms", reject_channels_with_gaps = True,
+        base_url = fdsn_base_url, chunk_size = chunk_size, max_workers = 1, windows = None):
+    """
+    station_codes : list of (network, station) codes
+    starttime, endtime : time window (UTCDateTime)
+    windows : per-station time windows, dictionnary (network, station) ->
+        (starttime, endtime) replacing the common window (see phase_windows.py)
+
+    Returns a dictionnary station id -> (status, message), status being
+    "ok", "skipped" (already downloaded), "no data" or "failed".
+    """
+
+    client = FDSNBulkClient(base_url)
+
+    os.makedirs(stations_dir, exist_ok=True)
+    os.makedirs(wf_dir, exist_ok=True)
+
+    windows = windows or {}
+
+    def window(nw, stn):
+        return windows.get((nw, stn), (starttime, endtime))
+
+    def bulk_times(nw, stn):
+        t1, t2 = window(nw, stn)
+        return f"{t1.isoformat()} {t2.isoformat()}"
+
+    summary = {f"{nw}.{stn}" : ("no data", "") for nw,stn in station_codes}
+
+    def run_chunks(function, items):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(function, chunks(items, chunk_size)))
+        return results
+
+    # 1. available channels
+
+    cha_pattern = fdsn_channel_pattern(channel_priorities)
+
+    def get_channels(chunk):
+        try:
+            content = client.query("station",
+                [f"{nw} {stn} * {cha_pattern} {bulk_times(nw, stn)}" for nw,stn in chunk],
+                level="channel", format="text")
+        except requests.RequestException as e:
+            for nw,stn in chunk:
+                summary[f"{nw}.{stn}"] = ("failed", f"station query : {e!r}")
+            return {}
+        return parse_station_text(content) if content else {}
+
+    available_channels = {}
+    for channels in run_chunks(get_channels, station_codes):
+        available_channels.update(channels)
+
+    # 2. channels selection (skipping already downloaded files)
+
+    requested_channels = []
+    for (nw,stn),channels in available_channels.items():
+        for channel in select_channels(channels, location_priorities, channel_priorities):
+            filename = mdl_utils.get_mseed_filename(wf_dir, nw, stn, channel.location, channel.channel, *window(nw, stn))
+            if os.path.exists(filename):
+                summary[f"{nw}.{stn}"] = ("skipped", "already downloaded")
+                continue
+            requested_channels.append((nw, stn, channel, filename))
+
+    # 3. waveforms
+
+    def get_waveforms(chunk):
+        try:
+            content = client.query("dataselect",
+                [f"{nw} {stn} {fdsn_location(channel.location)} {channel.channel} {bulk_times(nw, stn)}" for nw,stn,channel,_ in chunk])
+        except requests.RequestException as e:
+            for nw,stn,_,_ in chunk:
+                summary[f"{nw}.{stn}"] = ("failed", f"dataselect query : {e!r}")
+            return
+        if not content:
+            return
+
+        st = obspy.read(io.BytesIO(content), format="MSEED")
+
+        for nw,stn,channel,filename in chunk:
+            st_channel = st.select(network=nw, station=stn, location=channel.location, channel=channel.channel)
+            if not st_channel:
+                continue
+            if reject_channels_with_gaps and len(st_channel.get_gaps()) > 0:
+                continue
+            length = sum(tr.stats.endtime - tr.stats.starttime for tr in st_channel)
+            t1, t2 = window(nw, stn)
+            if length < minimum_length * (t2 - t1):
+                continue
+            st_channel.write(filename, format="MSEED")
+            if summary[f"{nw}.{stn}"][0] != "failed":
+                summary[f"{nw}.{stn}"] = ("ok", "")
+
+    run_chunks(get_waveforms, requested_channels)
+
+    # 4. stations metadata, for the stations with waveforms (downloaded again if
+    # the existing file, e.g. from the StationXML cache, misses some channels)
+
+    # (waveform files of each station, the directory being listed once)
+    wf_files = {}
+    for f in os.listdir(wf_dir):
+        wf_files.setdefault(".".join(f.split(".")[:2]), []).append(f)
+
+    stations_with_data = []
+    for nw,stn in station_codes:
+        xml_filename = mdl_utils.get_stationxml_filename(stations_dir, nw, stn, [], *window(nw, stn))
+        station_files = wf_files.get(f"{nw}.{stn}", [])
+        if not station_files:
+            continue
+        if os.path.exists(xml_filename) and has_channels(xml_filename, waveform_channels(station_files)):
+            continue
+        stations_with_data.append((nw, stn, xml_filename))
+
+    def get_stations(chunk):
+        try:
+            content = client.query("station",
+                [f"{nw} {stn} * {cha_pattern} {bulk_times(nw, stn)}" for nw,stn,_ in chunk],
+                level="response")
+        except requests.RequestException as e:
+            for nw,stn,_ in chunk:
+                summary[f"{nw}.{stn}"] = ("failed", f"station query : {e!r}")
+            return
+        if not content:
+            return
+
+        inv = obspy.read_inventory(io.BytesIO(content), format="STATIONXML")
+
+        for nw,stn,xml_filename in chunk:
+            inv_stn = inv.select(network=nw, station=stn)
+            if len(inv_stn) == 0:
+                continue
+            # (not written through a hard link to the StationXML cache)
+            if os.path.exists(xml_filename):
+                os.remove(xml_filename)
+            inv_stn.write(xml_filename, format="STATIONXML")
+
+    run_chunks(get_stations, stations_with_data)
+
+    # sanitize : only keep waveforms with station metadata
+
+    for nw,stn in station_codes:
+        station_id = f"{nw}.{stn}"
+        files = wf_files.get(station_id, [])
+        if not files or summary[station_id][0] == "failed":
+            continue
+        xml_filename = mdl_utils.get_stationxml_filename(stations_dir, nw, stn, [], *window(nw, stn))
+        if os.path.exists(xml_filename):
+            # new waveforms downloaded, or only files already there
+            if summary[station_id][0] == "ok":
+                summary[station_id] = ("ok", f"{len(files)} files")
+            else:
+                summary[station_id] = ("skipped", "already downloaded")
+        else:
+            for f in files:
+                os.remove(os.path.join(wf_dir, f))
+            summary[station_id] = ("no data", "no station metadata")
+
+    print(f"{client.n_requests} requests, {client.n_bytes/1e6:.1f} MB downloaded.")
+
+    return summary
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Local earthquake catalog store (SQLite), to answer repeated catalog queries
+(USGS, Global CMT) offline.
+
+The events are stored (as QuakeML) with their origin time, location and
+magnitude, indexed. The time ranges (and minimum magnitude) already requested
+to each catalog are recorded, so that only the uncovered time ranges are
+requested to the network.
+
+The store can also be filled from QuakeML/CMTSOLUTION/NDK files.
+
+Usage : python catalog_cache.py catalog.sqlite --import gcmt jan76_dec20.ndk --coverage 1976-01-01 2021-01-01 0
+        python catalog_cache.py catalog.sqlite -s 2016-08-23 -e 2016-08-24 -m 6
+"""
+
+import io
+import sqlite3
+import argparse
+
+from obspy import UTCDateTime, read_events
+from obspy.core.event import Catalog
+
+
+#-------------------------
+# configuration
+
+catalog_cache_file = "catalog.sqlite"
+
+#-------------------------
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS events (
+    catalog TEXT, id TEXT, time REAL, latitude REAL, longitude REAL, depth REAL, magnitude REAL, quakeml BLOB,
+    PRIMARY KEY (catalog, id));
+CREATE INDEX IF NOT EXISTS events_time ON events (catalog, time);
+CREATE INDEX IF NOT EXISTS events_magnitude ON events (catalog, magnitude);
+CREATE INDEX IF NOT EXISTS events_location ON events (catalog, latitude, longitude);
+CREATE TABLE IF NOT EXISTS coverage (
+    catalog TEXT, starttime REAL, endtime REAL, minmagnitude REAL);
+"""
+
+
+class CatalogCache:
+
+    def __init__(self, filename = catalog_cache_file):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    # storing
+
+    def add_events(self, catalog, events):
+        """Store events (obspy catalog or list of events) of a catalog."""
+
+        rows = []
+        for event in events:
+            origin = event.preferred_origin() or event.origins[0]
+            magnitude = event.preferred_magnitude() or (event.magnitudes[0] if event.magnitudes else None)
+            buf = io.BytesIO()
+            Catalog(events=[event]).write(buf, format="QUAKEML")
+            rows.append((
+                catalog, str(event.resource_id), origin.time.timestamp, origin.latitude, origin.longitude,
+                origin.depth, magnitude.mag if magnitude else None, buf.getvalue()))
+
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO events VALUES (?,?,?,?,?,?,?,?)", rows)
+
+        return len(rows)
+
+    def add_coverage(self, catalog, starttime, endtime, minmagnitude = None):
+        """Record that all the events of the catalog in the time range (above
+        minmagnitude) are stored."""
+        with self.db:
+            self.db.execute("INSERT INTO coverage VALUES (?,?,?,?)", (
+                catalog, UTCDateTime(starttime).timestamp, UTCDateTime(endtime).timestamp,
+                minmagnitude if minmagnitude is not None else -99.))
+
+    def import_file(self, catalog, filename, coverage = None):
+        """Store the events of a QuakeML/CMTSOLUTION/NDK file, coverage being
+        an optional (starttime, endtime, minmagnitude) covered by the file."""
+        n = self.add_events(catalog, read_events(filename))
+        if coverage:
+            self.add_coverage(catalog, *coverage)
+        return n
+
+    # querying
+
+    def uncovered(self, catalog, starttime, endtime, minmagnitude = None):
+        """Time ranges (starttime, endtime) not covered by previous requests."""
+
+        minmagnitude = minmagnitude if minmagnitude is not None else -99.
+        t1, t2 = UTCDateTime(starttime).timestamp, UTCDateTime(endtime).timestamp
+
+        covered = self.db.execute(
+            "SELECT starttime, endtime FROM coverage WHERE catalog = ? AND minmagnitude <= ? AND endtime > ? AND starttime < ? ORDER BY starttime",
+            (catalog, minmagnitude, t1, t2)).fetchall()
+
+        ranges = []
+        t = t1
+        for start,end in covered:
+            if start > t:
+                ranges.append((UTCDateTime(t), UTCDateTime(min(start, t2))))
+            t = max(t, end)
+            if t >= t2:
+                break
+        if t < t2:
+            ranges.append((UTCDateTime(t), UTCDateTime(t2)))
+        return ranges
+
+    def query(self, catalog, starttime, endtime, minmagnitude = None, maxmagnitude = None,
+              minlatitude = -90., maxlatitude = 90., minlongitude = -180., maxlongitude = 180.):
+        """Stored events of a catalog matching the conditions (obspy catalog)."""
+
+        rows = self.db.execute(
+            "SELECT quakeml FROM events WHERE catalog = ? AND time >= ? AND time <= ? "
+            "AND magnitude >= ? AND magnitude <= ? AND latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ? ORDER BY time",
+            (catalog, UTCDateTime(starttime).timestamp, UTCDateTime(endtime).timestamp,
+             minmagnitude if minmagnitude is not None else -99., maxmagnitude if maxmagnitude is not None else 99.,
+             minlatitude, maxlatitude, minlongitude, maxlongitude)).fetchall()
+
+        events = Catalog()
+        for (quakeml,) in rows:
+            events += read_events(io.BytesIO(quakeml), format="QUAKEML")
+        return events
+
+    def get_events(self, catalog, starttime, endtime, minmagnitude = None, maxmagnitude = None, fetch = None, **kwargs):
+        """Events of a catalog matching the conditions, the uncovered time ranges
+        being first requested with fetch(starttime, endtime, minmagnitude)
+        (returning an obspy catalog)."""
+
+        if fetch:
+            for t1,t2 in self.uncovered(catalog, starttime, endtime, minmagnitude):
+                self.add_events(catalog, fetch(t1, t2, minmagnitude))
+                self.add_coverage(catalog, t1, t2, minmagnitude)
+
+        return self.query(catalog, starttime, endtime, minmagnitude, maxmagnitude, **kwargs)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("db_file", type=str, help='catalog store (sqlite file)')
+
+    parser.add_argument("--import", dest='import_file', type=str, nargs=2, metavar=("CATALOG", "FILE"), help='import the events of a QuakeML/CMTSOLUTION/NDK file in a catalog')
+
+    parser.add_argument("--coverage", type=str, nargs=3, metavar=("START", "END", "MINMAG"), help='time range and minimum magnitude covered by the imported file')
+
+    parser.add_argument("-c",dest='catalog', type=str, default="usgs", help='catalog to query')
+
+    parser.add_argument("-s",dest='starttime', type=str, help='query start time')
+
+    parser.add_argument("-e",dest='endtime', type=str, help='query end time')
+
+    parser.add_argument("-m",dest='minmagnitude', type=float, default=None, help='query minimum magnitude')
+
+    parser.add_argument("-M",dest='maxmagnitude', type=float, default=None, help='query maximum magnitude')
+
+    args = parser.parse_args()
+
+    cache = CatalogCache(args.db_file)
+
+    if args.import_file:
+        catalog, filename = args.import_file
+        coverage = (args.coverage[0], args.coverage[1], float(args.coverage[2])) if args.coverage else None
+        n = cache.import_file(catalog, filename, coverage)
+        print(f"{n} events imported in catalog {catalog}")
+
+    if args.starttime and args.endtime:
+        print(cache.query(args.catalog, args.starttime, args.endtime, args.minmagnitude, args.maxmagnitude))
+
+    cache.close()
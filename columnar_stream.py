@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Columnar output format for the processed streams of mseed2obspy_stream, as an
+alternative to the PICKLE format.
+
+An event is a directory (<event>.cols) containing :
+    - data.npy : 2-D float array (one row per trace, the traces sharing the
+      sampling rate), padded with NaN after the end of the shorter traces,
+      memory-mapped when read
+    - traces.csv : the metadata table, one row per trace (id, component,
+      distance, back azimuth, coordinates, start time (ns), number of samples)
+    - event.json : the fields common to all the traces (sampling rate, event
+      location and origin time)
+
+Readers select the traces (by component, distance, back azimuth) on the
+metadata table and only read the corresponding rows of the array.
+
+Usage : python columnar_stream.py event.pkl -o event.cols
+    converts a PICKLE stream file
+        python columnar_stream.py event.cols -c T --dist 90 110
+    prints a selection of the traces
+"""
+
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from obspy import read, Stream, Trace, UTCDateTime
+from obspy.core.util import AttribDict
+
+
+#-------------------------
+# configuration
+
+columnar_ext = ".cols"
+
+data_filename = "data.npy"
+traces_filename = "traces.csv"
+event_filename = "event.json"
+
+#-------------------------
+
+
+def _traces_table(st):
+    """Metadata table of the traces of a processed stream (with the QC tags,
+    see trace_qc.py, if tagged)."""
+    table = pd.DataFrame({
+        "id"            : [tr.id for tr in st],
+        "network"       : [tr.stats.network for tr in st],
+        "station"       : [tr.stats.station for tr in st],
+        "location"      : [tr.stats.location for tr in st],
+        "channel"       : [tr.stats.channel for tr in st],
+        "component"     : [tr.stats.channel[-1] for tr in st],
+        "starttime_ns"  : [tr.stats.starttime.ns for tr in st],
+        "npts"          : [tr.stats.npts for tr in st],
+        "distance"      : [tr.stats.distance for tr in st],
+        "back_azimuth"  : [tr.stats.back_azimuth for tr in st],
+        "latitude"      : [tr.stats.coordinates["latitude"] for tr in st],
+        "longitude"     : [tr.stats.coordinates["longitude"] for tr in st],
+        "elevation"     : [tr.stats.coordinates["elevation"] for tr in st],
+        "local_depth"   : [tr.stats.coordinates["local_depth"] for tr in st],
+    })
+    if any("qc" in tr.stats for tr in st):
+        table["qc"] = [tr.stats.get("qc", "") for tr in st]
+    return table
+
+
+def _event_fields(st):
+    """Fields common to all the traces of a processed stream (and the
+    processing entries common to all the traces)."""
+    stats = st[0].stats
+    processing = [info for info in stats.get("processing", []) if all(info in tr.stats.get("processing", []) for tr in st)]
+    return {
+        "sampling_rate"     : stats.sampling_rate,
+        "evla"              : stats.evla,
+        "evlo"              : stats.evlo,
+        "evde"              : stats.evde,
+        "event_origin_time" : stats.event_origin_time.ns,
+        "processing"        : processing,
+    }
+
+
+class ColumnarWriter:
+    """Incremental writer : the streams appended (processed traces with the
+    same sampling rate) are written to disk batch by batch, and assembled in
+    the columnar format on close, without holding all the traces in memory."""
+
+    def __init__(self, out_dir, dtype = np.float64):
+        self.out_dir = out_dir
+        self.dtype = dtype
+        self.tmp_dir = out_dir + ".tmp"
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        self.batches = []
+        self.tables = []
+        self.event = None
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables)
+
+    def append(self, st):
+        """Append a stream, or a ColumnarStream (e.g. compact stream, see
+        compact_stream.py)."""
+
+        if len(st) == 0:
+            return
+
+        columnar = isinstance(st, ColumnarStream)
+
+        sampling_rates = set([st.event["sampling_rate"]] if columnar else [tr.stats.sampling_rate for tr in st])
+        if self.event:
+            sampling_rates.add(self.event["sampling_rate"])
+        if len(sampling_rates) > 1:
+            raise ValueError(f"Traces with different sampling rates : {sorted(sampling_rates)}")
+
+        if self.event is None:
+            self.event = dict(st.event) if columnar else _event_fields(st)
+
+        batch_file = os.path.join(self.tmp_dir, f"batch_{len(self.batches)}.npy")
+        if columnar:
+            np.save(batch_file, np.asarray(st.data, dtype=self.dtype))
+        else:
+            npts_max = max(tr.stats.npts for tr in st)
+            data = np.lib.format.open_memmap(batch_file, mode="w+", dtype=self.dtype, shape=(len(st), npts_max))
+            for i,tr in enumerate(st):
+                data[i,:tr.stats.npts] = tr.data
+                data[i,tr.stats.npts:] = np.nan
+            data.flush()
+            del data
+
+        self.batches.append(batch_file)
+        self.tables.append(st.traces if columnar else _traces_table(st))
+
+    def close(self):
+
+        if not self.batches:
+            shutil.rmtree(self.tmp_dir)
+            raise ValueError("No traces written")
+
+        traces = pd.concat(self.tables, ignore_index=True)
+        npts_max = int(traces["npts"].max())
+
+        # batches copied one by one in the memory-mapped array
+        data = np.lib.format.open_memmap(os.path.join(self.tmp_dir, data_filename), mode="w+", dtype=self.dtype, shape=(len(traces), npts_max))
+        i = 0
+        for batch_file in self.batches:
+            batch = np.load(batch_file, mmap_mode="r")
+            data[i:i+len(batch),:batch.shape[1]] = batch
+            data[i:i+len(batch),batch.shape[1]:] = np.nan
+            i += len(batch)
+            del batch
+            os.remove(batch_file)
+        data.flush()
+        del data
+
+        traces.to_csv(os.path.join(self.tmp_dir, traces_filename), index=False)
+
+        with open(os.path.join(self.tmp_dir, event_filename), "w") as f:
+            json.dump(self.event, f, indent=1)
+
+        if os.path.exists(self.out_dir):
+            shutil.rmtree(self.out_dir)
+        os.rename(self.tmp_dir, self.out_dir)
+
+
+def write_columnar(st, out_dir, dtype = np.float64):
+    """Write a processed stream (traces with the same sampling rate and the
+    metadata added by mseed2obspy_stream) in the columnar format."""
+    writer = ColumnarWriter(out_dir, dtype)
+    writer.append(st)
+    writer.close()
+
+
+class ColumnarStream:
+
+    def __init__(self, in_dir):
+        self.in_dir = in_dir
+        self.traces = pd.read_csv(os.path.join(in_dir, traces_filename), keep_default_na=False, float_precision="round_trip", dtype={"location" : str, "network" : str, "station" : str, "qc" : str})
+        with open(os.path.join(in_dir, event_filename)) as f:
+            self.event = json.load(f)
+        # not read until used
+        self.data = np.load(os.path.join(in_dir, data_filename), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.traces)
+
+    def select(self, component = None, dmin = None, dmax = None, bazmin = None, bazmax = None, station = None):
+        """Indexes of the traces matching the conditions."""
+
+        mask = np.ones(len(self.traces), dtype=bool)
+        if component is not None:
+            mask &= (self.traces["component"] == component).values
+        if station is not None:
+            mask &= (self.traces["station"] == station).values
+        if dmin is not None:
+            mask &= (self.traces["distance"] >= dmin).values
+        if dmax is not None:
+            mask &= (self.traces["distance"] <= dmax).values
+        if bazmin is not None:
+            mask &= (self.traces["back_azimuth"] >= bazmin).values
+        if bazmax is not None:
+            mask &= (self.traces["back_azimuth"] <= bazmax).values
+        return np.flatnonzero(mask)
+
+    def get_data(self, indexes):
+        """Array of the data of the selected traces (rows padded with NaN)."""
+        return np.asarray(self.data[np.sort(indexes)])
+
+    def to_stream(self, indexes = None):
+        """Obspy stream of the selected traces (all if None), with the same
+        metadata as the PICKLE output of mseed2obspy_stream."""
+
+        if indexes is None:
+            indexes = np.arange(len(self))
+        indexes = np.sort(indexes)
+
+        origin_time = UTCDateTime(ns = self.event["event_origin_time"])
+
+        st = Stream()
+        for i,row in zip(indexes, self.traces.iloc[indexes].itertuples()):
+            tr = Trace(data = np.array(self.data[i,:row.npts]))
+            tr.stats.network = row.network
+            tr.stats.station = row.station
+            tr.stats.location = row.location
+            tr.stats.channel = row.channel
+            tr.stats.starttime = UTCDateTime(ns = row.starttime_ns)
+            tr.stats.sampling_rate = self.event["sampling_rate"]
+            tr.stats.coordinates = AttribDict(latitude = row.latitude, longitude = row.longitude, elevation = row.elevation, local_depth = row.local_depth)
+            tr.stats.evla = self.event["evla"]
+            tr.stats.evlo = self.event["evlo"]
+            tr.stats.evde = self.event["evde"]
+            tr.stats.event_origin_time = origin_time
+            tr.stats.back_azimuth = row.back_azimuth
+            tr.stats.distance = row.distance
+            if "qc" in self.traces.columns:
+                tr.stats.qc = row.qc
+            if "processing" in self.event:
+                tr.stats.processing = list(self.event["processing"])
+            st.append(tr)
+        return st
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("in_file", type=str, help='PICKLE stream file (converted) or columnar directory (selection printed)')
+
+    parser.add_argument("-o",dest='out_dir', type=str, default=None, help='output columnar directory (default : in_file with .cols extension)')
+
+    parser.add_argument("-c",dest='component', type=str, default=None, help='component')
+
+    parser.add_argument("--dist", type=float, nargs=2, default=(None, None), help='distance range (°)')
+
+    parser.add_argument("--baz", type=float, nargs=2, default=(None, None), help='back azimuth range (°)')
+
+    args = parser.parse_args()
+
+    if os.path.isdir(args.in_file):
+        cs = ColumnarStream(args.in_file)
+        indexes = cs.select(args.component, *args.dist, *args.baz)
+        print(f"{len(indexes)}/{len(cs)} traces selected")
+        print(cs.traces.iloc[indexes][["id", "distance", "back_azimuth", "npts"]].to_string(index=False))
+    else:
+        out_dir = args.out_dir or os.path.splitext(args.in_file)[0] + columnar_ext
+        write_columnar(read(args.in_file, format="PICKLE"), out_dir)
+        print(f"{args.in_file} -> {out_dir}")
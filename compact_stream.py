@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Compact in-memory processed stream (compact mode of mseed2obspy_stream) :
+    - the samples of all the traces in a single contiguous float32 array (one
+      row per trace, padded with NaN), which can be allocated in shared memory
+      so that worker processes read and write it without copy
+    - the metadata in a table, one row per trace
+    - the event fields (sampling rate, event location and origin time) stored
+      once
+
+It has the layout of the columnar format (see columnar_stream.py), in which it
+is written directly, and the same selection methods.
+
+Usage : python compact_stream.py event.pkl
+    compares the memory used by a processed stream and its compact version
+"""
+
+import os
+import json
+import shutil
+import argparse
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from obspy import read, __version__ as obspy_version
+from obspy.signal.filter import bandpass
+
+from columnar_stream import ColumnarStream, _traces_table, _event_fields, data_filename, traces_filename, event_filename
+
+
+#-------------------------
+# configuration
+
+compact_dtype = np.float32
+
+#-------------------------
+
+
+def start_resource_tracker():
+    """Start the resource tracker of the shared memory blocks, before starting
+    the worker processes attaching them : the workers then share the tracker
+    of the process creating the blocks (the blocks being registered once, and
+    unregistered when unlinked by this process), instead of starting their own
+    tracker, which would unlink the blocks when they exit."""
+    resource_tracker.ensure_running()
+
+
+def attach(name, shape, dtype):
+    """Shared memory block of a compact stream (in a worker process started
+    after start_resource_tracker) and its array."""
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class CompactStream(ColumnarStream):
+
+    def __init__(self, data, traces, event, shm = None):
+        self.in_dir = None
+        self.data = data
+        self.traces = traces
+        self.event = event
+        self.shm = shm
+
+    @classmethod
+    def empty(cls, shape, traces, event, dtype = compact_dtype, shared = False):
+        """Compact stream with an array of NaN (in shared memory if shared)."""
+        shm = None
+        if shared:
+            shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        else:
+            data = np.empty(shape, dtype=dtype)
+        data[:] = np.nan
+        return cls(data, traces, event, shm)
+
+    @classmethod
+    def from_stream(cls, st, dtype = compact_dtype, shared = False):
+        """Compact version of a processed stream (traces with the same sampling
+        rate and the metadata added by mseed2obspy_stream)."""
+
+        sampling_rates = set(tr.stats.sampling_rate for tr in st)
+        if len(sampling_rates) > 1:
+            raise ValueError(f"Traces with different sampling rates : {sorted(sampling_rates)}")
+
+        traces = _traces_table(st)
+        cs = cls.empty((len(st), int(traces["npts"].max())), traces, _event_fields(st), dtype, shared)
+        for i,tr in enumerate(st):
+            cs.data[i,:tr.stats.npts] = tr.data
+        return cs
+
+    def like(self, shared = None):
+        """Compact stream of the same traces, with an array of NaN."""
+        return self.empty(self.data.shape, self.traces, self.event, self.data.dtype, self.shm is not None if shared is None else shared)
+
+    def shared_array(self):
+        """Name, shape and dtype of the shared array (see attach)."""
+        return self.shm.name, self.data.shape, self.data.dtype.str
+
+    def nbytes(self):
+        return self.data.nbytes + int(self.traces.memory_usage(deep=True).sum())
+
+    def write(self, out_dir):
+        """Write in the columnar format."""
+
+        tmp_dir = out_dir + ".tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        np.save(os.path.join(tmp_dir, data_filename), self.data)
+        self.traces.to_csv(os.path.join(tmp_dir, traces_filename), index=False)
+        with open(os.path.join(tmp_dir, event_filename), "w") as f:
+            json.dump(self.event, f, indent=1)
+
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        os.rename(tmp_dir, out_dir)
+
+    def close(self):
+        """Release the shared memory."""
+        if self.shm is not None:
+            self.data = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __getstate__(self):
+        # pickled (stage cache) as a private array
+        state = dict(self.__dict__)
+        state["data"] = np.array(self.data)
+        state["shm"] = None
+        return state
+
+
+def bandpass_processing(freqmin, freqmax, corners, zerophase):
+    """Entry of tr.stats.processing of a bandpass filter, as recorded by st.filter."""
+    options = {"freqmin" : freqmin, "freqmax" : freqmax, "corners" : corners, "zerophase" : zerophase}
+    return f"ObsPy {obspy_version}: filter(args=()::options={options}::type='bandpass')"
+
+
+def _bandpass_rows(src, dst, rows, npts, freqmin, freqmax, df, corners, zerophase):
+    dst[rows,:npts] = bandpass(src[rows,:npts].astype(np.float64), freqmin, freqmax, df, corners=corners, zerophase=zerophase, axis=-1)
+
+
+def _bandpass_shared(task):
+    """Worker : bandpass filter rows of a shared array into another one."""
+    src, dst, *args = task
+    src_shm, src_data = attach(*src)
+    dst_shm, dst_data = attach(*dst)
+    try:
+        _bandpass_rows(src_data, dst_data, *args)
+    finally:
+        del src_data, dst_data
+        src_shm.close()
+        dst_shm.close()
+
+
+def bandpass_compact(cs, bands, corners = 4, zerophase = False, pool = None, in_place = False):
+    """Bandpass filter a compact stream in several frequency bands (list of
+    (freqmin, freqmax)), the traces of the same length being filtered at once.
+
+    pool : process pool (started after start_resource_tracker), the rows being
+        filtered by the workers in the shared arrays (cs being in shared memory)
+    in_place : filter cs itself (one band only)
+
+    Returns the list of the filtered compact streams, one per band.
+    """
+
+    if in_place and len(bands) != 1:
+        raise ValueError("Only one band can be filtered in place")
+
+    outputs = [cs] if in_place else []
+    df = cs.event["sampling_rate"]
+    groups = cs.traces.groupby("npts").indices
+
+    try:
+        if not in_place:
+            for _ in bands:
+                outputs.append(cs.like())
+
+        if pool is None or cs.shm is None:
+            for out,(freqmin,freqmax) in zip(outputs, bands):
+                for npts,rows in groups.items():
+                    _bandpass_rows(cs.data, out.data, rows, int(npts), freqmin, freqmax, df, corners, zerophase)
+        else:
+            n_chunks = getattr(pool, "_max_workers", 1)
+            tasks = [
+                (cs.shared_array(), out.shared_array(), chunk, int(npts), freqmin, freqmax, df, corners, zerophase)
+                for out,(freqmin,freqmax) in zip(outputs, bands)
+                for npts,rows in groups.items()
+                for chunk in np.array_split(rows, min(n_chunks, len(rows)))]
+            for _ in pool.map(_bandpass_shared, tasks):
+                pass
+    except BaseException:
+        # (shared memory released on failure)
+        for out in outputs:
+            out.close()
+        raise
+
+    # (the outputs share the event fields of cs)
+    for out,(freqmin,freqmax) in zip(outputs, bands):
+        out.event = dict(out.event, processing = out.event.get("processing", []) + [bandpass_processing(freqmin, freqmax, corners, zerophase)])
+    return outputs
+
+
+if __name__ == "__main__":
+
+    import tracemalloc
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("in_file", type=str, help='PICKLE stream file')
+
+    args = parser.parse_args()
+
+    # memory allocated by each representation
+    tracemalloc.start()
+    st = read(args.in_file, format="PICKLE")
+    stream_bytes = tracemalloc.get_traced_memory()[0]
+    cs = CompactStream.from_stream(st)
+    compact_bytes = tracemalloc.get_traced_memory()[0] - stream_bytes
+    tracemalloc.stop()
+
+    print(f"{len(st)} traces : stream {stream_bytes/1e6:.1f} MB, compact stream {compact_bytes/1e6:.1f} MB")
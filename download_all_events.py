@@ -13,16 +13,22 @@ INPUTS :
 """
 
 from datetime import datetime
-from genericpath import exists
 import os,sys
+import argparse
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from obspy.core.event import read_events
 
 sys.path.append('/home/gcl/BR/sbrisson/getting_observation_data_ULVZs')
 
 from station_inventory import MyInventory
-from download_waveform_data import download_waveform_data
-from mseed2obspy_stream import mseed2obspy_stream
+from download_waveform_data import download_waveform_data, engines, fdsn_base_url
+from mseed2obspy_stream import mseed2obspy_stream, out_extensions
+from download_manifest import DownloadManifest, manifest_filename
+from trace_index import TraceIndex
+from work_queue import WorkQueue
+from waveform_container import WaveformContainer
 
 #-------------------------
 # configuration
@@ -34,77 +40,281 @@ stations_dir = "stations_usgs_cmtslt"
 mseed_data_dir = "mseed_data"
 pkl_data_dir = "obspy_pkl_data"
 
+# format of the obspy streams : "PICKLE" or "COLUMNAR" (see columnar_stream.py)
+out_format = "PICKLE"
+
+# index of the metadata of the traces of all the events (see trace_index.py), None to disable
+trace_index_file = "traces_index.sqlite"
+
+# index of the traces of each event (in the event directory), merged into
+# trace_index_file (SQLite files not being written concurrently by the nodes)
+event_index_filename = "traces_index.sqlite"
+
+# cache of the intermediate products of the processing (see stage_cache.py),
+# e.g. "stage_cache" to change the filtering without reading the data again, None to disable
+stage_cache_dir = None
+
+# download and process only the windows around the predicted S/Sdiff arrivals
+# (see phase_windows.py)
+phase_cut = False
+
+# number of stations downloaded concurrently for each event
+max_workers = 8
+
+# download engine : "mdl" (MassDownloader) or "bulk" (FDSN bulk requests)
+engine = "mdl"
+
+
+# number of events processed in parallel (one process per event)
+jobs = 1
+
+# number of workers reading the waveform files (see mseed2obspy_stream.py),
+# shared by the events processed in parallel (read_workers // jobs per event)
+read_workers = os.cpu_count() or 1
+
+# per-event log file (in the event directory) when events are processed in parallel
+event_log_filename = "download_all_events.log"
+
+# work queue directory shared by the nodes (queue mode, see work_queue.py)
+queue_dir = "queue"
+
+# StationXML cache shared by all the events (see stationxml_cache.py), None to disable
+station_cache_dir = "stationxml_cache"
+
+# pack the waveform files of each event into a single container (see waveform_container.py)
+pack_waveforms = True
+
 
 #-------------------------
 
-if __name__ == "__main__":
 
+def get_event_ids(line):
+    """Event ids from a line (date magnitude) of the events list."""
 
-    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    date_str = line.split()[0]
+    mag = float(line.split()[1])
+
+    date = datetime.strptime(date_str, "%Y/%m/%d")
+    date_str2 = date.strftime("%d-%b-%Y")
+    date_str3 = date.strftime("%Y-%m-%d")
+
+    event_id = f"{mag:.1f}_{date_str2}"
+    event_id2 = f"{date_str3}_{mag}"
+
+    return event_id, event_id2
+
+
+def process_event(line, base_dir, max_workers=max_workers, engine=engine, log_to_file=False, base_url=fdsn_base_url, read_workers=read_workers):
+    """Download and convert into an obspy stream the data of an event (line
+    of the events list). All paths are relative to base_dir.
+
+    If log_to_file, the outputs are written in a log file in the event directory.
     
-    with open(in_file, "r") as f:
-        date_mag = f.readlines()
+    Returns a dictionnary summarizing the event processing.
+    """
+
+    _, event_id2 = get_event_ids(line)
+
+    event_dir = os.path.join(base_dir, mseed_data_dir, event_id2)
+    os.makedirs(event_dir, exist_ok=True)
+
+    if not log_to_file:
+        return _process_event(line, base_dir, event_dir, max_workers, engine, base_url, read_workers)
+
+    with open(os.path.join(event_dir, event_log_filename), "a") as log:
+        with redirect_stdout(log), redirect_stderr(log):
+            return _process_event(line, base_dir, event_dir, max_workers, engine, base_url, read_workers)
+
+
+def _process_event(line, base_dir, event_dir, max_workers, engine, base_url, read_workers):
+
+    event_id, event_id2 = get_event_ids(line)
+
+    result = {"event" : event_id2, "status" : "ok", "ok" : 0, "skipped" : 0, "no data" : 0, "failed" : 0, "message" : ""}
+
+    print(f"Downloading data for event {event_id2}")
+
+    # get event and receivers list file names
+
+    event_filename = os.path.join(base_dir, events_dir, f"{event_id}.cmtsolution")
+
+    stations_filename = os.path.join(base_dir, stations_dir, f"{event_id}_receivers.dat")
+
+    # load metadata
+
+    try:
+        # read event information
+        events = read_events(event_filename)
+        event = events[0]
+
+    except FileNotFoundError:
+        print(f"Error, unable to open event file for event {event_id2}")
+        result.update(status = "failed", message = "no event file")
+        return result
 
-    for line in date_mag[1:]:
+    try:
+        # read station information
+        stations = MyInventory()
+        stations.read_fromDat(stations_filename)
 
-        os.chdir(cur_dir)
+    except FileNotFoundError:
+        print(f"Error, unable to open station file for event {event_id2}")
+        result.update(status = "failed", message = "no station file")
+        return result
 
-        # get event and receivers list file names
+    # dowload data
+    event_station_cache_dir = os.path.join(base_dir, station_cache_dir) if station_cache_dir else None
 
-        date_str = line.split()[0]
-        mag = float(line.split()[1])
+    summary = download_waveform_data(event, stations, max_workers=max_workers, engine=engine, base_url=base_url, event_dir=event_dir, station_cache_dir=event_station_cache_dir, phase_cut=phase_cut)
 
-        date = datetime.strptime(date_str, "%Y/%m/%d")
-        date_str2 = date.strftime("%d-%b-%Y")
-        date_str3 = date.strftime("%Y-%m-%d")
+    for status,_ in summary.values():
+        result[status] = result.get(status, 0) + 1
+
+    if pack_waveforms:
+        WaveformContainer(os.path.join(event_dir, "waveforms")).pack()
+
+    # get pickle file name
+    pkl_filename = os.path.join(base_dir, pkl_data_dir, f"{event_id2}{out_extensions[out_format]}")
+
+    # convert to obspy stream (skipped if already done with the same data)
+    mseed2obspy_stream(event, pkl_filename, manifest_file=manifest_filename, event_dir=event_dir, station_cache_dir=event_station_cache_dir, out_format=out_format, read_workers=read_workers, event_id=event_id2,
+        trace_index_file=os.path.join(event_dir, event_index_filename) if trace_index_file else None,
+        stage_cache_dir=os.path.join(base_dir, stage_cache_dir) if stage_cache_dir else None, cut=phase_cut)
+
+    if not os.path.exists(pkl_filename):
+        result.update(status = "failed", message = "no obspy stream")
+
+    # report what is missing
+    DownloadManifest(os.path.join(event_dir, manifest_filename)).report()
+
+    return result
+
+
+def queue_worker(lines, base_dir, queue_dir, max_workers=max_workers, engine=engine, base_url=fdsn_base_url, retry_failed=False, read_workers=read_workers):
+    """Process the events of the list claimed in the shared work queue, until
+    none is left. Several workers (processes or nodes) can run concurrently."""
+
+    events = {get_event_ids(line)[1] : line for line in lines}
+
+    def process_job(event_id2):
+        print(f"{event_id2} : claimed by {queue.worker_id}")
+        result = process_event(events[event_id2], base_dir, max_workers, engine, True, base_url, read_workers)
+        print(f"{event_id2} : {result['status']} {result['message']}")
+        return result
+
+    queue = WorkQueue(os.path.join(base_dir, queue_dir))
+
+    return queue.run(list(events), process_job, retry_failed)
+
+
+def merge_trace_indexes(lines, base_dir):
+    """Merge the trace indexes of the events into the campaign index, return
+    the number of traces merged."""
+
+    index = TraceIndex(os.path.join(base_dir, trace_index_file))
+    n = 0
+    for line in lines:
+        event_index_file = os.path.join(base_dir, mseed_data_dir, get_event_ids(line)[1], event_index_filename)
+        if os.path.exists(event_index_file):
+            n += index.merge(event_index_file)
+    index.close()
+    return n
+
+
+def print_campaign_summary(results):
+    """Print the aggregated summary of all the events."""
+
+    print(f"{'event':<16} {'status':<8} {'ok':>5} {'skipped':>8} {'no data':>8} {'failed':>7}")
+    for result in results:
+        print(f"{result['event']:<16} {result['status']:<8} {result['ok']:>5} {result.get('skipped', 0):>8} {result['no data']:>8} {result['failed']:>7} {result['message']}")
+
+    n_failed = sum(result["status"] != "ok" for result in results)
+    print(f"{len(results)} events, {n_failed} failed, {sum(result['ok'] for result in results)} stations downloaded.")
+
+
+if __name__ == "__main__":
+
+    # command line argument parser
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i",dest='in_file', type=str, default=in_file, help='events list (date magnitude)')
+
+    parser.add_argument("-j","--jobs",dest='jobs', type=int, default=jobs, help='number of events processed in parallel')
+
+    parser.add_argument("-w",dest='max_workers', type=int, default=max_workers, help='number of stations downloaded concurrently for each event')
+
+    parser.add_argument("--engine", type=str, default=engine, choices=engines, help='download engine')
+
+    parser.add_argument("--base-url", dest='base_url', type=str, default=fdsn_base_url, help='FDSN server')
+
+    parser.add_argument("--queue", dest='queue', action='store_true', help=f'queue mode : claim the events in the work queue shared by the nodes ({queue_dir} directory)')
+
+    parser.add_argument("--retry-failed", dest='retry_failed', action='store_true', help='queue mode : process again the events which failed')
+
+    parser.add_argument("--merge-index", dest='merge_index', action='store_true', help=f'only merge the trace indexes of the events into {trace_index_file} (queue mode, once all the nodes are done)')
+
+    args = parser.parse_args()
+
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+
+    os.makedirs(os.path.join(cur_dir, pkl_data_dir), exist_ok=True)
+    
+    with open(os.path.join(cur_dir, args.in_file), "r") as f:
+        date_mag = f.readlines()
 
-        event_id = f"{mag:.1f}_{date_str2}"
-        event_id2 = f"{date_str3}_{mag}"
+    lines = [line for line in date_mag[1:] if line.strip()]
 
-        print(f"Downloading data for event {event_id2}")
+    if args.merge_index:
+        print(f"{merge_trace_indexes(lines, cur_dir)} traces merged into {trace_index_file}")
+        sys.exit()
 
-        event_filename = os.path.join(events_dir, f"{event_id}.cmtsolution")
+    results = []
 
-        stations_filename = os.path.join(stations_dir, f"{event_id}_receivers.dat")
+    # cores shared by the events processed in parallel
+    event_read_workers = max(1, read_workers // args.jobs)
 
-        # load metadata
+    if args.queue:
 
-        try:
-            # read event information
-            events = read_events(event_filename)
-            event = events[0]
+        print(f"Processing events from the work queue {queue_dir} with {args.jobs} processes (logs in {mseed_data_dir}/<event>/{event_log_filename})")
 
-        except FileNotFoundError:
-            print(f"Error, unable to open event file for event {event_id2}")
-            continue
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(queue_worker, lines, cur_dir, queue_dir, args.max_workers, args.engine, args.base_url, args.retry_failed, event_read_workers) for _ in range(args.jobs)]
+            for future in as_completed(futures):
+                results += future.result()
 
-        try:
-            # read station information
-            stations = MyInventory()
-            stations.read_fromDat(stations_filename)
+        print_campaign_summary(results)
 
-        except FileNotFoundError:
-            print(f"Error, unable to open station file for event {event_id2}")
-            continue
+        # events processed by all the nodes
+        WorkQueue(os.path.join(cur_dir, queue_dir)).report([get_event_ids(line)[1] for line in lines])
 
-        # change dir
-        os.chdir(mseed_data_dir)
-        if not(os.path.exists(event_id2)):
-            os.mkdir(event_id2)
-        os.chdir(event_id2)
+        if trace_index_file:
+            print("Once all the nodes are done, merge the trace indexes of the events with : python download_all_events.py --merge-index")
 
-        # dowload data
-        download_waveform_data(event, stations)
+        sys.exit()
 
-        # get pickle file name
-        pkl_filename = os.path.join(cur_dir, pkl_data_dir+f"/{event_id2}.pkl")
+    if args.jobs == 1:
 
-        # convert to obspy stream 
-        mseed2obspy_stream(event, pkl_filename)
+        for line in lines:
+            results.append(process_event(line, cur_dir, args.max_workers, args.engine, base_url=args.base_url, read_workers=event_read_workers))
 
+    else:
 
+        print(f"Processing {len(lines)} events with {args.jobs} processes (logs in {mseed_data_dir}/<event>/{event_log_filename})")
 
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
 
+            futures = {executor.submit(process_event, line, cur_dir, args.max_workers, args.engine, True, args.base_url, event_read_workers) : line for line in lines}
 
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"event" : get_event_ids(futures[future])[1], "status" : "failed", "ok" : 0, "skipped" : 0, "no data" : 0, "failed" : 0, "message" : repr(e)}
+                print(f"{result['event']} : {result['status']} {result['message']}")
+                results.append(result)
 
+    print_campaign_summary(results)
 
+    if trace_index_file:
+        print(f"{merge_trace_indexes(lines, cur_dir)} traces merged into {trace_index_file}")
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Per-event download manifest (json file in the event directory) recording for
+each station its download status, channels, byte count, checksum and date,
+and the status of the conversion to an obspy stream.
+
+It lets a rerun of download_waveform_data / mseed2obspy_stream skip what is
+already done and only retry the failed stations.
+
+Usage : python download_manifest.py mseed_data/*/manifest.json
+    prints what is missing for each event
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from datetime import datetime
+
+from waveform_container import WaveformContainer
+
+
+#-------------------------
+# configuration
+
+manifest_filename = "manifest.json"
+
+# station status considered as final (not downloaded again on rerun)
+done_status = ("ok", "no data")
+
+#-------------------------
+
+
+def files_checksum(filenames):
+    """md5 checksum of the content of a list of files."""
+    md5 = hashlib.md5()
+    for filename in sorted(filenames):
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                md5.update(block)
+    return md5.hexdigest()
+
+
+class DownloadManifest:
+
+    def __init__(self, filename = manifest_filename):
+        self.filename = filename
+        self.stations = {}
+        self.conversions = {}
+        self._packed = {}
+        if os.path.exists(filename):
+            self.read()
+
+    def read(self):
+        with open(self.filename, "r") as f:
+            content = json.load(f)
+        self.stations = content.get("stations", {})
+        self.conversions = content.get("conversions", {})
+
+    def write(self):
+        """Atomic write (the manifest stays valid if the job is killed)."""
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump({"stations" : self.stations, "conversions" : self.conversions}, f, indent=1)
+        os.replace(tmp_filename, self.filename)
+
+    # stations
+
+    def record_station(self, station_id, status, msg = "", wf_dir = "waveforms", files = None):
+        """Record the download of a station, with the list of its waveform
+        files (names in wf_dir, listed from wf_dir if not given)."""
+
+        prefix = f"{station_id}."
+        if files is None:
+            files = [f for f in os.listdir(wf_dir) if f.startswith(prefix)] if os.path.isdir(wf_dir) else []
+        files = sorted(files)
+        paths = [os.path.join(wf_dir, f) for f in files]
+
+        attempts = self.stations.get(station_id, {}).get("attempts", 0) + 1
+
+        self.stations[station_id] = {
+            "status"    : status,
+            "message"   : msg,
+            "channels"  : [f.split("__")[0][len(prefix):] for f in files],
+            "files"     : files,
+            "bytes"     : sum(os.path.getsize(p) for p in paths),
+            "checksum"  : files_checksum(paths) if paths else None,
+            "timestamp" : datetime.now().isoformat(timespec="seconds"),
+            "attempts"  : attempts,
+        }
+
+    def is_done(self, station_id, wf_dir = "waveforms"):
+        """True if the station was downloaded (and its files are still here,
+        or packed in the waveform container) or has no data."""
+        if station_id not in self.stations:
+            return False
+        record = self.stations[station_id]
+        if record["status"] not in done_status:
+            return False
+        if wf_dir not in self._packed:
+            self._packed[wf_dir] = WaveformContainer(wf_dir).index
+        packed = self._packed[wf_dir]
+        return all(f in packed or os.path.exists(os.path.join(wf_dir, f)) for f in record["files"])
+
+    def missing(self):
+        """Stations whose download failed."""
+        return sorted(station_id for station_id,record in self.stations.items() if record["status"] not in done_status)
+
+    def stations_fingerprint(self):
+        """Checksum of the downloaded data, to know if a conversion is outdated."""
+        md5 = hashlib.md5()
+        for station_id,record in sorted(self.stations.items()):
+            if record["status"] == "ok":
+                md5.update(f"{station_id} {record['checksum']}\n".encode())
+        return md5.hexdigest()
+
+    # conversion into obspy stream
+
+    def record_conversion(self, out_file, status = "ok", parameters = None):
+        """Record the conversion of out_file, with the hash of the parameters
+        of the processing (see mseed2obspy_stream.conversion_parameters)."""
+        out_file = os.path.abspath(out_file)
+        self.conversions[out_file] = {
+            "status"    : status,
+            "bytes"     : os.path.getsize(out_file) if os.path.exists(out_file) else 0,
+            "stations"  : self.stations_fingerprint(),
+            "parameters": parameters,
+            "timestamp" : datetime.now().isoformat(timespec="seconds"),
+        }
+
+    def conversion_done(self, out_file, parameters = None):
+        """True if out_file exists and was produced from the current data,
+        with the same processing parameters (hash)."""
+        record = self.conversions.get(os.path.abspath(out_file))
+        if record is None or record["status"] != "ok" or not os.path.exists(out_file):
+            return False
+        return record["stations"] == self.stations_fingerprint() and record.get("parameters") == parameters
+
+    # report
+
+    def report(self):
+
+        status_count = {}
+        for record in self.stations.values():
+            status_count[record["status"]] = status_count.get(record["status"], 0) + 1
+        n_bytes = sum(record["bytes"] for record in self.stations.values())
+
+        print(f"{self.filename} : {len(self.stations)} stations (" + ", ".join(f"{n} {status}" for status,n in sorted(status_count.items())) + f"), {n_bytes/1e6:.1f} MB")
+
+        for station_id in self.missing():
+            record = self.stations[station_id]
+            print(f"  missing {station_id:<8} ({record['attempts']} attempts) {record['message']}")
+
+        for out_file,record in self.conversions.items():
+            up_to_date = "" if self.conversion_done(out_file, record.get("parameters")) else " (outdated)"
+            print(f"  conversion {out_file} : {record['status']}{up_to_date}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("manifest_files", type=str, nargs="+", help='manifest files')
+
+    args = parser.parse_args()
+
+    for manifest_file in args.manifest_files:
+        DownloadManifest(manifest_file).report()
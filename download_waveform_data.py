@@ -21,16 +21,23 @@ import sys
 
 import argparse 
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 from obspy.core.event import read_events
 from obspy.clients.fdsn import mass_downloader
 from obspy.clients.fdsn import Client
 from obspy.clients.fdsn.mass_downloader.domain import GlobalDomain
+from obspy.clients.fdsn.mass_downloader.download_helpers import STATUS
 from obspy.clients.fdsn.header import FDSNException
 
 
 from station_inventory import MyInventory
+from bulk_download import bulk_download_waveform_data, fdsn_base_url
+from download_manifest import DownloadManifest, manifest_filename
+from stationxml_cache import StationXMLCache
+from phase_windows import station_windows
 
 # custom modules
 sys.path.append('/home/sbrisson/documents/Geosciences/stage-BSL/tools/bsl_toolbox')
@@ -53,76 +60,372 @@ def initiate_client(client = "IRIS"):
 tmin_after_event = 500.
 tmax_after_event = 2500.
 
+# per-station windows around the predicted S/Sdiff arrival instead of the
+# fixed time bounds (see phase_windows.py)
+phase_cut = False
+
+# number of stations downloaded concurrently
+max_workers_default = 1
+
+# download engine :
+# - "mdl" : MassDownloader, station by station
+# - "bulk" : FDSN bulk requests over all stations (see bulk_download.py)
+engine_default = "mdl"
+engines = ("mdl", "bulk")
+
+# retries of the failed stations (waiting backoff*2**n seconds before the n-th retry)
+max_retries = 2
+backoff = 5.
+
+# log files (one per download worker)
+log_dir = "logs"
+log_file_base = "mass_downloader"
+
 #-------------------------
 
+worker_prefix = "mdl_worker"
 
-def download_waveform_data(event,stations):
-    """
-    event : obspy event file
-    stations : custom station inventory class instance
+
+class PerWorkerFileHandler(logging.Handler):
+    """Logging handler writing the records of each download worker thread in
+    its own file (logs/mass_downloader.<worker>.log).
+    
+    Records emitted outside of a worker thread (e.g. by the thread pools the
+    MassDownloader launches internally) go to logs/mass_downloader.main.log.
     """
 
-    origin_time = event.preferred_origin().time
+    def __init__(self, log_dir=log_dir, base_name=log_file_base):
+        super().__init__()
+        self.log_dir = log_dir
+        self.base_name = base_name
+        self.formatter = logging.Formatter("[%(asctime)s] %(threadName)s - %(message)s")
+        self._handlers = {}
+        os.makedirs(log_dir, exist_ok=True)
 
-    # Location priorities:
-    location_priorities = ("","00", "10", "01", "02")
+    def _get_handler(self, thread_name):
+        if not thread_name.startswith(worker_prefix):
+            thread_name = "main"
+        if thread_name not in self._handlers:
+            handler = logging.FileHandler(os.path.join(self.log_dir, f"{self.base_name}.{thread_name}.log"))
+            handler.setFormatter(self.formatter)
+            self._handlers[thread_name] = handler
+        return self._handlers[thread_name]
 
-    # Channel priorities
-    channel_priorities = ("BH[ZNE12]", "LH[ZNE12]")
+    def emit(self, record):
+        self._get_handler(record.threadName).emit(record)
 
-    # Mass downloader over IRIS
-    # mdl = mass_downloader.MassDownloader( providers= ["IRIS"], configure_logging=False )
-    mdl = mass_downloader.MassDownloader( providers= ["IRIS"])
+    def close(self):
+        for handler in self._handlers.values():
+            handler.close()
+        super().close()
 
-    # Data directories
-    stations_dir = "stations"
-    wf_dir = "waveforms"
 
-    print(f"Saving station metadata in directory {stations_dir} and waveforms in {wf_dir}")
+def configure_mdl_logging(log_dir=log_dir):
+    """Log the MassDownloader to one file per worker and not in stdout."""
+
+    logger = logging.getLogger("obspy.clients.fdsn.mass_downloader")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = 0
+
+    # remove previous handlers (console or previous event)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+
+    handler = PerWorkerFileHandler(log_dir)
+    logger.addHandler(handler)
+
+    return handler
+
+
+def station_waveform_files(wf_dir):
+    """Waveform files of each station (NET.STA -> list of file names) of a
+    directory, listed once."""
+    files = {}
+    if os.path.isdir(wf_dir):
+        for f in os.listdir(wf_dir):
+            files.setdefault(".".join(f.split(".")[:2]), []).append(f)
+    return files
+
+
+def mdl_waveform_files(helpers):
+    """Waveform files (names) of a download of the MassDownloader (from its
+    download helpers), and whether some were downloaded (not already there)."""
+    files, downloaded = [], False
+    for helper in helpers.values():
+        for station in helper.stations.values():
+            for channel in station.channels:
+                for interval in channel.intervals:
+                    if interval.filename and interval.status in (STATUS.DOWNLOADED, STATUS.EXISTS):
+                        files.append(os.path.basename(interval.filename))
+                        downloaded = downloaded or interval.status == STATUS.DOWNLOADED
+    return sorted(files), downloaded
+
+
+def print_download_summary(summary):
+    """Print the per-station download status."""
+
+    status_count = {}
+    for status,_ in summary.values():
+        status_count[status] = status_count.get(status, 0) + 1
+
+    print("Download summary : " + ", ".join(f"{n} {status}" for status,n in sorted(status_count.items())))
+
+    for station_id,(status,msg) in sorted(summary.items()):
+        if status not in ("ok", "skipped"):
+            print(f"  {station_id:<8} {status:<8} {msg}")
+
+
+def mdl_download_waveform_data(
+        station_codes, starttime, endtime, location_priorities, channel_priorities, 
+        stations_dir = "stations", wf_dir = "waveforms", max_workers = max_workers_default, on_result = None,
+        log_dir = log_dir, provider = "IRIS", windows = None):
+    """
+    Download the data with the MassDownloader, station by station.
+
+    station_codes : list of (network, station) codes
+    starttime, endtime : time window (UTCDateTime)
+    windows : per-station time windows, dictionnary (network, station) ->
+        (starttime, endtime) replacing the common window (see phase_windows.py)
+    provider : FDSN provider name or url
+    on_result : function (station_id, status, message, files) called as soon
+        as a station is done (files : names of its waveform files, None if
+        unknown)
+
+    Returns a dictionnary station id -> (status, message).
+    """
 
     # Global domain (stations filtered to be inside directionnal domain)
     global_domain = GlobalDomain()
 
-    # log to a file and not in stdout
-    logger = logging.getLogger("obspy.clients.fdsn.mass_downloader")
-
-    # remove console handler
-    logger.removeHandler(logger.handlers[0])
+    # log to files (one per worker) and not in stdout
+    handler = configure_mdl_logging(log_dir)
 
-    handler = logging.FileHandler('mass_downloader.log')
-    logger.addHandler(handler) 
+    # Mass downloader over IRIS, one per worker thread
+    local = threading.local()
 
-    # DOWNLOAD DATA
+    def get_mdl():
+        if not hasattr(local, "mdl"):
+            local.mdl = mass_downloader.MassDownloader( providers= [provider], configure_logging=False )
+        return local.mdl
 
     # This loop might seem quite inefficient to you and it is. However, 
     # the MassDownloader does not always download all the data requested if the
     # list of stations is too large. Then, the user should re-run the MassDownloader
-    # a couple of times. As an alternative, we here run it for each station.
+    # a couple of times. As an alternative, we here run it for each station,
+    # several stations being downloaded concurrently.
 
-    for nw_code,st_code in tqdm(zip(stations.stations["nw"],stations.stations["code"]), total=stations.len(),unit="station"):
-        
-        # print(f"Downloading data for station {nw_code:<2}.{st_code:<4} ({i/stations_in.len()*100:.0f}%).", end="\r")
+    windows = windows or {}
+
+    def download_station(nw_code, st_code):
+
+        station_starttime, station_endtime = windows.get((nw_code, st_code), (starttime, endtime))
 
         # set Restrictions
         restrictions = mass_downloader.Restrictions( 
-            starttime   = origin_time +tmin_after_event,
-            endtime     = origin_time +tmax_after_event,
+            starttime   = station_starttime,
+            endtime     = station_endtime,
             location_priorities = location_priorities,
             channel_priorities = channel_priorities,
             reject_channels_with_gaps = True,
             minimum_interstation_distance_in_m=1E2,
             network = nw_code, station = st_code 
             )
-        # Start download
-        mdl.download(
+        # Start download (the files of the station given by the download
+        # helpers, without listing the directory)
+        helpers = get_mdl().download(
             global_domain, 
             restrictions, 
             mseed_storage = wf_dir, 
             stationxml_storage = stations_dir,
             print_report=False )
 
+        files, downloaded = mdl_waveform_files(helpers)
+        if files and not downloaded:
+            return ("skipped", "already downloaded"), files
+        if files:
+            return ("ok", f"{len(files)} files"), files
+        return ("no data", ""), files
+
+    summary = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=worker_prefix) as executor:
+
+        futures = {
+            executor.submit(download_station, nw_code, st_code) : f"{nw_code}.{st_code}" 
+            for nw_code,st_code in station_codes
+            }
+
+        for future in tqdm(as_completed(futures), total=len(futures), unit="station"):
+            station_id = futures[future]
+            files = None
+            try:
+                summary[station_id], files = future.result()
+            except Exception as e:
+                summary[station_id] = ("failed", repr(e))
+            if on_result:
+                on_result(station_id, *summary[station_id], files)
+
+    logging.getLogger("obspy.clients.fdsn.mass_downloader").removeHandler(handler)
+    handler.close()
+
+    return summary
+
+
+def download_waveform_data(
+        event, stations, max_workers=max_workers_default, engine=engine_default, base_url=fdsn_base_url, 
+        manifest_file=manifest_filename, max_retries=max_retries, backoff=backoff, event_dir=".",
+        station_cache_dir=None, phase_cut=phase_cut):
+    """
+    event : obspy event file
+    stations : custom station inventory class instance
+    event_dir : event data directory, where the stations/, waveforms/ and logs/
+        directories and the manifest are written
+    max_workers : number of stations (or bulk requests) downloaded concurrently
+    engine : "mdl" (MassDownloader) or "bulk" (FDSN bulk requests)
+    base_url : FDSN server
+    manifest_file : download manifest, stations already downloaded are skipped
+        (None to download everything)
+    max_retries, backoff : the failed stations are downloaded again up to
+        max_retries times, waiting backoff*2**n seconds before the n-th retry
+    station_cache_dir : StationXML cache shared between events, station
+        metadata found in it is not downloaded again
+    phase_cut : download for each station only the window around its
+        predicted S/Sdiff arrival (see phase_windows.py), the stations without
+        arrival being skipped
+
+    Returns a dictionnary station id -> (status, message), status being
+    "ok", "skipped" (already downloaded), "no data" or "failed".
+    """
+
+    if engine not in engines:
+        raise ValueError(f"Unknown download engine {engine}, should be one of {engines}")
+
+    origin_time = event.preferred_origin().time
+
+    # Location priorities:
+    location_priorities = ("","00", "10", "01", "02")
+
+    # Channel priorities
+    channel_priorities = ("BH[ZNE12]", "LH[ZNE12]")
+
+    # Data directories
+    stations_dir = os.path.join(event_dir, "stations")
+    wf_dir = os.path.join(event_dir, "waveforms")
+
+    print(f"Saving station metadata in directory {stations_dir} and waveforms in {wf_dir}")
+
+    # (stations duplicated in the list would be downloaded concurrently in the same files)
+    station_codes = list(dict.fromkeys(zip(stations.stations["nw"],stations.stations["code"])))
+
+    summary = {}
+
+    # skipping stations already downloaded
+    manifest = None
+    if manifest_file:
+        manifest_file = os.path.join(event_dir, manifest_file)
+        manifest = DownloadManifest(manifest_file)
+        pending = []
+        for nw_code,st_code in station_codes:
+            station_id = f"{nw_code}.{st_code}"
+            if manifest.is_done(station_id, wf_dir):
+                summary[station_id] = ("skipped", f"already downloaded ({manifest.stations[station_id]['status']})")
+            else:
+                pending.append((nw_code,st_code))
+        if summary:
+            print(f"{len(summary)} stations already downloaded (from {manifest_file}), skipping them.")
+        station_codes = pending
+
+    starttime = origin_time +tmin_after_event
+    endtime = origin_time +tmax_after_event
+
+    # per-station windows around the phase arrival
+    windows = None
+    if phase_cut:
+        windows = station_windows(stations, event.preferred_origin())
+        no_arrival = [(nw_code,st_code) for nw_code,st_code in station_codes if (nw_code,st_code) not in windows]
+        for nw_code,st_code in no_arrival:
+            summary[f"{nw_code}.{st_code}"] = ("no data", "no phase arrival")
+        station_codes = [code for code in station_codes if code in windows]
+        if windows:
+            starttime = min(start for start,_ in windows.values())
+            endtime = max(end for _,end in windows.values())
+        print(f"Per-station windows around the phase arrival ({len(no_arrival)} stations without arrival)")
+
+    # station metadata from the cache (not downloaded again)
+    station_cache = None
+    if station_cache_dir:
+        station_cache = StationXMLCache(station_cache_dir)
+        found = station_cache.fill(station_codes, stations_dir, starttime, endtime, wf_dir)
+        print(f"{len(found)} station metadata files from the cache {station_cache_dir}")
+
+    def record_station(station_id, status, msg, files = None):
+        if manifest:
+            # (the files of a skipped station are recorded as downloaded)
+            manifest.record_station(station_id, "ok" if status == "skipped" else status, msg, wf_dir, files)
+            manifest.write()
+
+    # DOWNLOAD DATA
+
+    for attempt in range(max_retries+1):
+
+        if not station_codes:
+            break
+
+        if attempt > 0:
+            wait = backoff * 2**(attempt-1)
+            print(f"Retrying {len(station_codes)} failed stations in {wait:.0f}s (attempt {attempt+1})")
+            sleep(wait)
+
+        if engine == "bulk":
+            attempt_summary = bulk_download_waveform_data(
+                station_codes,
+                starttime   = starttime,
+                endtime     = endtime,
+                location_priorities = location_priorities,
+                channel_priorities = channel_priorities,
+                stations_dir = stations_dir,
+                wf_dir = wf_dir,
+                reject_channels_with_gaps = True,
+                base_url = base_url,
+                max_workers = max_workers,
+                windows = windows
+                )
+            # (directory listed once for all the stations)
+            wf_files = station_waveform_files(wf_dir)
+            for station_id,(status,msg) in attempt_summary.items():
+                record_station(station_id, status, msg, wf_files.get(station_id, []))
+        else:
+            attempt_summary = mdl_download_waveform_data(
+                station_codes,
+                starttime   = starttime,
+                endtime     = endtime,
+                location_priorities = location_priorities,
+                channel_priorities = channel_priorities,
+                stations_dir = stations_dir,
+                wf_dir = wf_dir,
+                max_workers = max_workers,
+                on_result = record_station,
+                log_dir = os.path.join(event_dir, log_dir),
+                provider = "IRIS" if base_url == fdsn_base_url else base_url,
+                windows = windows
+                )
+
+        summary.update(attempt_summary)
+
+        # new station metadata into the cache
+        if station_cache:
+            xml_files = [(nw_code, st_code, os.path.join(stations_dir, f"{nw_code}.{st_code}.xml")) for nw_code,st_code in station_codes]
+            station_cache.store_many([(nw_code, st_code, f) for nw_code,st_code,f in xml_files if os.path.exists(f)])
+
+        station_codes = [(nw_code,st_code) for nw_code,st_code in station_codes if summary[f"{nw_code}.{st_code}"][0] == "failed"]
+
+    print_download_summary(summary)
+
     print("Done.")
 
+    return summary
+
 
 if __name__ == "__main__":
     
@@ -134,6 +437,20 @@ if __name__ == "__main__":
 
     parser.add_argument("-r",dest='receivers_file', type=str, help='receivers.dat file')
 
+    parser.add_argument("-j",dest='max_workers', type=int, default=max_workers_default, help='number of stations downloaded concurrently')
+
+    parser.add_argument("--engine", type=str, default=engine_default, choices=engines, help='download engine')
+
+    parser.add_argument("--base-url", dest='base_url', type=str, default=fdsn_base_url, help='FDSN server')
+
+    parser.add_argument("-d",dest='event_dir', type=str, default=".", help='event data directory')
+
+    parser.add_argument("--station-cache", dest='station_cache_dir', type=str, default=None, help='StationXML cache directory shared between events')
+
+    parser.add_argument("--cut", dest='phase_cut', action='store_true', help='download only the window around the predicted S/Sdiff arrival of each station')
+
+    parser.add_argument("--no-manifest", dest='manifest_file', action='store_const', const=None, default=manifest_filename, help='do not skip the stations already downloaded')
+
     args = parser.parse_args()
     
 
@@ -147,7 +464,7 @@ if __name__ == "__main__":
 
     # downlaod data
 
-    download_waveform_data(event, stations)
+    download_waveform_data(event, stations, max_workers=args.max_workers, engine=args.engine, base_url=args.base_url, manifest_file=args.manifest_file, event_dir=args.event_dir, station_cache_dir=args.station_cache_dir, phase_cut=args.phase_cut or phase_cut)
 
     
         
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Local FDSN web services stand-in, serving the StationXML and MiniSEED files
+of a downloaded event (stations/ and waveforms/ directories), to test and
+benchmark the download engines without requesting IRIS.
+
+Services (GET and bulk POST) :
+    - /fdsnws/station/1/query : xml or text format, network to response level
+    - /fdsnws/dataselect/1/query
+    - /fdsnws/availability/1/query and /fdsnws/availability/1/extent (text format)
+    - /stats : number of requests and bytes served (json)
+
+Latency, error rate and bandwidth can be set to mimic a real data center.
+
+Usage : python fdsn_standin_server.py -d test_python_script --port 8080 --latency 0.2
+    then use http://localhost:8080 as FDSN base url
+"""
+
+import io
+import os
+import copy
+import json
+import time
+import random
+import fnmatch
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import obspy
+from obspy import UTCDateTime, Stream, Inventory
+
+
+#-------------------------
+# configuration
+
+port = 8080
+
+# added delay before each response (seconds)
+latency = 0.
+
+# fraction of the requests answered with a 503 error
+error_rate = 0.
+
+# bandwidth of each connection (bytes/second, 0 for unlimited)
+bandwidth = 0.
+
+#-------------------------
+
+
+# parameters listed in the WADL files (used by the obspy client to discover the services)
+wadl_parameters = {
+    "station" : ["starttime", "endtime", "network", "station", "location", "channel",
+        "minlatitude", "maxlatitude", "minlongitude", "maxlongitude", "latitude", "longitude",
+        "minradius", "maxradius", "level", "format", "matchtimeseries", "includeavailability", "nodata"],
+    "dataselect" : ["starttime", "endtime", "network", "station", "location", "channel", "quality", "nodata"],
+}
+
+wadl_template = """<?xml version="1.0" encoding="UTF-8"?>
+<application xmlns="http://wadl.dev.java.net/2009/02" xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <resources base="http://{host}/fdsnws/{service}/1/">
+    <resource path="query">
+      <method id="query" name="GET">
+        <request>
+{params}
+        </request>
+      </method>
+    </resource>
+  </resources>
+</application>
+"""
+
+station_text_header = {
+    "network" : "#Network|Description|StartTime|EndTime|TotalStations",
+    "station" : "#Network|Station|Latitude|Longitude|Elevation|SiteName|StartTime|EndTime",
+    "channel" : "#Network|Station|Location|Channel|Latitude|Longitude|Elevation|Depth|Azimuth|Dip|SensorDescription|Scale|ScaleFreq|ScaleUnits|SampleRate|StartTime|EndTime",
+}
+
+short_names = {"net" : "network", "sta" : "station", "loc" : "location", "cha" : "channel", "start" : "starttime", "end" : "endtime"}
+
+
+class Selection:
+    """One selection line (network station location channel starttime endtime)."""
+
+    def __init__(self, network="*", station="*", location="*", channel="*", starttime=None, endtime=None):
+        self.patterns = [[p if p != "--" else "" for p in value.split(",")] for value in (network, station, location, channel)]
+        self.starttime = UTCDateTime(starttime) if starttime and starttime != "*" else None
+        self.endtime = UTCDateTime(endtime) if endtime and endtime != "*" else None
+
+    def match(self, *codes):
+        return all(any(fnmatch.fnmatch(code, p) for p in patterns) for code,patterns in zip(codes, self.patterns))
+
+    def overlaps(self, start, end):
+        return (self.endtime is None or start is None or start <= self.endtime) and \
+            (self.starttime is None or end is None or end >= self.starttime)
+
+
+def parse_request(handler):
+    """Return the parameters and the list of selections of a GET or POST request."""
+
+    url = urlparse(handler.path)
+
+    if handler.command == "POST":
+        body = handler.rfile.read(int(handler.headers.get("Content-Length", 0))).decode()
+        params, selections = {}, []
+        for line in body.splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                params[key.strip()] = value.strip()
+            elif line.strip():
+                selections.append(Selection(*line.split()))
+        return params, selections
+
+    params = {short_names.get(key, key) : values[0] for key,values in parse_qs(url.query).items()}
+    selection = Selection(*[params.get(key, "*") for key in ("network", "station", "location", "channel")], params.get("starttime"), params.get("endtime"))
+    return params, [selection]
+
+
+class FDSNStandinData:
+    """Station metadata and waveforms served by the stand-in."""
+
+    def __init__(self, data_dir):
+        self.inventory = obspy.read_inventory(os.path.join(data_dir, "stations", "*"))
+        self.stream = Stream()
+        wf_dir = os.path.join(data_dir, "waveforms")
+        for waveform in sorted(os.listdir(wf_dir)):
+            self.stream += obspy.read(os.path.join(wf_dir, waveform))
+        self.trace_ids = set(tr.id for tr in self.stream)
+
+    def select_inventory(self, selections, level="station", matchtimeseries=False):
+
+        networks = []
+        for nw in self.inventory:
+            stations = []
+            for stn in nw:
+                channels = [
+                    cha for cha in stn
+                    if any(sel.match(nw.code, stn.code, cha.location_code, cha.code) and sel.overlaps(cha.start_date, cha.end_date) for sel in selections)
+                    and (not matchtimeseries or f"{nw.code}.{stn.code}.{cha.location_code}.{cha.code}" in self.trace_ids)
+                    ]
+                if not channels:
+                    continue
+                stn = copy.copy(stn)
+                if level == "response":
+                    stn.channels = channels
+                elif level == "channel":
+                    stn.channels = [copy.copy(cha) for cha in channels]
+                    for cha in stn.channels:
+                        cha.response = None
+                else:
+                    stn.channels = []
+                stations.append(stn)
+            if stations:
+                nw = copy.copy(nw)
+                nw.stations = stations if level != "network" else []
+                networks.append(nw)
+
+        return Inventory(networks=networks, source="fdsn_standin_server")
+
+    def station_text(self, inv, level):
+
+        rows = [station_text_header[level]]
+        for nw in inv:
+            if level == "network":
+                rows.append(f"{nw.code}|{nw.description or ''}|{nw.start_date or ''}|{nw.end_date or ''}|{len(nw)}")
+                continue
+            for stn in nw:
+                if level == "station":
+                    rows.append(f"{nw.code}|{stn.code}|{stn.latitude}|{stn.longitude}|{stn.elevation}|{stn.site.name or ''}|{stn.start_date or ''}|{stn.end_date or ''}")
+                    continue
+                for cha in stn:
+                    sensor = cha.sensor.description if cha.sensor else ""
+                    rows.append(
+                        f"{nw.code}|{stn.code}|{cha.location_code}|{cha.code}|{cha.latitude}|{cha.longitude}|{cha.elevation}|{cha.depth}|"
+                        f"{cha.azimuth if cha.azimuth is not None else ''}|{cha.dip if cha.dip is not None else ''}|{sensor or ''}|||M/S|{cha.sample_rate}|"
+                        f"{cha.start_date or ''}|{cha.end_date or ''}")
+
+        return ("\n".join(rows) + "\n").encode()
+
+    def select_waveforms(self, selections):
+        st = Stream()
+        for sel in selections:
+            for tr in self.stream:
+                if sel.match(tr.stats.network, tr.stats.station, tr.stats.location, tr.stats.channel) and sel.overlaps(tr.stats.starttime, tr.stats.endtime):
+                    st += tr.slice(sel.starttime, sel.endtime)
+        return st
+
+    def availability_text(self, selections, extent=False):
+
+        st = self.select_waveforms(selections)
+        segments = {}
+        for tr in st:
+            segments.setdefault(tr.id, []).append((tr.stats.sampling_rate, tr.stats.starttime, tr.stats.endtime))
+
+        rows = ["#Network Station Location Channel Quality SampleRate Earliest Latest"]
+        for trace_id,trace_segments in sorted(segments.items()):
+            if extent:
+                trace_segments = [(trace_segments[0][0], min(s[1] for s in trace_segments), max(s[2] for s in trace_segments))]
+            nw, stn, loc, cha = trace_id.split(".")
+            for sr,start,end in trace_segments:
+                rows.append(f"{nw} {stn} {loc or '--'} {cha} M {sr} {start} {end}")
+
+        return ("\n".join(rows) + "\n").encode() if len(rows) > 1 else b""
+
+
+def make_handler(data, latency=latency, error_rate=error_rate, bandwidth=bandwidth):
+
+    stats = {"requests" : 0, "bytes" : 0}
+    lock = threading.Lock()
+
+    class FDSNStandinHandler(BaseHTTPRequestHandler):
+
+        # keep-alive connections
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, code, content=b"", content_type="text/plain"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            # (throttled : each chunk sent after its transfer time)
+            step = max(1, min(int(bandwidth), 1 << 16)) if bandwidth else len(content) or 1
+            for i in range(0, len(content), step):
+                chunk = content[i:i+step]
+                if bandwidth:
+                    time.sleep(len(chunk) / bandwidth)
+                self.wfile.write(chunk)
+            with lock:
+                stats["bytes"] += len(content)
+
+        def nodata(self, params):
+            self.send(int(params.get("nodata", 204)))
+
+        def handle_request(self):
+
+            path = urlparse(self.path).path.rstrip("/")
+
+            if path == "/stats":
+                with lock:
+                    content = json.dumps(stats).encode()
+                return self.send(200, content, "application/json")
+
+            with lock:
+                stats["requests"] += 1
+
+            if path.endswith("application.wadl"):
+                service = path.split("/")[2]
+                if service not in wadl_parameters:
+                    return self.send(404)
+                params = "\n".join(f'          <param name="{p}" style="query" type="xs:string"/>' for p in wadl_parameters[service])
+                wadl = wadl_template.format(host=self.headers.get("Host", "localhost"), service=service, params=params)
+                return self.send(200, wadl.encode(), "application/xml")
+
+            if path.endswith("/version"):
+                return self.send(200, b"1.1.0")
+
+            # (the POST body read before any answer, not to be left in the
+            # keep-alive connection)
+            params, selections = parse_request(self)
+
+            time.sleep(latency)
+            if random.random() < error_rate:
+                return self.send(503, b"Service temporarily unavailable")
+
+            if path == "/fdsnws/station/1/query":
+                level = params.get("level", "station")
+                matchtimeseries = params.get("matchtimeseries", "false").lower() == "true"
+                inv = data.select_inventory(selections, level, matchtimeseries)
+                if len(inv) == 0:
+                    return self.nodata(params)
+                if params.get("format", "xml") == "text":
+                    return self.send(200, data.station_text(inv, level))
+                buf = io.BytesIO()
+                inv.write(buf, format="STATIONXML")
+                return self.send(200, buf.getvalue(), "application/xml")
+
+            if path == "/fdsnws/dataselect/1/query":
+                st = data.select_waveforms(selections)
+                if not st:
+                    return self.nodata(params)
+                buf = io.BytesIO()
+                st.write(buf, format="MSEED")
+                return self.send(200, buf.getvalue(), "application/vnd.fdsn.mseed")
+
+            if path in ("/fdsnws/availability/1/query", "/fdsnws/availability/1/extent"):
+                content = data.availability_text(selections, extent=path.endswith("extent"))
+                if not content:
+                    return self.nodata(params)
+                return self.send(200, content)
+
+            return self.send(404)
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+    return FDSNStandinHandler
+
+
+def run_server(data_dir, port=port, latency=latency, error_rate=error_rate, bandwidth=bandwidth, host="127.0.0.1"):
+    """Serve the data of data_dir (stations/ and waveforms/ directories) until interrupted."""
+
+    data = FDSNStandinData(data_dir)
+    server = ThreadingHTTPServer((host, port), make_handler(data, latency, error_rate, bandwidth))
+    server.daemon_threads = True
+
+    print(f"Serving {len(data.inventory.get_contents()['stations'])} stations and {len(data.stream)} traces from {data_dir} on http://{host}:{port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d",dest='data_dir', type=str, help='directory with stations/ and waveforms/ directories', required=True)
+
+    parser.add_argument("--port", type=int, default=port, help='port')
+
+    parser.add_argument("--latency", type=float, default=latency, help='added delay before each response (s)')
+
+    parser.add_argument("--error-rate", dest='error_rate', type=float, default=error_rate, help='fraction of requests answered with an error')
+
+    parser.add_argument("--bandwidth", type=float, default=bandwidth, help='bandwidth of each connection (bytes/s, 0 for unlimited)')
+
+    args = parser.parse_args()
+
+    run_server(args.data_dir, args.port, args.latency, args.error_rate, args.bandwidth)
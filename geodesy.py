@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Vectorized epicentral distances, azimuths and back azimuths, for arrays of
+stations and one or many events at once.
+
+The distances are great circle distances in degrees (as obspy
+locations2degrees), the azimuths are computed on the WGS84 ellipsoid (as obspy
+gps2dist_azimuth), with pyproj (a dependency of cartopy).
+
+Usage : python geodesy.py
+    checks the results against obspy on random locations
+"""
+
+import numpy as np
+from pyproj import Geod
+
+from obspy.geodetics import locations2degrees
+
+
+#-------------------------
+# configuration
+
+ellipsoid = "WGS84"
+
+#-------------------------
+
+
+geod = Geod(ellps=ellipsoid)
+
+
+def distance_azimuth(st_lat, st_lon, ev_lat, ev_lon):
+    """Epicentral distances (°), azimuths (event to station, °) and back
+    azimuths (station to event, °) in [0, 360[.
+
+    The arguments are broadcast together : station arrays of shape (n_stations,)
+    and event arrays of shape (n_events, 1) give arrays of shape
+    (n_events, n_stations).
+    """
+
+    st_lat, st_lon, ev_lat, ev_lon = np.broadcast_arrays(
+        np.asarray(st_lat, dtype=float), np.asarray(st_lon, dtype=float),
+        np.asarray(ev_lat, dtype=float), np.asarray(ev_lon, dtype=float))
+
+    dist = locations2degrees(st_lat, st_lon, ev_lat, ev_lon)
+
+    baz, az, _ = geod.inv(st_lon.ravel(), st_lat.ravel(), ev_lon.ravel(), ev_lat.ravel())
+
+    az = np.reshape(az, st_lat.shape) % 360.
+    baz = np.reshape(baz, st_lat.shape) % 360.
+
+    return dist, az, baz
+
+
+def distance_azimuth_table(st_lat, st_lon, ev_lats, ev_lons):
+    """Distances, azimuths and back azimuths of the stations for several events
+    (arrays of shape (n_events, n_stations))."""
+    return distance_azimuth(
+        np.ravel(st_lat)[None,:], np.ravel(st_lon)[None,:],
+        np.ravel(ev_lats)[:,None], np.ravel(ev_lons)[:,None])
+
+
+if __name__ == "__main__":
+
+    from obspy.geodetics import gps2dist_azimuth
+
+    rng = np.random.default_rng(0)
+    n = 1000
+    st_lat, st_lon = rng.uniform(-89, 89, n), rng.uniform(-180, 180, n)
+    ev_lat, ev_lon = -7.29, 122.48
+
+    dist, az, baz = distance_azimuth(st_lat, st_lon, ev_lat, ev_lon)
+
+    ref = np.array([gps2dist_azimuth(la, lo, ev_lat, ev_lon) for la,lo in zip(st_lat, st_lon)])
+    ref_dist = np.array([locations2degrees(la, lo, ev_lat, ev_lon) for la,lo in zip(st_lat, st_lon)])
+
+    def angle_diff(a, b):
+        return np.abs((a - b + 180.) % 360. - 180.)
+
+    print(f"max difference with obspy : distance {np.abs(dist - ref_dist).max():.2e}°, azimuth {angle_diff(az, ref[:,2]).max():.2e}°, back azimuth {angle_diff(baz, ref[:,1]).max():.2e}°")
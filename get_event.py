@@ -24,6 +24,7 @@ from datetime import datetime
 
 
 # obspy imports
+from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
 from obspy.clients.fdsn.header import FDSNNoDataException
 
@@ -33,6 +34,9 @@ sys.path.append('/home/sbrisson/documents/Geosciences/stage-BSL/tools/bsl_toolbo
 # global cmt request
 from data_acquisition.globalcmt_request import GlobalCMT_search
 
+# local catalog store
+from catalog_cache import CatalogCache, catalog_cache_file
+
 
 
 #-------------------------
@@ -48,55 +52,98 @@ Mw_max = 7.0
 #-------------------------
 
 
-def get_events_usgs(date, Mw_min, Mw_max):
+def fetch_usgs_events(starttime, endtime, Mw_min):
+    """All the events of the USGS catalog in a time range (obspy catalog)."""
+    
+    client_cmt = Client("USGS")
+    
+    try:
+        return client_cmt.get_events(
+            starttime   = starttime,
+            endtime     = endtime, 
+            minmagnitude= Mw_min,
+            includeallorigins=True
+            )
+    except FDSNNoDataException:
+        return []
+
+
+def fetch_gcmt_events(starttime, endtime, Mw_min):
+    """All the events of the Global CMT catalog in a time range (list of
+    obspy events), the search being done day by day."""
+    
+    nb_sec = 24*60*60
+    
+    events = []
+    day = UTCDateTime(starttime.date)
+    while day < endtime:
+        gcmt = GlobalCMT_search(
+            date = day.datetime,
+            Mw_min = Mw_min,
+        )     
+        events += list(gcmt.get_cmt_solution())
+        day += nb_sec
+    return events
+
+
+def get_events_usgs(date, Mw_min, Mw_max, catalog_cache = catalog_cache_file):
     """Return all the events matching the conditions in the USGS catalog.
 
     Args:
         date (string): date of event, YYYY/MM/DD
         Mw_min (float)
         Mw_max (float)
+        catalog_cache (string): local catalog store (only the days never requested
+            are requested to the USGS), None to always request the USGS
     """
     
-    client_cmt = Client("USGS")
-
     nb_sec = 24*60*60
+    starttime = UTCDateTime(datetime.strptime(date, '%Y/%m/%d'))
     
-    try:
-        events_usgs = client_cmt.get_events(
-            starttime   = date,
-            endtime     = date + nb_sec, 
-            minmagnitude= Mw_min,
-            maxmagnitude= Mw_max,
-            includeallorigins=True
-            )
+    if catalog_cache:
+        cache = CatalogCache(catalog_cache)
+        events_usgs = cache.get_events("usgs", starttime, starttime + nb_sec, Mw_min, Mw_max, fetch=fetch_usgs_events)
+        cache.close()
+    else:
+        events_usgs = [e for e in fetch_usgs_events(starttime, starttime + nb_sec, Mw_min) if (e.preferred_magnitude() or e.magnitudes[0]).mag <= Mw_max]
+    
+    if len(events_usgs) != 0:
         print(">> USGS catalogue")
         print(events_usgs)
-        
-    except FDSNNoDataException:
+    else:
         print(">> No matching event in USGS catalogue")
-        return []
     
+    return events_usgs
     
-def get_events_gcmt(date, Mw_min, Mw_max):
-    """Return all the events matching the conditions in the USGS catalog.
+    
+def get_events_gcmt(date, Mw_min, Mw_max, catalog_cache = catalog_cache_file):
+    """Return all the events matching the conditions in the Global CMT catalog.
 
     Args:
         date (string): date of event, YYYY/MM/DD
         Mw_min (float)
         Mw_max (float)
+        catalog_cache (string): local catalog store (only the days never requested
+            are requested to the Global CMT), None to always request the Global CMT
     """
     
-    gcmt = GlobalCMT_search(
-        date = datetime.strptime(date, '%Y/%m/%d'),
-        Mw_min = 6.2,
-    )     
-    events_gcmt = gcmt.get_cmt_solution()
+    nb_sec = 24*60*60
+    starttime = UTCDateTime(datetime.strptime(date, '%Y/%m/%d'))
+    
+    if catalog_cache:
+        cache = CatalogCache(catalog_cache)
+        events_gcmt = cache.get_events("gcmt", starttime, starttime + nb_sec, Mw_min, Mw_max, fetch=fetch_gcmt_events)
+        cache.close()
+    else:
+        events_gcmt = [e for e in fetch_gcmt_events(starttime, starttime + nb_sec, Mw_min) if (e.preferred_magnitude() or e.magnitudes[0]).mag <= Mw_max]
     
     if len(events_gcmt) != 0:
         print(">> Global CMT catalogue")
         print(events_gcmt)
     else:
-        print(">> No matching event in USGS catalogue")
+        print(">> No matching event in Global CMT catalogue")
+    
+    return events_gcmt
         
 
 if __name__ == "__main__":
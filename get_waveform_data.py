@@ -11,20 +11,11 @@ import matplotlib.pyplot as plt
 import os
 import sys
 
-from datetime import datetime
-
-
-
-
-# obspy imports
-from obspy.clients.fdsn import Client
-from obspy.clients.fdsn.header import FDSNNoDataException
-
 # custom modules
 sys.path.append('/home/sbrisson/documents/Geosciences/stage-BSL/tools/bsl_toolbox')
 
-# global cmt request
-from data_acquisition.globalcmt_request import GlobalCMT_search
+# catalog requests (through the local catalog store)
+from get_event import get_events_usgs, get_events_gcmt
 
 
 
@@ -38,57 +29,8 @@ date = "2011/08/30"
 Mw_min = 6.0
 Mw_max = 7.0
 
+#-------------------------
 
-def get_events_usgs(date, Mw_min, Mw_max):
-    """Return all the events matching the conditions in the USGS catalog.
-
-    Args:
-        date (string): date of event, YYYY/MM/DD
-        Mw_min (float)
-        Mw_max (float)
-    """
-    
-    client_cmt = Client("USGS")
-
-    nb_sec = 24*60*60
-    
-    try:
-        events_usgs = client_cmt.get_events(
-            starttime   = date,
-            endtime     = date + nb_sec, 
-            minmagnitude= Mw_min,
-            maxmagnitude= Mw_max,
-            includeallorigins=True
-            )
-        print(">> USGS catalogue")
-        print(events_usgs)
-        
-    except FDSNNoDataException:
-        print(">> No matching event in USGS catalogue")
-        return []
-    
-    
-def get_events_gcmt(date, Mw_min, Mw_max):
-    """Return all the events matching the conditions in the USGS catalog.
-
-    Args:
-        date (string): date of event, YYYY/MM/DD
-        Mw_min (float)
-        Mw_max (float)
-    """
-    
-    gcmt = GlobalCMT_search(
-        date = datetime.strptime(date, '%Y/%m/%d'),
-        Mw_min = 6.2,
-    )     
-    events_gcmt = gcmt.get_cmt_solution()
-    
-    if len(events_gcmt) != 0:
-        print(">> Global CMT catalogue")
-        print(events_gcmt)
-    else:
-        print(">> No matching event in USGS catalogue")
-        
 
 if __name__ == "__main__":
     
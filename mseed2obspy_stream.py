@@ -15,50 +15,632 @@ import matplotlib.pyplot as plt
 
 import os
 import sys
+import math
 
 from datetime import datetime
 
+import shutil
 import argparse
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import obspy
-from obspy import read, Stream
+from obspy import read, Stream, Trace, UTCDateTime
 from obspy.core.event import read_events
-from obspy.geodetics import gps2dist_azimuth,locations2degrees
+from obspy.signal.filter import bandpass
+from fractions import Fraction
+from scipy.signal import resample_poly, firwin
+
+from download_manifest import DownloadManifest
+from stationxml_cache import StationXMLCache, waveform_channels
+from station_coordinates import StationCoordinates, index_ext as coordinates_index_ext
+from geodesy import distance_azimuth
+from trace_index import TraceIndex, event_id_from_file
+from columnar_stream import write_columnar, ColumnarWriter, columnar_ext
+from waveform_container import WaveformContainer, read_container_entries, match_ids, requested_windows
+from stage_cache import StageCache, stage_key
+from compact_stream import CompactStream, bandpass_compact, bandpass_processing, compact_dtype, start_resource_tracker
+from trace_qc import apply_qc, write_report, qc_parameters, qc_report_filename, qc_action
+from phase_windows import cut_traces, window_parameters
 
 
 #-------------------------
 # configuration
 
+# sub directories of the event directory
 stations_dir = "stations"
 wf_dir = "waveforms"
 
 sampling_rate = 10.0 # sr for interpolation
 
+# anti-alias FIR filter of the downsampling : half length (in zero crossings of
+# the sinc, scipy's default being 10) and Kaiser window parameter, the shorter
+# filter being enough for the long periods processed
+antialias_half_length = 5
+antialias_beta = 5.0
+
 # corners periods for filtering (in seconds)
 ifmin = 20.0
 ifmax = 10.0
+corners = 4
+zerophase = False # filtering forwards and backwards
+
+# parallel reading of the waveform files : number of workers and pool type
+# ("process" or "thread", the reading being mostly python code, only
+# processes scale with the number of cores)
+read_workers = os.cpu_count() or 1
+read_executor = "process"
+
+# output format : "PICKLE" (obspy stream) or "COLUMNAR" (memory-mappable array
+# and metadata table, see columnar_stream.py), and the matching extensions
+out_format = "PICKLE"
+out_extensions = {"PICKLE" : ".pkl", "COLUMNAR" : columnar_ext}
+
+# number of stations processed at once in the streaming mode
+batch_size = 20
+
+# compact mode : processed traces held as float32 rows of a single array
+# (shared with the worker processes of the filtering), with the event fields
+# stored once (see compact_stream.py)
+compact = False
+
+# quality control of the traces before the processing (see trace_qc.py) :
+# None, or the action on the failing traces ("drop" or "tag")
+quality_control = None
+
+# traces cut to the window around the predicted S/Sdiff arrival (with margins,
+# see phase_windows.py) before the processing
+phase_cut = False
 
 #-------------------------
 
 
-def mseed2obspy_stream(event, out_file, verbose=False):
+def read_stations(event_stations_dir, event_wf_dir, time, station_cache_dir=None):
+    """Coordinates index (see station_coordinates.py, saved next to
+    event_stations_dir) of the StationXML files of the event, and from the
+    StationXML cache of the stations with waveforms but no file in
+    event_stations_dir."""
+
+    files = sorted(glob(os.path.join(event_stations_dir, "*")))
+
+    if station_cache_dir:
+        station_cache = StationXMLCache(station_cache_dir)
+        stations_with_file = set(os.path.basename(f).rsplit(".", 1)[0] for f in files)
+        stations_with_data = {}
+        for f in waveform_names(event_wf_dir):
+            stations_with_data.setdefault(".".join(f.split(".")[:2]), []).append(f)
+        for station_id in sorted(set(stations_with_data) - stations_with_file):
+            cached_file = station_cache.lookup(*station_id.split("."), time, time, waveform_channels(stations_with_data[station_id]))
+            if cached_file:
+                files.append(cached_file)
+
+    if not files:
+        raise FileNotFoundError(f"No station metadata in {event_stations_dir}")
+
+    return StationCoordinates(files, os.path.normpath(event_stations_dir) + coordinates_index_ext)
+
+
+def waveform_names(event_wf_dir):
+    """Names of the waveform files of the event, in the directory or packed
+    in its waveform container."""
+    names = WaveformContainer(event_wf_dir).names()
+    if os.path.isdir(event_wf_dir):
+        names += os.listdir(event_wf_dir)
+    return names
+
+
+def _read_waveform_file(task):
+    """Traces of a waveform file, or of an entry of a waveform container
+    (task : (file name, container entry or None)), or the error message."""
+    filename, entry = task
+    try:
+        if entry is None:
+            return read(filename, format="MSEED").traces, None
+        return read_container_entries(filename, [entry]), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def waveform_tasks(event_wf_dir, trace_ids=None):
+    """Reading tasks (file name, container entry or None) of the waveform
+    files of a directory and of the traces packed in its waveform container
+    (see waveform_container.py).
+
+    trace_ids : ids of the traces to read (wildcards allowed), all if None
+    """
+
+    container = WaveformContainer(event_wf_dir)
+
+    # a file not packed yet replaces its packed version
+    files = sorted(os.listdir(event_wf_dir)) if os.path.isdir(event_wf_dir) else []
+    unpacked = set(files)
+    tasks = [(container.container_file, entry) for name,entry in container.index.items() if name not in unpacked and match_ids(name, trace_ids)]
+    tasks += [(os.path.join(event_wf_dir, f), None) for f in files if match_ids(f, trace_ids)]
+    return tasks
+
+
+def task_station(task):
+    """Station code of the trace of a reading task."""
+    filename, entry = task
+    return (entry["id"] if entry else os.path.basename(filename)).split(".")[1]
+
+
+def station_batches(tasks, batch_size=batch_size):
+    """Reading tasks grouped by batches of batch_size stations (all the
+    traces of a station code being in the same batch, as in the rotation)."""
+
+    tasks_by_station = {}
+    for task in tasks:
+        tasks_by_station.setdefault(task_station(task), []).append(task)
+
+    stations = sorted(tasks_by_station)
+    return [
+        [task for station in stations[i:i+batch_size] for task in tasks_by_station[station]]
+        for i in range(0, len(stations), batch_size)]
+
+
+def make_pool(max_workers=read_workers, executor=read_executor):
+    """Pool of workers reading the waveform files (None for serial reading)."""
+    if max_workers <= 1:
+        return None
+    if executor == "process":
+        # workers sharing the resource tracker of the compact streams (see compact_stream.py)
+        start_resource_tracker()
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+def read_tasks(tasks, pool=None):
+    """Read concurrently (with the pool, serially if None) into a single stream
+    the traces of reading tasks. Files which cannot be read are reported and
+    skipped.
+
+    Returns the stream and the dictionnary file -> error of the files not read.
+    """
+
+    if pool is not None and len(tasks) > 1:
+        results = list(pool.map(_read_waveform_file, tasks, chunksize=max(1, len(tasks)//(4*pool._max_workers))))
+    else:
+        results = [_read_waveform_file(task) for task in tasks]
+
+    traces = []
+    errors = {}
+    for (f,entry),(file_traces,error) in zip(tasks, results):
+        if error:
+            errors[f if entry is None else f"{f}:{entry['id']}@{entry['offset']}"] = error
+        else:
+            traces.extend(file_traces)
+
+    return Stream(traces=traces), errors
+
+
+def read_waveforms(event_wf_dir, max_workers=read_workers, executor=read_executor, trace_ids=None):
+    """Read concurrently into a single stream the waveform files of a directory
+    and the traces packed in its waveform container (see read_tasks)."""
+
+    pool = make_pool(max_workers, executor)
+    try:
+        return read_tasks(waveform_tasks(event_wf_dir, trace_ids), pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def add_metadata(st, stations2, origin):
+    """Add to the traces the station coordinates (one lookup in the coordinates
+    index per trace), the event information, the distance and back azimuth.
+    Traces without station metadata are removed.
+
+    Returns the list of the distances.
+    """
+
+    coordinates = []
+    for tr in st.traces[:]:
+        try:
+            coordinates.append(stations2.get_coordinates(tr.id, tr.stats.starttime))
+        except KeyError as e:
+            print(f"{e.args[0]}, trace removed")
+            st.remove(tr)
+    if len(st) == 0:
+        return []
+
+    # distances and back azimuths computed at once for all the traces
+    dist_list, _, baz_list = distance_azimuth(
+        [c["latitude"] for c in coordinates], [c["longitude"] for c in coordinates],
+        origin.latitude, origin.longitude)
+
+    for tr,st_coordinates,dist,b_az in zip(st, coordinates, dist_list, baz_list):
+        
+        tr.stats.coordinates = st_coordinates
+        
+        tr.stats.evla = origin.latitude
+        tr.stats.evlo = origin.longitude
+        tr.stats.evde = origin.depth / 1000.
+        tr.stats.event_origin_time = origin.time
+        
+        tr.stats.back_azimuth = float(b_az) # for rotation
+        tr.stats.distance = float(dist)
+
+    return list(dist_list)
+
+
+def rotate_ne_rt(st):
+    """Rotate NE->RT, in place, the N and E traces of each (network, station,
+    location, band) group, with their back azimuths. The rotation is done at
+    once for all the pairs of traces of the same length.
+
+    Returns the dictionnary group id -> reason of the groups not rotated.
+    """
+
+    # traces grouped in a single pass
+    groups = {}
+    for tr in st:
+        key = f"{tr.stats.network}.{tr.stats.station}.{tr.stats.location}.{tr.stats.channel[:-1]}?"
+        groups.setdefault(key, {}).setdefault(tr.stats.channel[-1], []).append(tr)
+
+    not_rotated = {}
+    pairs_by_npts = {}
+
+    for key,components in groups.items():
+
+        n, e = components.get("N", []), components.get("E", [])
+
+        if not n and not e:
+            not_rotated[key] = f"no N/E components ({', '.join(sorted(components))})"
+            continue
+        if len(n) != 1 or len(e) != 1:
+            not_rotated[key] = f"{len(n)} N and {len(e)} E traces"
+            continue
+
+        n, e = n[0], e[0]
+        if len(n) != len(e) or abs(n.stats.starttime - e.stats.starttime) > 0.5*n.stats.delta or n.stats.sampling_rate != e.stats.sampling_rate:
+            not_rotated[key] = "N and E components with different time spans"
+            continue
+
+        pairs_by_npts.setdefault(len(n), []).append((n, e))
+
+    for pairs in pairs_by_npts.values():
+
+        N = np.array([n.data for n,_ in pairs])
+        E = np.array([e.data for _,e in pairs])
+        ba = [math.radians(n.stats.back_azimuth) for n,_ in pairs]
+        sin_ba = np.array([math.sin(b) for b in ba])[:,None]
+        cos_ba = np.array([math.cos(b) for b in ba])[:,None]
+
+        R = - E * sin_ba - N * cos_ba
+        T = - E * cos_ba + N * sin_ba
+
+        for (n,e),r,t in zip(pairs, R, T):
+            # written in the arrays of the traces if possible (the rows of R and
+            # T not keeping them in memory)
+            if n.data.dtype == r.dtype and e.data.dtype == t.dtype and n.data.flags.writeable and e.data.flags.writeable:
+                n.data[:], e.data[:] = r, t
+            else:
+                n.data, e.data = r, t
+            n.stats.channel = n.stats.channel[:-1] + "R"
+            e.stats.channel = e.stats.channel[:-1] + "T"
+            e.stats.back_azimuth = n.stats.back_azimuth
+
+    return not_rotated
+
+
+def grid_start_ns(starttime, sampling_rate=sampling_rate):
+    """First time (ns) of the common time grid (multiples of the sampling
+    interval since the epoch) at or after starttime."""
+    delta_ns = round(1e9 / sampling_rate)
+    return -(-starttime.ns // delta_ns) * delta_ns
+
+
+def same_length_groups(st):
+    """Traces grouped by (sampling rate, number of samples), to be stacked in
+    2-D arrays."""
+    groups = {}
+    for tr in st:
+        groups.setdefault((tr.stats.sampling_rate, tr.stats.npts), []).append(tr)
+    return groups
+
+
+def resample_stream(st, sampling_rate=sampling_rate):
+    """Resample the traces, in place, on the common time grid (see
+    grid_start_ns), replacing st.interpolate.
+
+    The traces of the same sampling rate and length are stacked in a 2-D
+    array : when downsampling, resampled at once by a polyphase anti-alias
+    filter (zero-phase FIR, scipy.signal.resample_poly), then linearly
+    interpolated on the grid. They are given the same length, the number of
+    grid samples within all of them.
+    """
+
+    groups = same_length_groups(st)
+
+    for (df,npts),traces in groups.items():
+
+        data = np.array([tr.data for tr in traces], dtype=np.float64)
+
+        if df > sampling_rate:
+            ratio = Fraction(sampling_rate / df).limit_denominator(1000)
+            max_rate = max(ratio.numerator, ratio.denominator)
+            fir = firwin(2 * antialias_half_length * max_rate + 1, 1. / max_rate, window=('kaiser', antialias_beta))
+            data = resample_poly(data, ratio.numerator, ratio.denominator, axis=-1, window=fir, padtype='line')
+            df, npts = df * ratio.numerator / ratio.denominator, data.shape[1]
+
+        # start of each trace on the grid, and as a (fractional) index of its samples
+        starts = [grid_start_ns(tr.stats.starttime, sampling_rate) for tr in traces]
+        offsets = np.array([(start - tr.stats.starttime.ns) * 1e-9 * df for start,tr in zip(starts, traces)])
+
+        step = df / sampling_rate
+        n_new = int(np.floor((npts - 1 - offsets.max()) / step + 1e-9)) + 1
+        if n_new < 1:
+            for tr in traces:
+                st.remove(tr)
+            continue
+
+        if step == int(step):
+            # (after downsampling) grid samples at the same fractional position
+            # between the samples of a trace : strided slices of the rows
+            step = int(step)
+            resampled = np.empty((len(traces), n_new))
+            for i,offset in enumerate(offsets):
+                first = int(np.floor(offset))
+                weight = offset - first
+                left = data[i,first:first+step*(n_new-1)+1:step]
+                right = data[i,first+1:first+step*(n_new-1)+2:step]
+                if weight == 0 or len(right) < n_new:
+                    resampled[i] = left
+                else:
+                    resampled[i] = left + weight * (right - left)
+            data = resampled
+        else:
+            positions = offsets[:,None] + step * np.arange(n_new)[None,:]
+            index = np.minimum(np.floor(positions).astype(int), npts - 2) if npts > 1 else np.zeros_like(positions, dtype=int)
+            weight = positions - index
+            left = np.take_along_axis(data, index, axis=-1)
+            right = np.take_along_axis(data, np.minimum(index + 1, npts - 1), axis=-1)
+            data = left + weight * (right - left)
+
+        for tr,start,resampled in zip(traces, starts, data):
+            tr.data = resampled
+            tr.stats.sampling_rate = sampling_rate
+            tr.stats.starttime = UTCDateTime(ns=start)
+
+
+def bandpass_filter(st, freqmin, freqmax, corners=corners, zerophase=zerophase):
+    """Bandpass filter (as st.filter('bandpass', ...)), in place. The traces of
+    the same sampling rate and length are stacked in a 2-D array, filtered at
+    once with a single filter design.
+    """
+
+    groups = same_length_groups(st)
+    info = bandpass_processing(freqmin, freqmax, corners, zerophase)
+
+    for (df,_),traces in groups.items():
+        data = np.array([tr.data for tr in traces], dtype=np.float64)
+        data = bandpass(data, freqmin, freqmax, df, corners=corners, zerophase=zerophase, axis=-1)
+        for tr,filtered in zip(traces, data):
+            tr.data = filtered
+            tr.stats.setdefault("processing", []).append(info)
+
+
+def bandpass_filter_bands(st, bands, corners=corners, zerophase=zerophase):
+    """Bandpass filter the traces in several frequency bands (list of
+    (freqmin, freqmax)), st being left unchanged. The traces are stacked once,
+    each band being filtered on the same arrays (see bandpass_filter).
+
+    Returns the list of the filtered streams, one per band.
+    """
+
+    streams = [Stream() for _ in bands]
+
+    for (df,_),traces in same_length_groups(st).items():
+        data = np.array([tr.data for tr in traces], dtype=np.float64)
+        for st_band,(freqmin,freqmax) in zip(streams, bands):
+            filtered = bandpass(data, freqmin, freqmax, df, corners=corners, zerophase=zerophase, axis=-1)
+            info = bandpass_processing(freqmin, freqmax, corners, zerophase)
+            for tr,tr_data in zip(traces, filtered):
+                # (own processing list, the header being copied shallowly)
+                tr_band = Trace(data=tr_data, header=tr.stats)
+                tr_band.stats.processing = tr.stats.get("processing", []) + [info]
+                st_band.append(tr_band)
+
+    return streams
+
+
+def band_files(out_file, bands=None):
+    """Output file of each period band (list of (period min, period max) in
+    seconds) : out_file for the default band, else with a _<min>-<max>s
+    suffix."""
+    if bands is None:
+        return {(ifmax, ifmin) : out_file}
+    base, ext = os.path.splitext(os.path.normpath(out_file))
+    return {(tmin, tmax) : f"{base}_{tmin:g}-{tmax:g}s{ext}" for tmin,tmax in bands}
+
+
+processing_stages = ("ingest", "resample", "rotate", "filter")
+
+
+def stage_keys(tasks, stations2, origin, bands=None, compact=False, qc=None, cut=False):
+    """Keys of the products of the processing stages in the stage cache (see
+    stage_cache.py) : hash of the data read (waveform files and container
+    entries, station metadata files, event origin) and of the quality control
+    and cut done while reading, then of the parameters of each stage. The
+    filter stage has one key per band."""
+
+    waveforms = []
+    for filename,entry in tasks:
+        stat = os.stat(filename)
+        if entry is None:
+            waveforms.append([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+        else:
+            # the container being only appended, an entry is not modified
+            waveforms.append([os.path.abspath(filename), stat.st_ino, entry["id"], entry["offset"], entry["size"]])
+    stations = sorted([f, record["signature"]] for f,record in stations2.files.items())
+
+    keys = {}
+    keys["ingest"] = stage_key("ingest", waveforms, stations, [str(origin.time), origin.latitude, origin.longitude, origin.depth], qc, qc_parameters() if qc else None, window_parameters() if cut else None)
+    keys["resample"] = stage_key(keys["ingest"], "resample", sampling_rate, antialias_half_length, antialias_beta)
+    keys["rotate"] = stage_key(keys["resample"], "rotate")
+    keys["filter"] = [stage_key(keys["rotate"], "filter", band, corners, zerophase, compact) for band in (bands or [(ifmax, ifmin)])]
+    return keys
+
+
+def conversion_parameters(band, out_format=out_format, compact=False, qc=None, cut=False, trace_ids=None):
+    """Hash of the parameters of the conversion of the output file of a period
+    band, recorded in the download manifest (conversion redone when changed)."""
+    return stage_key("conversion", band, out_format, compact, trace_ids,
+        sampling_rate, antialias_half_length, antialias_beta, corners, zerophase,
+        qc, qc_parameters() if qc else None, window_parameters() if cut else None)
+
+
+def cached_product(cache, keys):
+    """Last processing stage whose product is in the stage cache, and its
+    product (the filtered streams for the filter stage), (None, None) if none."""
+
+    if all(key in cache for key in keys["filter"]):
+        streams = [cache.get(key) for key in keys["filter"]]
+        if all(st is not None for st in streams):
+            return "filter", streams
+
+    for stage in ("rotate", "resample", "ingest"):
+        st = cache.get(keys[stage])
+        if st is not None:
+            return stage, st
+
+    return None, None
+
+
+def process_stream(st, verbose=False, bands=None, cache=None, keys=None, done="ingest", compact=False, pool=None):
+    """Resample, rotate (NE->RT) and filter the traces, in place.
+
+    bands : period bands (list of (period min, period max) in seconds), the
+        resampled and rotated traces being filtered in each of them
+    cache, keys : stage cache where the product of each stage is stored, and
+        the keys of the products (see stage_keys)
+    done : last stage already done, st being its product
+    compact : filter compact streams (see compact_stream.py), the traces of st
+        being released once compacted
+    pool : process pool of the workers filtering the compact streams
+
+    Returns the list of the filtered streams, one per band (st for the default
+    band).
+    """
+
+    if done == "filter":
+        return st
+    done = processing_stages.index(done)
+
+    # resampling and triming
+    if done < 1:
+        if verbose: print("Resampling...")
+        resample_stream(st, sampling_rate)
+        if cache: cache.put(keys["resample"], st)
+
+
+    # rotating it
+    if done < 2:
+        if verbose: print("Rotating NE->RT...")
+        st._trim_common_channels()
+
+        not_rotated = rotate_ne_rt(st)
+        for key,reason in sorted(not_rotated.items()):
+            print(f"Couldn't rotate {key} : {reason}")
+        if cache: cache.put(keys["rotate"], st)
+
+    # filtering it
+    if verbose: print("Filtering...")
+    frequencies = [(1/tmax, 1/tmin) for tmin,tmax in (bands or [(ifmax, ifmin)])]
+    if compact:
+        cs = CompactStream.from_stream(st, shared=pool is not None)
+        st.traces = []
+        try:
+            streams = bandpass_compact(cs, frequencies, corners, zerophase, pool, in_place=len(frequencies) == 1)
+        finally:
+            if len(frequencies) > 1: cs.close()
+    elif bands is None:
+        bandpass_filter(st, *frequencies[0])
+        streams = [st]
+    else:
+        streams = bandpass_filter_bands(st, frequencies)
+    if cache:
+        try:
+            for key,st_band in zip(keys["filter"], streams):
+                cache.put(key, st_band)
+        except BaseException:
+            if compact:
+                for st_band in streams: st_band.close()
+            raise
+    return streams
+
+
+def mseed2obspy_stream(event, out_file, verbose=False, manifest_file=None, event_dir=".", station_cache_dir=None, read_workers=read_workers, read_executor=read_executor, trace_ids=None, out_format=out_format, trace_index_file=None, streaming=False, batch_size=batch_size, bands=None, stage_cache_dir=None, compact=compact, qc=quality_control, cut=phase_cut, event_id=None):
     """
     event : event obspy object
-    out_file : output file name
+    out_file : output file name (directory for the COLUMNAR format)
+    manifest_file : download manifest (in event_dir), the conversion is skipped
+        if out_file was already produced from the same downloaded data
+    event_dir : event data directory, containing the stations/ and waveforms/
+        directories, where the receivers.dat file is written
+    station_cache_dir : StationXML cache, to read the metadata missing from
+        the stations/ directory
+    read_workers, read_executor : parallel reading of the waveform files
+    trace_ids : ids of the traces to process (wildcards allowed), all if None
+    out_format : "PICKLE" or "COLUMNAR"
+    trace_index_file : campaign trace index (see trace_index.py) where the
+        metadata of the traces are registered
+    event_id : event id of the traces in the trace index (default : from
+        out_file)
+    streaming : process the stations by batches of batch_size stations, written
+        one after the other (bounded memory, COLUMNAR format only)
+    bands : period bands (list of (period min, period max) in seconds) of the
+        filtering, one output file per band (see band_files), the traces being
+        read, resampled and rotated once ; default : the (ifmax, ifmin) band in
+        out_file
+    stage_cache_dir : cache of the products of the processing stages (see
+        stage_cache.py), the processing restarting after the last stage found
+        in the cache (not used in the streaming mode)
+    compact : compact mode (see compact_stream.py) : float32 traces, filtered
+        by the reading workers in shared memory (process pool)
+    qc : quality control of the traces once read (see trace_qc.py), the
+        failing traces being dropped ("drop") or tagged ("tag"), and the report
+        written in event_dir ; None to disable
+    cut : cut the traces to the window around their predicted S/Sdiff arrival
+        before the processing (see phase_windows.py)
     """
 
+    out_files = band_files(out_file, bands)
+    parameters = {f : conversion_parameters(band, out_format, compact, qc, cut, trace_ids) for band,f in out_files.items()}
+    # event id and band of the traces in the trace index
+    event_id = event_id or event_id_from_file(out_file)[0]
+    index_bands = {f : f"{tmin:g}-{tmax:g}" for (tmin,tmax),f in out_files.items()}
+    out_files = list(out_files.values())
+
+    event_stations_dir = os.path.join(event_dir, stations_dir)
+    event_wf_dir = os.path.join(event_dir, wf_dir)
+
+    manifest = None
+    if manifest_file:
+        manifest_file = os.path.join(event_dir, manifest_file)
+    if manifest_file and os.path.exists(manifest_file):
+        manifest = DownloadManifest(manifest_file)
+        if all(manifest.conversion_done(f, parameters[f]) for f in out_files):
+            print(f"{', '.join(out_files)} already up to date, skipping conversion.")
+            return
+
+    if streaming and out_format != "COLUMNAR":
+        print("The streaming mode needs the COLUMNAR output format")
+        return
+
     origin = event.preferred_origin()
 
     # loading station metadata
     try:
-        stations2 = obspy.read_inventory(stations_dir+"/*")
+        stations2 = read_stations(event_stations_dir, event_wf_dir, origin.time, station_cache_dir)
     except:
         print("Issue with reading stations metadata")
         return 
     print(f"{len(stations2)} stations.")
 
     # writting in a receivers.dat file
-    out_file_stn_base = "receivers.dat"
+    out_file_stn_base = os.path.join(event_dir, "receivers.dat")
     out_file_stn = out_file_stn_base
     n = 1
     while os.path.exists(out_file_stn):
@@ -70,70 +652,137 @@ def mseed2obspy_stream(event, out_file, verbose=False):
     with open(out_file_stn, 'w') as out:
         header = ["Number of stations is:",len(stations2),"nw stn lat lon:"]
         out.writelines(f"{l}\n" for l in header)
-        for nw in stations2:
-            nw_code = nw.code
-            for stn in nw:
-                code = stn.code
-                lat,lon = stn.latitude,stn.longitude
-                out.write(f"{nw_code:<2} {code[:4]:<4} {lat:8.4f}  {lon:8.4f}\n")
-
-    # Reading waveform data into a stream obspy object
-    st = Stream()
-    try:
-        for waveform in os.listdir(wf_dir):
-            st += read(os.path.join(wf_dir, waveform))
-    except:
-        print("Issue with reading waveform data")
-        return 
-    dist_list = []
-
-    # computing aditionnal metadata
-    for tr in st:
-        
-        st_coordinates = stations2.get_coordinates(tr.id)
-        st_lat = st_coordinates["latitude"]
-        st_lon = st_coordinates["longitude"]
-        
-        tr.stats.coordinates = st_coordinates
-        
-        tr.stats.evla = origin.latitude
-        tr.stats.evlo = origin.longitude
-        tr.stats.evde = origin.depth / 1000.
-        tr.stats.event_origin_time = origin.time
-                
-        _,b_az,_ = gps2dist_azimuth(st_lat, st_lon, origin.latitude, origin.longitude)
-        dist = locations2degrees(st_lat, st_lon, origin.latitude, origin.longitude)
-        
-        tr.stats.back_azimuth = b_az # for rotation
-        tr.stats.distance = dist
-        
-        dist_list.append(dist)
+        for nw_code,code,lat,lon in stations2.stations():
+            out.write(f"{nw_code:<2} {code[:4]:<4} {lat:8.4f}  {lon:8.4f}\n")
+
+    # Reading waveform data into a stream obspy object : at once, or by
+    # batches of stations in the streaming mode
+    tasks = waveform_tasks(event_wf_dir, trace_ids)
+    batches = station_batches(tasks, batch_size) if streaming else [tasks]
+
+    # products of the processing stages already in the cache : nothing to read
+    cache, keys, cached_stage = None, None, None
+    if stage_cache_dir and not streaming:
+        cache = StageCache(stage_cache_dir)
+        keys = stage_keys(tasks, stations2, origin, bands, compact, qc, cut)
+        cached_stage, st = cached_product(cache, keys)
+        if cached_stage:
+            print(f"Restarting after the {cached_stage} stage (stage cache)")
+            batches = []
+
+    index = TraceIndex(trace_index_file) if trace_index_file else None
+    writers = []
+    if streaming:
+        writers = [ColumnarWriter(f, compact_dtype if compact else np.float64) for f in out_files]
+        if index:
+            for f in out_files: index.unregister(f)
+
+    pool = make_pool(read_workers, read_executor)
+    # the compact streams are filtered in shared memory by worker processes
+    filter_pool = pool if compact and read_executor == "process" else None
 
-    if verbose: print(f"Distances between {min(dist_list):.1f}° and {max(dist_list):.1f}°")
-
-    # interpolating and triming
-    if verbose: print("Interpolating...")
-    st.interpolate(sampling_rate=sampling_rate)
+    dist_list = []
+    n_errors = 0
+    qc_reports = []
+    # (coverage of the time window requested for each trace)
+    qc_windows = requested_windows(waveform_names(event_wf_dir)) if qc else None
+
+    for i,batch in enumerate(batches):
+
+        st, errors = read_tasks(batch, pool)
+        for f,error in errors.items():
+            print(f"Issue with reading waveform file {f} : {error}")
+        n_errors += len(errors)
+
+        # computing aditionnal metadata
+        dist_list += add_metadata(st, stations2, origin)
+
+        # quality control before the processing
+        if qc:
+            qc_reports.append(apply_qc(st, qc, qc_windows))
+
+        # cut to the phase windows before the processing
+        if cut:
+            removed = cut_traces(st)
+            if verbose and removed: print(f"{len(removed)} traces not cut ({', '.join(sorted(set(removed.values())))}), removed")
+
+        if streaming and len(st) > 0:
+            if verbose: print(f"Batch {i+1}/{len(batches)} : {len(st)} traces")
+            streams = process_stream(st, bands=bands, compact=compact, pool=filter_pool)
+            try:
+                for f,writer,st_band in zip(out_files, writers, streams):
+                    if index: index.register(st_band, f, event_id, first_position=len(writer), replace=False, band=index_bands[f])
+                    writer.append(st_band)
+            finally:
+                # (shared memory of the compact streams)
+                if compact:
+                    for st_band in streams: st_band.close()
+
+    if pool is not None and filter_pool is None:
+        pool.shutdown()
+
+    if cache and not cached_stage and dist_list:
+        cache.put(keys["ingest"], st)
+        cached_stage = "ingest"
+
+    if not dist_list and not cached_stage:
+        print("No waveform data read")
+        for writer in writers: shutil.rmtree(writer.tmp_dir)
+        if index: index.close()
+        if filter_pool is not None: filter_pool.shutdown()
+        return
+    if verbose and dist_list: print(f"{len(dist_list)} traces read ({n_errors} files not read)")
+    if verbose and dist_list: print(f"Distances between {min(dist_list):.1f}° and {max(dist_list):.1f}°")
+
+    if qc_reports:
+        qc_report_file = os.path.join(event_dir, qc_report_filename)
+        report = write_report(qc_reports, qc_report_file)
+        print(f"Quality control : {report['passed'].sum()}/{len(report)} traces passed (report in {qc_report_file})")
+
+    # (streaming : no batch written)
+    if (len(writers[0]) == 0 if streaming else len(st) == 0):
+        print("No trace left after the quality control and cut")
+        for writer in writers: shutil.rmtree(writer.tmp_dir)
+        if index: index.close()
+        if filter_pool is not None: filter_pool.shutdown()
+        return
+
+    if streaming:
+        for f,writer in zip(out_files, writers):
+            if verbose: print(f">> Writting {f}")
+            writer.close()
+
+    else:
+        streams = process_stream(st, verbose, bands, cache, keys, cached_stage or "ingest", compact, filter_pool)
+        try:
+            for f,st_band in zip(out_files, streams):
 
+                # saving it into serialized stream object (pickle format) or columnar format
+                if verbose: print(f">> Writting {f}")
+                if out_format == "COLUMNAR" and compact:
+                    st_band.write(f)
+                elif out_format == "COLUMNAR":
+                    write_columnar(st_band, f)
+                elif compact:
+                    st_band.to_stream().write(f, format='PICKLE')
+                else:
+                    st_band.write(f, format='PICKLE')
 
-    # rotating it
-    if verbose: print("Rotating NE->RT...")
-    stations3 = set([tr.stats.station for tr in st])
-    st._trim_common_channels()
+                if index: index.register(st_band, f, event_id, band=index_bands[f])
+        finally:
+            # (shared memory of the compact streams)
+            if compact:
+                for st_band in streams: st_band.close()
 
-    for station in stations3:                       
-        try:
-            st.select(station=station).rotate('NE->RT')
-        except ValueError:
-            print(f"Couldn't rotate:\n{st.select(station=station)}")
+    if filter_pool is not None:
+        filter_pool.shutdown()
 
-    # filtering it
-    if verbose: print("Filtering...")
-    st.filter('bandpass', freqmin=1/ifmin, freqmax=1/ifmax)
+    if index: index.close()
 
-    # saving it into serialized stream object (pickle format)
-    if verbose: print(f">> Writting {out_file}")
-    st.write(out_file, format='PICKLE')
+    if manifest:
+        for f in out_files:
+            manifest.record_conversion(f, parameters=parameters[f])
+        manifest.write()
 
 
 if __name__ == "__main__":
@@ -146,15 +795,45 @@ if __name__ == "__main__":
 
     parser.add_argument("-o",dest='out_file', type=str, help='output file name (without extension)', required=True)
 
+    parser.add_argument("-m",dest='manifest_file', type=str, help='download manifest (skip conversion if already done)', default=None)
+
+    parser.add_argument("-d",dest='event_dir', type=str, help='event data directory', default=".")
+
+    parser.add_argument("--station-cache", dest='station_cache_dir', type=str, help='StationXML cache directory', default=None)
+
+    parser.add_argument("-j",dest='read_workers', type=int, help='number of workers reading the waveform files', default=read_workers)
+
+    parser.add_argument("--ids", dest='trace_ids', type=str, nargs="+", help='ids of the traces to process (wildcards allowed, e.g. "IU.*")', default=None)
+
+    parser.add_argument("-f",dest='out_format', type=str, choices=list(out_extensions), help='output format', default=out_format)
+
+    parser.add_argument("--index", dest='trace_index_file', type=str, help='campaign trace index where the traces are registered', default=None)
+
+    parser.add_argument("--streaming", dest='streaming', action='store_true', help='process the stations by batches (bounded memory, COLUMNAR format only)')
+
+    parser.add_argument("--batch-size", dest='batch_size', type=int, help='number of stations per batch in the streaming mode', default=batch_size)
+
+    parser.add_argument("--band", dest='bands', type=float, nargs=2, action='append', metavar=('TMIN', 'TMAX'), help='period band (s) of the filtering, repeated for several bands processed in a single pass (one output per band, with a _TMIN-TMAXs suffix)', default=None)
+
+    parser.add_argument("--stage-cache", dest='stage_cache_dir', type=str, help='cache directory of the products of the processing stages (rerun from the last stage cached)', default=None)
+
+    parser.add_argument("--compact", dest='compact', action='store_true', help='compact mode : float32 traces in a single (shared memory) array, event fields stored once')
+
+    parser.add_argument("--qc", dest='qc', type=str, nargs="?", const=qc_action, choices=("drop", "tag"), help='quality control of the traces before the processing, the failing traces being dropped (default) or tagged', default=quality_control)
+
+    parser.add_argument("--cut", dest='cut', action='store_true', help='cut the traces to the window around their predicted S/Sdiff arrival before the processing')
+
+    parser.add_argument("--read-executor", dest='read_executor', type=str, choices=("thread","process"), help='pool type of the workers reading the waveform files', default=read_executor)
+
     args = parser.parse_args()
 
     # read event information
     events = read_events(args.event_file)
     event = events[0]
 
-    out_file = args.out_file + ".pkl"
+    out_file = args.out_file + out_extensions[args.out_format]
 
-    mseed2obspy_stream(event, out_file, verbose=True)
+    mseed2obspy_stream(event, out_file, verbose=True, manifest_file=args.manifest_file, event_dir=args.event_dir, station_cache_dir=args.station_cache_dir, read_workers=args.read_workers, read_executor=args.read_executor, trace_ids=args.trace_ids, out_format=args.out_format, trace_index_file=args.trace_index_file, streaming=args.streaming, batch_size=args.batch_size, bands=[tuple(sorted(band)) for band in args.bands] if args.bands else None, stage_cache_dir=args.stage_cache_dir, compact=args.compact or compact, qc=args.qc, cut=args.cut or phase_cut)
 
 
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Time windows around the predicted arrival of a phase (first arrival of S or
+Sdiff by default, see travel_times.py), from the distance of each station and
+the event depth :
+    - per-station download windows (download_waveform_data), instead of the
+      fixed window after the origin
+    - cut of the traces before the processing of mseed2obspy_stream
+      (resampling, rotation, filtering), which then handles only the window
+
+The window (in seconds around the arrival) is extended by a margin on each
+side, absorbing the transient of the filtering, the traces being tapered over
+the outer part of the margin once cut.
+
+Usage : python phase_windows.py -e event.xml -r receivers.dat
+    prints the per-station download windows of an event
+"""
+
+import argparse
+
+import numpy as np
+
+from travel_times import first_arrivals
+from geodesy import distance_azimuth
+
+
+#-------------------------
+# configuration
+
+# window (s) around the first arrival of the phases
+window_phases = ("S", "Sdiff")
+phase_window = (-20., 100.)
+
+# margin (s) added on each side of the window, and length (s) of the cosine
+# taper at both ends of the cut traces
+window_margin = 200.
+taper_length = 50.
+
+#-------------------------
+
+
+def window_parameters():
+    """Parameters of the cut (part of the stage cache keys)."""
+    return [window_phases, phase_window, window_margin, taper_length]
+
+
+def phase_windows(distances, depth, phases = window_phases, window = phase_window, margin = window_margin):
+    """Start and end (s after the origin) of the windows at each distance (°)
+    for a source depth (km), margins included, NaN where none of the phases
+    arrives."""
+    arrivals = first_arrivals(distances, depth, phases)
+    return arrivals + window[0] - margin, arrivals + window[1] + margin
+
+
+def station_windows(stations, origin, phases = window_phases, window = phase_window, margin = window_margin):
+    """Download windows of the stations of an inventory (see station_inventory.py)
+    for an event origin, as a dictionnary (network, station) -> (starttime,
+    endtime) (UTCDateTime), without the stations where none of the phases
+    arrives."""
+
+    dist, _, _ = distance_azimuth(stations.stations["lat"], stations.stations["lon"], origin.latitude, origin.longitude)
+    starts, ends = phase_windows(dist, origin.depth / 1000., phases, window, margin)
+
+    windows = {}
+    for nw_code,st_code,start,end in zip(stations.stations["nw"], stations.stations["code"], starts, ends):
+        if not np.isnan(start):
+            windows[(nw_code, st_code)] = (origin.time + float(start), origin.time + float(end))
+    return windows
+
+
+def cut_traces(st, phases = window_phases, window = phase_window, margin = window_margin, taper_length = taper_length):
+    """Cut in place the traces (with the metadata of mseed2obspy_stream :
+    distance, event depth and origin time) to their window, the mean removed
+    and the ends tapered. The cut traces are float64 copies (the full traces
+    are released), of the same length for a sampling rate unless the data
+    does not cover the margins. The traces not covering their window (margins
+    excluded), or without arrival, are removed.
+
+    Returns the dictionnary trace id -> reason of the traces removed.
+    """
+
+    if len(st) == 0:
+        return {}
+
+    stats = st[0].stats
+    origin_time = stats.event_origin_time
+    starts, _ = phase_windows([tr.stats.distance for tr in st], stats.evde, phases, window, margin)
+    duration = window[1] - window[0] + 2 * margin
+
+    removed = {}
+    traces = []
+    tapers = {}
+    for tr,start in zip(st, starts):
+
+        if np.isnan(start):
+            removed[tr.id] = f"no {'/'.join(phases)} arrival"
+            continue
+
+        df = tr.stats.sampling_rate
+        first = int(round((origin_time + float(start) - tr.stats.starttime) * df))
+        last = first + int(round(duration * df))
+        n_margin = int(round(margin * df))
+        if first + n_margin < 0 or last - n_margin > tr.stats.npts:
+            removed[tr.id] = "window not covered"
+            continue
+        first, last = max(first, 0), min(last, tr.stats.npts)
+        npts = last - first
+
+        data = tr.data[first:last].astype(np.float64)
+        data -= data.mean()
+
+        n_taper = min(int(round(taper_length * df)), npts // 2)
+        if n_taper not in tapers:
+            tapers[n_taper] = 0.5 * (1 - np.cos(np.pi * np.arange(n_taper) / n_taper))
+        taper = tapers[n_taper]
+        if len(taper):
+            data[:len(taper)] *= taper
+            data[-len(taper):] *= taper[::-1]
+
+        tr.stats.starttime += first / df
+        tr.data = data
+        traces.append(tr)
+
+    st.traces = traces
+    return removed
+
+
+if __name__ == "__main__":
+
+    from obspy.core.event import read_events
+
+    from station_inventory import MyInventory
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-e",dest='event_file', type=str, help='obspy compatible event file', required=True)
+
+    parser.add_argument("-r",dest='receivers_file', type=str, help='receivers.dat file', required=True)
+
+    args = parser.parse_args()
+
+    origin = read_events(args.event_file)[0].preferred_origin()
+    stations = MyInventory()
+    stations.read_fromDat(args.receivers_file)
+
+    windows = station_windows(stations, origin)
+    for (nw_code,st_code),(starttime,endtime) in sorted(windows.items()):
+        print(f"{nw_code:<2} {st_code:<5} {starttime - origin.time:8.1f} s {endtime - origin.time:8.1f} s")
+    print(f"{len(windows)}/{len(stations.stations)} stations, {sum(end - start for start,end in windows.values()):.0f} s of data")
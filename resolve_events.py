@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Resolve a whole events list (date magnitude, as read by download_all_events)
+into the files expected by download_all_events : for each line the event
+CMTSOLUTION file (events_dir/<event_id>.cmtsolution) and the receivers file
+(stations_dir/<event_id>_receivers.dat).
+
+Instead of one catalog request per line :
+    - the dates of the list are grouped in time spans, one catalog request per
+      span (through the local catalog store, see catalog_cache.py, so that
+      already requested spans are not requested again)
+    - the stations of all the events are obtained with a single station request
+      over the whole time span, then selected for each event (activity, distance
+      and azimuth domain)
+
+The lines matching no event or several events of the catalog are reported
+(and their files not written).
+
+Usage : python resolve_events.py -i events_list_indonesia2africa_fe.txt -c gcmt
+"""
+
+import os,sys
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+from obspy import UTCDateTime
+from obspy.clients.fdsn import Client
+
+from station_inventory import MyInventory, MyStation
+from geodesy import distance_azimuth
+from catalog_cache import CatalogCache, catalog_cache_file
+from get_event import fetch_usgs_events, fetch_gcmt_events
+from download_all_events import get_event_ids, in_file, events_dir, stations_dir
+from download_waveform_data import tmin_after_event, tmax_after_event
+
+# custom modules
+sys.path.append('/home/sbrisson/documents/Geosciences/stage-BSL/tools/bsl_toolbox')
+
+from data_acquisition.distance_azimuth_domain import DistanceAzimuthDomain
+
+
+#-------------------------
+# configuration
+
+# catalog the events are taken from ("gcmt" or "usgs")
+catalog = "gcmt"
+
+# maximum difference between the magnitude of the list and of the catalog
+mag_tolerance = 0.05
+
+# dates of the list closer than max_gap days are requested together, per
+# catalog : the gcmt catalog being searched day by day, only consecutive days
+# are requested together (merging distant dates would add day searches)
+max_gaps = {"usgs" : 30, "gcmt" : 0}
+
+# stations search (same as in the notebook, indonesia events to Africa)
+channels = "BH*,HH*,LH*"
+dmin  = 70.0
+dmax  = 120.0
+azmin = -40.0
+azmax = 40.0
+lat_pivot = -10.
+lon_pivot = 50.
+
+#-------------------------
+
+
+fetch_functions = {
+    "usgs" : fetch_usgs_events,
+    "gcmt" : fetch_gcmt_events,
+}
+
+
+def parse_events_list(lines):
+    """(line, date, magnitude) of the lines of an events list."""
+    return [(line, UTCDateTime(datetime.strptime(line.split()[0], "%Y/%m/%d")), float(line.split()[1])) for line in lines]
+
+
+def time_spans(dates, max_gap = max_gaps["usgs"]):
+    """Group dates (days) into time spans [start, end[ with gaps smaller than max_gap days."""
+
+    nb_sec = 24*60*60
+
+    spans = []
+    for date in sorted(dates):
+        if spans and date - spans[-1][1] <= max_gap*nb_sec:
+            spans[-1][1] = max(spans[-1][1], date + nb_sec)
+        else:
+            spans.append([date, date + nb_sec])
+    return [tuple(span) for span in spans]
+
+
+def event_magnitude(event):
+    return (event.preferred_magnitude() or event.magnitudes[0]).mag
+
+
+def event_origin(event):
+    return event.preferred_origin() or event.origins[0]
+
+
+def match_events(entries, events, mag_tolerance = mag_tolerance):
+    """Match each (line, date, magnitude) entry with the events of its day of
+    similar magnitude.
+
+    Returns the dictionnaries line -> event of the matched lines and
+    line -> candidate events of the unmatched (no candidate) and ambiguous
+    (several candidates) lines.
+    """
+
+    events_by_day = {}
+    for event in events:
+        events_by_day.setdefault(event_origin(event).time.date, []).append(event)
+
+    matched, unmatched = {}, {}
+    for line,date,mag in entries:
+        candidates = [e for e in events_by_day.get(date.date, []) if abs(event_magnitude(e) - mag) <= mag_tolerance + 1e-6]
+        if len(candidates) == 1:
+            matched[line] = candidates[0]
+        else:
+            unmatched[line] = candidates
+
+    return matched, unmatched
+
+
+def get_stations_inventory(starttime, endtime, client = "IRIS"):
+    """Stations (station level) active at some point of the time span."""
+    return Client(client).get_stations(channel=channels, starttime=starttime, endtime=endtime, level="station")
+
+
+def select_stations(inventory, event):
+    """Stations of the inventory recording the event, in its distance and azimuth domain."""
+
+    origin = event_origin(event)
+    starttime = origin.time + tmin_after_event
+    endtime = origin.time + tmax_after_event
+
+    domain = DistanceAzimuthDomain(
+        lat_center  = origin.latitude,
+        lon_center  = origin.longitude,
+        lat_pivot   = lat_pivot,
+        lon_pivot   = lon_pivot,
+        dmin        = dmin,
+        dmax        = dmax,
+        azmin       = azmin,
+        azmax       = azmax,
+    )
+
+    candidates = [
+        (nw.code, st) for nw in inventory.networks for st in nw.stations
+        if (st.start_date is None or st.start_date <= starttime) and (st.end_date is None or st.end_date >= endtime)]
+
+    # distance selection done at once for all the stations
+    lats = np.array([st.latitude for _,st in candidates])
+    lons = np.array([st.longitude for _,st in candidates])
+    dist,_,_ = distance_azimuth(lats, lons, origin.latitude, origin.longitude)
+
+    stations = MyInventory()
+    for (nw_code,st),d in zip(candidates, dist):
+        if dmin <= d <= dmax and domain.is_in_domain(st.latitude, st.longitude):
+            stations.append(MyStation(st.code, nw_code, st.latitude, st.longitude))
+    return stations
+
+
+def resolve_events(lines, base_dir, catalog = catalog, catalog_cache = catalog_cache_file, overwrite = False):
+    """Write the CMTSOLUTION and receivers files of all the lines of an events
+    list. Lines whose files already exist are skipped (unless overwrite).
+
+    Returns the list of the lines not resolved.
+    """
+
+    os.makedirs(os.path.join(base_dir, events_dir), exist_ok=True)
+    os.makedirs(os.path.join(base_dir, stations_dir), exist_ok=True)
+
+    def event_files(line):
+        event_id,_ = get_event_ids(line)
+        return os.path.join(base_dir, events_dir, f"{event_id}.cmtsolution"), os.path.join(base_dir, stations_dir, f"{event_id}_receivers.dat")
+
+    entries = [
+        entry for entry in parse_events_list(lines)
+        if overwrite or not all(os.path.exists(f) for f in event_files(entry[0]))]
+
+    print(f"{len(lines)} events, {len(lines) - len(entries)} already resolved")
+    if not entries:
+        return []
+
+    # 1. events (one catalog request per time span)
+
+    Mw_min = min(mag for _,_,mag in entries) - mag_tolerance
+    spans = time_spans([date for _,date,_ in entries], max_gaps[catalog])
+
+    print(f">> Requesting the {catalog} catalog over {len(spans)} time span(s)")
+
+    cache = CatalogCache(catalog_cache)
+    events = []
+    for starttime,endtime in spans:
+        events += cache.get_events(catalog, starttime, endtime, Mw_min, fetch=fetch_functions[catalog])
+    cache.close()
+
+    matched, unmatched = match_events(entries, events)
+
+    # 2. stations (one station request)
+
+    if matched:
+
+        times = [event_origin(event).time for event in matched.values()]
+        print(">> Requesting the stations")
+        inventory = get_stations_inventory(min(times) + tmin_after_event, max(times) + tmax_after_event)
+
+    # 3. writing the files
+
+    failed = []
+    for line,event in matched.items():
+
+        cmt_file, receivers_file = event_files(line)
+
+        try:
+            event.write(cmt_file, format="CMTSOLUTION")
+        except Exception as e:
+            print(f"Error, unable to write the CMTSOLUTION of {line.strip()} : {e}")
+            failed.append(line)
+            continue
+
+        stations = select_stations(inventory, event)
+        stations.write(receivers_file)
+        print(f"{line.strip():<20} -> {event_origin(event).time} Mw {event_magnitude(event):.2f}, {stations.len()} stations")
+
+    # 4. report
+
+    for line,candidates in unmatched.items():
+        if candidates:
+            print(f"Ambiguous : {line.strip()}, {len(candidates)} events :")
+            for event in candidates:
+                print(f"    {event_origin(event).time} Mw {event_magnitude(event):.2f} ({event_origin(event).latitude:.2f}, {event_origin(event).longitude:.2f})")
+        else:
+            print(f"Unmatched : {line.strip()}")
+
+    print(f"{len(matched) - len(failed)} events resolved, {len([c for c in unmatched.values() if not c])} unmatched, {len([c for c in unmatched.values() if c])} ambiguous, {len(failed)} failed")
+
+    return list(unmatched) + failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-i",dest='in_file', type=str, default=in_file, help='events list (date magnitude)')
+
+    parser.add_argument("-c",dest='catalog', type=str, default=catalog, choices=list(fetch_functions), help='catalog')
+
+    parser.add_argument("--catalog-cache", dest='catalog_cache', type=str, default=catalog_cache_file, help='local catalog store')
+
+    parser.add_argument("-f",dest='overwrite', action='store_true', help='resolve again the events already resolved')
+
+    args = parser.parse_args()
+
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+
+    with open(os.path.join(cur_dir, args.in_file), "r") as f:
+        date_mag = f.readlines()
+
+    lines = [line for line in date_mag[1:] if line.strip()]
+
+    resolve_events(lines, cur_dir, args.catalog, args.catalog_cache, args.overwrite)
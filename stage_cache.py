@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Content-addressed cache of the intermediate products of the processing stages
+of mseed2obspy_stream (ingest + metadata, resample, rotate, filter).
+
+Each product is stored (pickled) under a key hashing its inputs and the
+parameters of its stage : the key of a stage is computed from the key of the
+previous one, so a product is reused only if all the stages before it were
+done on the same data with the same parameters. A rerun restarts from the last
+stage found in the cache.
+
+The cache is bounded in size : the least recently used products are evicted
+first (the modification time of a file being updated when it is read).
+
+Usage : python stage_cache.py stage_cache [--max-size 5] [--clear]
+    prints the content of a cache directory (and evicts / clears it)
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import argparse
+
+
+#-------------------------
+# configuration
+
+cache_ext = ".pkl"
+
+max_size = 20e9 # bytes
+
+#-------------------------
+
+
+def stage_key(*parts):
+    """Key (sha256) of a stage product, from the key of its input and the
+    parameters of the stage (json serializable, or converted to strings)."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageCache:
+
+    def __init__(self, cache_dir, max_size = max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + cache_ext)
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def get(self, key):
+        """Product of a key, None if not in the cache."""
+        filename = self._file(key)
+        try:
+            with open(filename, "rb") as f:
+                product = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # most recently used
+        os.utime(filename)
+        return product
+
+    def put(self, key, product):
+        """Store a product, evicting the least recently used ones if the cache
+        is too large."""
+        filename = self._file(key)
+        tmp_file = filename + f".{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(product, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, filename)
+        self.evict(keep = key)
+
+    def entries(self):
+        """List of the (modification time, size, file) of the products, least
+        recently used first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(cache_ext):
+                continue
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, filename))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _,size,_ in self.entries())
+
+    def evict(self, keep = None):
+        """Remove the least recently used products until the cache fits in
+        max_size (the product of the key keep excepted), return the number of
+        products removed."""
+
+        entries = self.entries()
+        total = sum(size for _,size,_ in entries)
+        n = 0
+        for _,size,filename in entries:
+            if total <= self.max_size:
+                break
+            if keep and filename == self._file(keep):
+                continue
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+            n += 1
+        return n
+
+    def clear(self):
+        for _,_,filename in self.entries():
+            os.remove(filename)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("cache_dir", type=str, help='stage cache directory')
+
+    parser.add_argument("--max-size", dest='max_size', type=float, default=None, help='evict the least recently used products above this size (GB)')
+
+    parser.add_argument("--clear", dest='clear', action='store_true', help='remove all the products')
+
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache_dir)
+
+    if args.clear:
+        cache.clear()
+    elif args.max_size is not None:
+        cache.max_size = args.max_size * 1e9
+        print(f"{cache.evict()} products evicted")
+
+    entries = cache.entries()
+    print(f"{args.cache_dir} : {len(entries)} products, {sum(size for _,size,_ in entries)/1e9:.2f} GB")
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Station coordinates index : the coordinates (and orientation) of the channels
+of StationXML files, indexed by channel id, without parsing the instrument
+responses into an obspy Inventory.
+
+The index is saved next to the stations directory (stations.coordinates.json)
+with the size and modification time of each file : on later runs only the new
+or modified files are parsed again.
+
+Usage : python station_coordinates.py event_dir/stations
+    builds (or updates) the index of a stations directory
+"""
+
+import os
+import json
+import argparse
+from glob import glob
+import xml.etree.ElementTree as ET
+
+from obspy import UTCDateTime
+
+
+#-------------------------
+# configuration
+
+index_ext = ".coordinates.json"
+
+#-------------------------
+
+
+def _tag(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def _child_float(element, name, default = None):
+    for child in element:
+        if _tag(child) == name and child.text:
+            return float(child.text)
+    return default
+
+
+def parse_stationxml(filename):
+    """Stations and channels of a StationXML file.
+
+    Returns the list of the networks (number of network elements), the list of
+    the stations [nw, sta, lat, lon] and the dictionnary channel id -> list of
+    epochs [lat, lon, elevation, depth, azimuth, dip, start, end].
+    """
+
+    n_networks = 0
+    stations = []
+    channels = {}
+    nw_code, st_code = None, None
+
+    for event,element in ET.iterparse(filename, events=("start", "end")):
+
+        tag = _tag(element)
+
+        if event == "start":
+            if tag == "Network":
+                nw_code = element.get("code")
+                n_networks += 1
+            elif tag == "Station":
+                st_code = element.get("code")
+            continue
+
+        if tag == "Channel":
+            channel_id = f"{nw_code}.{st_code}.{element.get('locationCode', '')}.{element.get('code')}"
+            channels.setdefault(channel_id, []).append([
+                _child_float(element, "Latitude"), _child_float(element, "Longitude"),
+                _child_float(element, "Elevation"), _child_float(element, "Depth", 0.),
+                _child_float(element, "Azimuth"), _child_float(element, "Dip"),
+                element.get("startDate"), element.get("endDate")])
+            # the responses are not kept
+            element.clear()
+
+        elif tag == "Station":
+            stations.append([nw_code, st_code, _child_float(element, "Latitude"), _child_float(element, "Longitude")])
+            element.clear()
+
+    return n_networks, stations, channels
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class StationCoordinates:
+
+    def __init__(self, files = None, index_file = None):
+        """Coordinates of the channels of a list of StationXML files, the
+        index being read from and saved to index_file if given."""
+
+        self.index_file = index_file
+        self.files = {}
+
+        if index_file and os.path.exists(index_file):
+            with open(index_file) as f:
+                self.files = json.load(f)
+
+        if files is not None:
+            self.update(files)
+
+    @classmethod
+    def from_directory(cls, stations_dir, extra_files = []):
+        """Index of the StationXML files of a directory (saved next to it)."""
+        files = sorted(glob(os.path.join(stations_dir, "*"))) + list(extra_files)
+        return cls(files, os.path.normpath(stations_dir) + index_ext)
+
+    def update(self, files):
+        """Parse the new or modified files, forget the removed ones, and save
+        the index if modified."""
+
+        files = [os.path.abspath(f) for f in files]
+        modified = set(self.files) - set(files)
+
+        for f in set(self.files) - set(files):
+            del self.files[f]
+
+        for f in files:
+            signature = file_signature(f)
+            if f in self.files and self.files[f]["signature"] == signature:
+                continue
+            n_networks, stations, channels = parse_stationxml(f)
+            self.files[f] = {"signature" : signature, "networks" : n_networks, "stations" : stations, "channels" : channels}
+            modified.add(f)
+
+        self.order = files
+        self._channels = {}
+        for f in files:
+            for channel_id,epochs in self.files[f]["channels"].items():
+                self._channels.setdefault(channel_id, []).extend(epochs)
+
+        if modified and self.index_file:
+            tmp_file = self.index_file + f".{os.getpid()}.tmp"
+            with open(tmp_file, "w") as out:
+                json.dump(self.files, out)
+            os.replace(tmp_file, self.index_file)
+
+        return len(modified)
+
+    def __len__(self):
+        """Number of networks (as the length of an obspy Inventory)."""
+        return sum(self.files[f]["networks"] for f in self.order)
+
+    def stations(self):
+        """List of the stations (nw, sta, lat, lon), in the files order."""
+        return [station for f in self.order for station in self.files[f]["stations"]]
+
+    def _epoch(self, seed_id, datetime = None):
+        epochs = self._channels.get(seed_id)
+        if not epochs:
+            raise KeyError(f"No matching channel metadata found for {seed_id}")
+        if datetime is not None:
+            epochs = [
+                e for e in epochs
+                if (e[6] is None or UTCDateTime(e[6]) <= datetime) and (e[7] is None or UTCDateTime(e[7]) >= datetime)]
+            if not epochs:
+                raise KeyError(f"No matching channel metadata found for {seed_id} at {datetime}")
+        return epochs[0]
+
+    def get_coordinates(self, seed_id, datetime = None):
+        """Coordinates of a channel (as obspy Inventory.get_coordinates)."""
+        lat, lon, elevation, depth = self._epoch(seed_id, datetime)[:4]
+        return {"latitude" : lat, "longitude" : lon, "elevation" : elevation, "local_depth" : depth}
+
+    def get_orientation(self, seed_id, datetime = None):
+        """Orientation of a channel (as obspy Inventory.get_orientation)."""
+        azimuth, dip = self._epoch(seed_id, datetime)[4:6]
+        return {"azimuth" : azimuth, "dip" : dip}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("stations_dirs", type=str, nargs="+", help='stations directories')
+
+    args = parser.parse_args()
+
+    for stations_dir in args.stations_dirs:
+        coordinates = StationCoordinates.from_directory(stations_dir)
+        print(f"{coordinates.index_file} : {len(coordinates.stations())} stations, {len(coordinates._channels)} channels")
@@ -7,6 +7,7 @@ Created on Tue Jun 21 2022
 
 # imports
 
+import numpy as np
 import pandas as pd
 
 import matplotlib.pyplot as plt
@@ -14,6 +15,8 @@ import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 import shapely.geometry as sgeom
 
+from geodesy import distance_azimuth, distance_azimuth_table
+
 # to have better defined great circles
 # https://stackoverflow.com/questions/40270990/cartopy-higher-resolution-for-great-circle-distance-line
 class LowerThresholdOthographic(ccrs.Orthographic):
@@ -70,6 +73,20 @@ class MyInventory:
     def nb_networks(self):
         return self.stations["nw"].drop_duplicates().shape[0]
     
+    def distance_azimuth(self, ev_lat, ev_lon):
+        """Add the distance, azimuth and back azimuth columns (dist, az, baz)
+        of the stations from an event (or arrays of shape (n_events, n_stations)
+        returned for several events)"""
+
+        if np.ndim(ev_lat) > 0:
+            return distance_azimuth_table(self.stations["lat"], self.stations["lon"], ev_lat, ev_lon)
+
+        dist, az, baz = distance_azimuth(self.stations["lat"], self.stations["lon"], ev_lat, ev_lon)
+        self.stations["dist"] = dist
+        self.stations["az"] = az
+        self.stations["baz"] = baz
+        return dist, az, baz
+
     def write(self, out_file = "receivers.dat",n_char_stn=5, pad=False):
         """Write to receivers.dat file"""
 
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+StationXML cache shared by all the events of a campaign, so that the metadata
+of a station is downloaded once and not for every event.
+
+The files are stored by content (objects/<sha256>.xml, identical files are
+stored once) and indexed (index.json) by network.station, the time span
+covered by all their channels and the list of their channels (a file is used
+only if it has the channels needed). The least recently used files (time of
+the last use being the access time of the file) are evicted when the cache
+exceeds max_size.
+
+The index is read without lock, and written (under lock) only when files are
+added, once for all the files of a download attempt (store_many).
+
+Files are hard linked (not copied) between the cache and the event stations/
+directories. As a file of stations/ can be overwritten in place by the
+MassDownloader, a cached file is used only if its size and modification time
+are the ones recorded when stored (its content being checked against its hash
+otherwise).
+
+Usage : python stationxml_cache.py cache_dir [--add stations_dir ...]
+    prints the content of the cache (after adding the files of stations_dir)
+"""
+
+import os
+import json
+import time
+import shutil
+import fcntl
+import hashlib
+import argparse
+from contextlib import contextmanager
+import xml.etree.ElementTree as ET
+
+from obspy import UTCDateTime
+
+
+#-------------------------
+# configuration
+
+# maximum size of the cache (bytes)
+max_size = 5e9
+
+#-------------------------
+
+
+def stationxml_content(filename):
+    """Time span covered by all the channels of a StationXML file (start, end),
+    None for open ends, and the sorted list of its channels "LOC.CHA"."""
+
+    start, end = None, None
+    channels = set()
+    for _,element in ET.iterparse(filename):
+        if element.tag.endswith("}Channel"):
+            channels.add(f"{element.get('locationCode', '')}.{element.get('code')}")
+            cha_start = element.get("startDate")
+            cha_end = element.get("endDate")
+            if cha_start and (start is None or UTCDateTime(cha_start) > start):
+                start = UTCDateTime(cha_start)
+            if cha_end and (end is None or UTCDateTime(cha_end) < end):
+                end = UTCDateTime(cha_end)
+            element.clear()
+    return (str(start) if start else None), (str(end) if end else None), sorted(channels)
+
+
+def waveform_channels(filenames):
+    """Channels "LOC.CHA" of waveform files (NET.STA.LOC.CHA__...)."""
+    return sorted(set(".".join(os.path.basename(f).split("__")[0].split(".")[2:4]) for f in filenames))
+
+
+def has_channels(filename, channels):
+    """True if a StationXML file has all the channels "LOC.CHA" of a list."""
+    return set(channels) <= set(stationxml_content(filename)[2])
+
+
+def file_hash(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hard link (no additional disk space) or copy if not possible."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+class StationXMLCache:
+
+    def __init__(self, cache_dir, max_size = max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_file = os.path.join(cache_dir, "index.json")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    @contextmanager
+    def _index(self):
+        """Index locked (against other processes) while being read and modified."""
+        with open(os.path.join(self.cache_dir, "index.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = {}
+            if os.path.exists(self.index_file):
+                with open(self.index_file) as f:
+                    index = json.load(f)
+            yield index
+            tmp_file = self.index_file + f".{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(index, f, indent=1)
+            os.replace(tmp_file, self.index_file)
+
+    def _read_index(self):
+        """Index, without lock (replaced atomically when written)."""
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _last_used(self, entry):
+        try:
+            return max(entry["last_used"], os.stat(self._object_file(entry["hash"])).st_atime)
+        except FileNotFoundError:
+            return entry["last_used"]
+
+    def _unchanged(self, entry):
+        """True if the file of an entry exists and was not modified (through a
+        hard link) since stored."""
+        object_file = self._object_file(entry["hash"])
+        try:
+            stat = os.stat(object_file)
+        except FileNotFoundError:
+            return False
+        if [stat.st_size, stat.st_mtime_ns] == [entry["size"], entry.get("mtime_ns")]:
+            return True
+        return file_hash(object_file) == entry["hash"]
+
+    def _object_file(self, sha):
+        return os.path.join(self.objects_dir, f"{sha}.xml")
+
+    def lookup(self, nw_code, st_code, starttime, endtime, channels = None):
+        """Cached StationXML file of a station covering [starttime, endtime],
+        with the channels "LOC.CHA" of the list channels if given, None if
+        there is none."""
+
+        for entry in self._read_index().get(f"{nw_code}.{st_code}", []):
+            if entry["start"] and UTCDateTime(entry["start"]) > starttime:
+                continue
+            if entry["end"] and UTCDateTime(entry["end"]) < endtime:
+                continue
+            if channels and not set(channels) <= set(entry.get("channels", [])):
+                continue
+            if not self._unchanged(entry):
+                # missing (entry removed on the next store) or modified through a hard link
+                continue
+            # last use (access time, the modification time being checked)
+            object_file = self._object_file(entry["hash"])
+            os.utime(object_file, ns = (time.time_ns(), os.stat(object_file).st_mtime_ns))
+            return object_file
+        return None
+
+    def store(self, nw_code, st_code, filename):
+        """Add a StationXML file of a station to the cache."""
+        self.store_many([(nw_code, st_code, filename)])
+
+    def store_many(self, files):
+        """Add StationXML files of stations (list of (network, station, file))
+        to the cache, the index being updated once."""
+
+        new_entries = []
+        for nw_code,st_code,filename in files:
+            sha = file_hash(filename)
+            start, end, channels = stationxml_content(filename)
+            object_file = self._object_file(sha)
+            if not os.path.exists(object_file) or os.path.getsize(object_file) != os.path.getsize(filename):
+                tmp_file = object_file + f".{os.getpid()}.tmp"
+                link_or_copy(filename, tmp_file)
+                os.replace(tmp_file, object_file)
+            stat = os.stat(object_file)
+            new_entries.append((f"{nw_code}.{st_code}", {"hash" : sha, "start" : start, "end" : end, "channels" : channels, "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns, "last_used" : time.time()}))
+
+        if not new_entries:
+            return
+
+        with self._index() as index:
+            for station_id,new_entry in new_entries:
+                entries = index.setdefault(station_id, [])
+                for entry in entries:
+                    if entry["hash"] == new_entry["hash"]:
+                        entry.update(new_entry)
+                        break
+                else:
+                    entries.append(new_entry)
+            # entries of the files missing
+            objects = set(os.listdir(self.objects_dir))
+            for station_id,station_entries in list(index.items()):
+                station_entries[:] = [e for e in station_entries if f"{e['hash']}.xml" in objects]
+                if not station_entries:
+                    del index[station_id]
+            self._evict(index)
+
+    def _evict(self, index):
+        """Remove the least recently used files until the cache fits in max_size."""
+
+        # (times of last use read only if needed)
+        if sum({entry["hash"] : entry["size"] for station_entries in index.values() for entry in station_entries}.values()) <= self.max_size:
+            return
+
+        entries = sorted(
+            ((self._last_used(entry), station_id, entry) for station_id,station_entries in index.items() for entry in station_entries),
+            key = lambda x: x[0])
+
+        sizes = {entry["hash"] : entry["size"] for _,_,entry in entries}
+        total_size = sum(sizes.values())
+
+        for _,station_id,entry in entries:
+            if total_size <= self.max_size:
+                break
+            index[station_id].remove(entry)
+            if not index[station_id]:
+                del index[station_id]
+            # the file can be shared with other stations entries
+            if not any(e["hash"] == entry["hash"] for station_entries in index.values() for e in station_entries):
+                if os.path.exists(self._object_file(entry["hash"])):
+                    os.remove(self._object_file(entry["hash"]))
+                total_size -= entry["size"]
+
+    def fill(self, station_codes, stations_dir, starttime, endtime, wf_dir = None):
+        """Put in stations_dir (NET.STA.xml) the cached files of the stations
+        covering the time window (and with the channels of the waveform files
+        of the station already in wf_dir), return the list of stations found.
+
+        The channels of the waveforms downloaded afterwards are to be checked
+        (see has_channels), the cached file being replaced if some are missing.
+        """
+
+        os.makedirs(stations_dir, exist_ok=True)
+        wf_files = os.listdir(wf_dir) if wf_dir and os.path.isdir(wf_dir) else []
+        found = []
+        for nw_code,st_code in station_codes:
+            filename = os.path.join(stations_dir, f"{nw_code}.{st_code}.xml")
+            if os.path.exists(filename):
+                continue
+            channels = waveform_channels([f for f in wf_files if f.startswith(f"{nw_code}.{st_code}.")])
+            cached_file = self.lookup(nw_code, st_code, starttime, endtime, channels)
+            if cached_file:
+                link_or_copy(cached_file, filename)
+                found.append((nw_code, st_code))
+        return found
+
+    def add_directory(self, stations_dir):
+        """Add all the StationXML files (NET.STA.xml) of a directory."""
+        if not os.path.isdir(stations_dir):
+            return
+        files = []
+        for f in os.listdir(stations_dir):
+            if f.endswith(".xml"):
+                nw_code, st_code, _ = f.split(".")
+                files.append((nw_code, st_code, os.path.join(stations_dir, f)))
+        self.store_many(files)
+
+    def report(self):
+        index = self._read_index()
+        n_entries = sum(len(entries) for entries in index.values())
+        sizes = {entry["hash"] : entry["size"] for entries in index.values() for entry in entries}
+        print(f"{self.cache_dir} : {len(index)} stations, {n_entries} entries, {len(sizes)} files, {sum(sizes.values())/1e6:.1f} MB (max {self.max_size/1e6:.0f} MB)")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("cache_dir", type=str, help='cache directory')
+
+    parser.add_argument("--add", dest='stations_dirs', type=str, nargs="+", default=[], help='stations directories to add to the cache')
+
+    args = parser.parse_args()
+
+    cache = StationXMLCache(args.cache_dir)
+
+    for stations_dir in args.stations_dirs:
+        cache.add_directory(stations_dir)
+
+    cache.report()
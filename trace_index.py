@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Campaign-wide index (SQLite) of the metadata of the traces of all the processed
+events (event, origin, station, component, distance, azimuth, back azimuth,
+sampling rate, period band of the filtering, QC tag, and the file and position
+of the trace), registered by mseed2obspy_stream.
+
+Traces can then be selected over all the events without reading the stream
+files, and only the selected traces loaded.
+
+The locking of SQLite being unreliable on network file systems (NFS), an index
+must not be written by several nodes at once : download_all_events registers
+the traces of each event in an index of the event directory, merged into the
+campaign index by a single process (at the end of the run, or with
+--merge-index in queue mode).
+
+Usage : python trace_index.py traces_index.sqlite --add obspy_pkl_data/*.pkl
+    registers already processed files
+        python trace_index.py traces_index.sqlite --merge mseed_data/*/traces_index.sqlite
+    merges the indexes of the events
+        python trace_index.py traces_index.sqlite -c T --dist 95 120 --az -40 40
+    prints a selection of the traces
+"""
+
+import os
+import re
+import sqlite3
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from obspy import read, Stream, UTCDateTime
+from geodesy import distance_azimuth
+from columnar_stream import ColumnarStream
+
+
+#-------------------------
+# configuration
+
+trace_index_file = "traces_index.sqlite"
+
+#-------------------------
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS traces (
+    event TEXT, file TEXT, position INTEGER,
+    id TEXT, network TEXT, station TEXT, location TEXT, channel TEXT, component TEXT,
+    latitude REAL, longitude REAL,
+    evla REAL, evlo REAL, evde REAL, origin_time TEXT,
+    distance REAL, azimuth REAL, back_azimuth REAL,
+    sampling_rate REAL, npts INTEGER, qc TEXT, band TEXT);
+CREATE INDEX IF NOT EXISTS traces_file ON traces (file);
+CREATE INDEX IF NOT EXISTS traces_component_distance ON traces (component, distance);
+CREATE INDEX IF NOT EXISTS traces_azimuth ON traces (azimuth);
+CREATE INDEX IF NOT EXISTS traces_station ON traces (network, station);
+CREATE INDEX IF NOT EXISTS traces_event ON traces (event);
+"""
+
+# columns added since the first version of the schema
+added_columns = (("qc", "TEXT"), ("band", "TEXT"))
+
+
+def event_id_from_file(filename):
+    """Event id and period band ("TMIN-TMAX" in s, None for the default band)
+    of an output file of mseed2obspy_stream (<event>[_<TMIN>-<TMAX>s].ext)."""
+    name = os.path.splitext(os.path.basename(os.path.normpath(filename)))[0]
+    match = re.fullmatch(r"(.+)_([0-9.]+-[0-9.]+)s", name)
+    return (match.group(1), match.group(2)) if match else (name, None)
+
+
+def read_stream_file(filename):
+    """Stream of a PICKLE file or columnar directory."""
+    if os.path.isdir(filename):
+        return ColumnarStream(filename).to_stream()
+    return read(filename, format="PICKLE")
+
+
+class TraceIndex:
+
+    def __init__(self, filename = trace_index_file):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.executescript(schema)
+        # (indexes written before the columns were added)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(traces)")]
+        for column,column_type in added_columns:
+            if column not in columns:
+                with self.db:
+                    self.db.execute(f"ALTER TABLE traces ADD COLUMN {column} {column_type}")
+
+    def close(self):
+        self.db.close()
+
+    def unregister(self, out_file):
+        with self.db:
+            self.db.execute("DELETE FROM traces WHERE file = ?", (os.path.abspath(out_file),))
+
+    def register(self, st, out_file, event_id = None, first_position = 0, replace = True, band = None):
+        """Register (replacing the previous registration of the file) the
+        traces of a processed stream (or ColumnarStream) written in out_file.
+
+        event_id, band : event id and period band ("TMIN-TMAX" in s), from the
+            file name if not given (see event_id_from_file)
+        first_position, replace : to register a stream written in several
+            batches (position of its first trace in the file, and replace=False)
+        """
+
+        out_file = os.path.abspath(out_file)
+        if event_id is None:
+            event_id, file_band = event_id_from_file(out_file)
+            band = band or file_band
+
+        # (id, network, station, location, channel, lat, lon, evla, evlo, evde, origin time, distance, back azimuth, sampling rate, npts, qc)
+        if isinstance(st, ColumnarStream):
+            ev = st.event
+            origin_time = str(UTCDateTime(ns = ev["event_origin_time"]))
+            tagged = "qc" in st.traces.columns
+            traces = [
+                (row.id, row.network, row.station, row.location, row.channel,
+                 row.latitude, row.longitude, ev["evla"], ev["evlo"], ev["evde"], origin_time,
+                 row.distance, row.back_azimuth, ev["sampling_rate"], int(row.npts), row.qc if tagged else None)
+                for row in st.traces.itertuples()]
+        else:
+            traces = [
+                (tr.id, tr.stats.network, tr.stats.station, tr.stats.location, tr.stats.channel,
+                 tr.stats.coordinates["latitude"], tr.stats.coordinates["longitude"], tr.stats.evla, tr.stats.evlo, tr.stats.evde, str(tr.stats.event_origin_time),
+                 tr.stats.distance, tr.stats.back_azimuth, tr.stats.sampling_rate, tr.stats.npts, tr.stats.get("qc"))
+                for tr in st]
+
+        _, azimuths, _ = distance_azimuth(
+            [t[5] for t in traces], [t[6] for t in traces], [t[7] for t in traces], [t[8] for t in traces])
+
+        rows = []
+        for position,(t,az) in enumerate(zip(traces, azimuths), first_position):
+            rows.append((
+                event_id, out_file, position,
+                *t[:5], t[4][-1],
+                *t[5:12], float(az), *t[12:], band))
+
+        if replace:
+            self.unregister(out_file)
+
+        with self.db:
+            self.db.executemany(f"INSERT INTO traces VALUES ({','.join('?'*22)})", rows)
+
+        return len(rows)
+
+    def merge(self, filename):
+        """Register the traces of another index (e.g. of an event), replacing
+        the previous registration of its files, return the number of traces."""
+
+        # (columns of the other index updated)
+        TraceIndex(filename).close()
+        self.db.execute("ATTACH DATABASE ? AS other", (filename,))
+        try:
+            with self.db:
+                self.db.execute("DELETE FROM traces WHERE file IN (SELECT DISTINCT file FROM other.traces)")
+                n = self.db.execute("INSERT INTO traces SELECT * FROM other.traces").rowcount
+        finally:
+            self.db.execute("DETACH DATABASE other")
+        return n
+
+    def register_file(self, filename, event_id = None):
+        """Register the traces of an already written stream file (PICKLE or columnar)."""
+        return self.register(read_stream_file(filename), filename, event_id)
+
+    def query(self, component = None, dmin = None, dmax = None, azmin = None, azmax = None,
+              bazmin = None, bazmax = None, event = None, network = None, station = None, passed = None, band = None):
+        """Traces matching the conditions (pandas DataFrame). The azimuth
+        windows can cross north (e.g. azmin = -40, azmax = 40).
+
+        passed : traces passing (True) or failing (False) the quality control
+            (QC tags, see trace_qc.py), the traces without QC passing
+        band : period band ("TMIN-TMAX" in s) of the filtering
+        """
+
+        conditions, params = [], []
+
+        def add(condition, *values):
+            conditions.append(condition)
+            params.extend(values)
+
+        for column,value in (("component", component), ("event", event), ("network", network), ("station", station), ("band", band)):
+            if value is not None:
+                add(f"{column} = ?", value)
+        if passed is not None:
+            add("(qc IS NULL OR qc = '')" if passed else "qc != ''")
+        if dmin is not None:
+            add("distance >= ?", dmin)
+        if dmax is not None:
+            add("distance <= ?", dmax)
+
+        for column,amin,amax in (("azimuth", azmin, azmax), ("back_azimuth", bazmin, bazmax)):
+            if amin is None or amax is None:
+                continue
+            amin, amax = amin % 360., amax % 360.
+            if amin <= amax:
+                add(f"{column} BETWEEN ? AND ?", amin, amax)
+            else:
+                add(f"({column} >= ? OR {column} <= ?)", amin, amax)
+
+        where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+        return pd.read_sql_query(f"SELECT * FROM traces{where} ORDER BY event, distance", self.db, params=params)
+
+    def events(self):
+        return pd.read_sql_query("SELECT event, GROUP_CONCAT(DISTINCT band) AS bands, COUNT(DISTINCT file) AS files, COUNT(*) AS traces FROM traces GROUP BY event ORDER BY event", self.db)
+
+
+def load_traces(selection):
+    """Stream of the traces of a query result, only the selected traces
+    being read from the columnar files."""
+
+    st = Stream()
+    for filename,rows in selection.groupby("file", sort=False):
+        positions = rows["position"].values
+        if os.path.isdir(filename):
+            st += ColumnarStream(filename).to_stream(positions)
+        else:
+            traces = read(filename, format="PICKLE")
+            st += Stream([traces[i] for i in np.sort(positions)])
+    return st
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("db_file", type=str, help='trace index (sqlite file)')
+
+    parser.add_argument("--add", dest='files', type=str, nargs="+", default=[], help='stream files (PICKLE or columnar) to register')
+
+    parser.add_argument("--merge", dest='indexes', type=str, nargs="+", default=[], help='indexes (e.g. of the events) to merge')
+
+    parser.add_argument("-c",dest='component', type=str, default=None, help='component')
+
+    parser.add_argument("-e",dest='event', type=str, default=None, help='event id')
+
+    parser.add_argument("--dist", type=float, nargs=2, default=(None, None), help='distance range (°)')
+
+    parser.add_argument("--az", type=float, nargs=2, default=(None, None), help='azimuth range (°)')
+
+    parser.add_argument("--baz", type=float, nargs=2, default=(None, None), help='back azimuth range (°)')
+
+    parser.add_argument("--band", dest='band', type=str, default=None, help='period band of the filtering (TMIN-TMAX in s)')
+
+    parser.add_argument("--passed", dest='passed', action='store_const', const=True, default=None, help='only the traces passing the quality control')
+
+    args = parser.parse_args()
+
+    index = TraceIndex(args.db_file)
+
+    for f in args.files:
+        n = index.register_file(f)
+        print(f"{f} : {n} traces registered")
+
+    for f in args.indexes:
+        n = index.merge(f)
+        print(f"{f} : {n} traces merged")
+
+    if not args.files and not args.indexes:
+        selection = index.query(args.component, *args.dist, *args.az, *args.baz, event=args.event, passed=args.passed, band=args.band)
+        print(selection[["event", "band", "id", "distance", "azimuth", "back_azimuth"]].to_string(index=False))
+        print(f"{len(selection)} traces, {selection['event'].nunique()} events")
+
+    index.close()
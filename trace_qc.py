@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Quality control of the traces of an event, before the processing of
+mseed2obspy_stream (resampling, rotation, filtering) :
+    - signal to noise ratio, in the period band of the processing : RMS
+      amplitude in a window around the predicted S/Sdiff arrival over RMS
+      amplitude in a window before the first (P/Pdiff) arrival, or, for the
+      traces without data there (e.g. downloaded around S/Sdiff only, see
+      phase_windows.py), in the data before the signal window ; the SNR is
+      not tested without noise window, the traces without signal window (or
+      without arrival) failing ("no signal window")
+    - clipped traces : many samples at the maximum amplitude
+    - flat traces : most consecutive samples equal
+    - gappy traces : several segments, or covering only part of the time
+      window requested for the trace (of the event data if unknown)
+
+The measures are computed at once for the traces of the same sampling rate and
+length (cumulative sums of the stacked arrays, windows differing per trace).
+Failing traces are dropped, or tagged (stats.qc), and a report with one row
+per trace is written.
+
+Usage : python trace_qc.py -e event.xml -d event_dir
+    prints and writes the QC report of the data of an event
+"""
+
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from obspy.signal.filter import bandpass
+
+from travel_times import first_arrivals
+
+
+#-------------------------
+# configuration
+
+# noise window : noise_length seconds ending noise_margin seconds before the
+# first arrival of the noise phases
+noise_phases = ("P", "Pdiff")
+noise_length = 300.
+noise_margin = 20.
+
+# noise windows shorter than min_noise_length (s) : noise taken before the
+# signal window, the SNR not being tested if still shorter
+min_noise_length = 60.
+
+# signal window (s) around the first arrival of the signal phases
+signal_phases = ("S", "Sdiff")
+signal_window = (-20., 100.)
+
+# period band (s) of the SNR
+snr_band = (10., 20.)
+
+min_snr = 2.
+
+# clipped : at least clip_samples samples at the maximum amplitude
+clip_samples = 10
+
+# flat : at least flat_fraction of the consecutive samples equal
+flat_fraction = 0.5
+
+# gappy : several segments, or less than min_coverage of the time span of the event data
+min_coverage = 0.95
+
+# failing traces : "drop" or "tag" (reasons in stats.qc)
+qc_action = "drop"
+
+qc_report_filename = "qc_report.csv"
+
+#-------------------------
+
+
+def qc_parameters():
+    """Parameters of the quality control (part of the stage cache keys)."""
+    return [noise_phases, noise_length, noise_margin, min_noise_length, signal_phases, signal_window, snr_band, min_snr,
+            clip_samples, flat_fraction, min_coverage]
+
+
+def _window_rms(c1, c2, i0, i1):
+    """RMS amplitude (mean removed) of the rows between the indexes i0 and i1
+    (arrays, one per row), from the cumulative sums of the samples and of their
+    squares, NaN for empty windows."""
+    rows = np.arange(len(i0))
+    n = (i1 - i0).astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (c1[rows,i1] - c1[rows,i0]) / n
+        var = (c2[rows,i1] - c2[rows,i0]) / n - mean**2
+    return np.where(n > 0, np.sqrt(np.maximum(var, 0.)), np.nan)
+
+
+def trace_qc(st, windows = None):
+    """Quality control measures of the traces of a stream with the metadata of
+    mseed2obspy_stream (distance, event depth and origin time), as a table with
+    one row per trace, in the stream order.
+
+    windows : time window (UTCDateTime start, end) requested for each trace id
+        (see waveform_container.requested_windows), the coverage of the traces
+        without window being measured over the time span of all the traces
+    """
+
+    if len(st) == 0:
+        return pd.DataFrame()
+
+    stats = st[0].stats
+    origin_time = stats.event_origin_time
+    distances = np.array([tr.stats.distance for tr in st])
+    noise_arrivals = first_arrivals(distances, stats.evde, noise_phases)
+    signal_arrivals = first_arrivals(distances, stats.evde, signal_phases)
+
+    report = pd.DataFrame({
+        "id"            : [tr.id for tr in st],
+        "starttime"     : [str(tr.stats.starttime) for tr in st],
+        "npts"          : [tr.stats.npts for tr in st],
+        "sampling_rate" : [tr.stats.sampling_rate for tr in st],
+        "distance"      : distances,
+        "signal_arrival": signal_arrivals,
+    })
+    for column in ("noise_rms", "signal_rms"):
+        report[column] = np.nan
+    report["noise_window"] = ""
+    for column in ("clipped", "flat"):
+        report[column] = False
+
+    # traces of the same sampling rate and length stacked
+    groups = {}
+    for i,tr in enumerate(st):
+        groups.setdefault((tr.stats.sampling_rate, tr.stats.npts), []).append(i)
+
+    for (df,npts),positions in groups.items():
+
+        positions = np.array(positions)
+        data = np.array([st[i].data for i in positions], dtype=np.float64)
+        data -= data.mean(axis=1, keepdims=True)
+
+        amplitude = np.abs(data)
+        max_amplitude = amplitude.max(axis=1, keepdims=True)
+        n_at_max = (amplitude == max_amplitude).sum(axis=1)
+        report.loc[positions, "clipped"] = (max_amplitude[:,0] > 0) & (n_at_max >= clip_samples)
+        del amplitude
+
+        if npts > 1:
+            repeated = (np.diff(data, axis=1) == 0).mean(axis=1)
+            report.loc[positions, "flat"] = repeated >= flat_fraction
+        else:
+            report.loc[positions, "flat"] = True
+
+        # windows in samples, clipped to the traces
+        start = np.array([origin_time - st[i].stats.starttime for i in positions])
+        def index(t):
+            return np.clip(np.nan_to_num(np.round((start + t) * df), nan=0.).astype(int), 0, npts)
+        signal = index(signal_arrivals[positions] + signal_window[0]), index(signal_arrivals[positions] + signal_window[1])
+        no_arrival = np.isnan(signal_arrivals[positions])
+        signal[1][no_arrival] = signal[0][no_arrival]
+
+        # noise before P, else before the signal window (in the data)
+        min_noise = min_noise_length * df
+        noise_end = noise_arrivals[positions] - noise_margin
+        noise = index(noise_end - noise_length), index(noise_end)
+        before_p = noise[1] - noise[0] >= min_noise
+        before_signal = index(signal_arrivals[positions] + signal_window[0] - noise_margin - noise_length), index(signal_arrivals[positions] + signal_window[0] - noise_margin)
+        noise = np.where(before_p, noise[0], before_signal[0]), np.where(before_p, noise[1], before_signal[1])
+        no_noise = noise[1] - noise[0] < min_noise
+        noise[1][no_noise] = noise[0][no_noise]
+        report.loc[positions, "noise_window"] = np.where(before_p, "before P", np.where(no_noise, "", "before signal"))
+
+        data = bandpass(data, 1/snr_band[1], 1/snr_band[0], df, axis=-1)
+
+        c1 = np.zeros((len(positions), npts + 1))
+        c2 = np.zeros((len(positions), npts + 1))
+        np.cumsum(data, axis=1, out=c1[:,1:])
+        np.cumsum(data**2, axis=1, out=c2[:,1:])
+
+        report.loc[positions, "noise_rms"] = _window_rms(c1, c2, *noise)
+        report.loc[positions, "signal_rms"] = _window_rms(c1, c2, *signal)
+        del c1, c2
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        report["snr"] = report["signal_rms"] / report["noise_rms"]
+
+    # segments and coverage of the window requested for each trace (time span
+    # of all the traces if unknown)
+    windows = windows or {}
+    span = max(tr.stats.endtime for tr in st) - min(tr.stats.starttime for tr in st)
+    spans = pd.Series([windows[tr.id][1] - windows[tr.id][0] if tr.id in windows else span for tr in st])
+    durations = pd.Series([tr.stats.npts / tr.stats.sampling_rate for tr in st])
+    segments = report.groupby("id")["id"].transform("size")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        coverage = (durations.groupby(report["id"]).transform("sum") / spans).where(spans > 0, 1.)
+    report["gappy"] = (segments > 1) | (coverage < min_coverage)
+
+    reasons = []
+    for row in report.itertuples():
+        reason = []
+        if np.isnan(row.signal_rms): reason.append("no signal window")
+        if row.snr < min_snr: reason.append("low snr")
+        if row.clipped: reason.append("clipped")
+        if row.flat: reason.append("flat")
+        if row.gappy: reason.append("gappy")
+        reasons.append(", ".join(reason))
+    report["reason"] = reasons
+    report["passed"] = report["reason"] == ""
+
+    return report
+
+
+def apply_qc(st, action = qc_action, windows = None):
+    """Quality control of the traces of a stream : failing traces removed
+    (action "drop") or tagged (action "tag", reasons in stats.qc), in place.
+
+    windows : time window requested for each trace id (see trace_qc)
+
+    Returns the QC report (see trace_qc).
+    """
+
+    report = trace_qc(st, windows)
+    if len(report) == 0:
+        return report
+
+    if action == "drop":
+        st.traces = [tr for tr,passed in zip(st, report["passed"]) if passed]
+    else:
+        for tr,reason in zip(st, report["reason"]):
+            tr.stats.qc = reason
+
+    return report
+
+
+def write_report(reports, filename):
+    """Write the QC reports (list of tables, e.g. one per batch of stations)."""
+    report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame()
+    report.to_csv(filename, index=False, float_format="%.6g")
+    return report
+
+
+if __name__ == "__main__":
+
+    from obspy.core.event import read_events
+
+    import mseed2obspy_stream as m2o
+    from waveform_container import requested_windows
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-e",dest='event_file', type=str, help='obspy compatible event file', required=True)
+
+    parser.add_argument("-d",dest='event_dir', type=str, help='event data directory', default=".")
+
+    args = parser.parse_args()
+
+    origin = read_events(args.event_file)[0].preferred_origin()
+    event_wf_dir = os.path.join(args.event_dir, m2o.wf_dir)
+
+    stations = m2o.read_stations(os.path.join(args.event_dir, m2o.stations_dir), event_wf_dir, origin.time)
+    st, _ = m2o.read_waveforms(event_wf_dir)
+    m2o.add_metadata(st, stations, origin)
+
+    report = write_report([trace_qc(st, requested_windows(m2o.waveform_names(event_wf_dir)))], os.path.join(args.event_dir, qc_report_filename))
+
+    print(report[["id", "distance", "snr", "noise_window", "clipped", "flat", "gappy", "reason"]].to_string(index=False))
+    print(f"{report['passed'].sum()}/{len(report)} traces passed")
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Predicted arrival times (in seconds after the origin) of seismic phases at the
+stations of an event, with obspy TauP : the first arrival of a list of phases
+(e.g. S and Sdiff) for arrays of epicentral distances.
+
+The arrivals are read from travel-time tables : the first arrival of each
+phase computed once with TauP on a distance x depth grid for a 1-D model,
+saved on disk (table_dir) and reused by all the events and runs. The queries
+are answered for all the traces at once by bilinear interpolation of the first
+arrival of the phases at the grid nodes ; the queries in the cells at the edge
+of the distance range of the phases (a node without arrival), or out of the
+grid, are computed with TauP.
+
+A table is built once, before the runs, with --build (about 2 minutes for
+iasp91 with the default grid, one depth per worker with -j) : without table (or
+with a table of other phases or grids), the arrivals are computed with TauP,
+the processes never building it themselves. The tables are read from table_dir,
+by default in the source directory, or from the directory given by the
+TRAVEL_TIME_TABLES environment variable (e.g. a directory shared by the nodes).
+
+The accuracy of a table is checked against TauP at random points when built
+(maximum error printed and stored in the table) : with the default grid (1° x
+25 km, and the discontinuities of the model), below 0.03 s for S/Sdiff,
+sS/sSdiff and P/Pdiff beyond 30°, and 0.13 s over the whole grid (triplications
+of the first arrivals before 30°).
+
+Usage : python travel_times.py -z 534 --dist 70 120 --phases S Sdiff
+        python travel_times.py --build [-m iasp91] [-j 8] [--table-dir dir]
+            builds the table of a model (and prints its accuracy)
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from obspy.taup import TauPyModel
+
+
+#-------------------------
+# configuration
+
+model = "iasp91"
+
+# distances rounded (°) : one TauP computation per rounded distance (without table)
+distance_step = 0.1
+
+# travel-time tables : directory (TRAVEL_TIME_TABLES environment variable if
+# set), phases, distance and depth grids ((start, stop, step) in ° and km, the
+# depths of the discontinuities of the model being added to the depth grid)
+use_tables = True
+table_dir = os.environ.get("TRAVEL_TIME_TABLES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "travel_time_tables"))
+table_phases = ("P", "Pdiff", "S", "Sdiff", "sS", "sSdiff")
+table_distances = (0., 180., 1.)
+table_depths = (0., 700., 25.)
+
+# number of random points where a table is checked against TauP when built
+n_check = 200
+
+#-------------------------
+
+
+_models = {}
+_tables = {}
+
+
+def get_model(name = model):
+    if name not in _models:
+        _models[name] = TauPyModel(model = name)
+    return _models[name]
+
+
+def grid(start, stop, step):
+    return start + step * np.arange(int(round((stop - start) / step)) + 1)
+
+
+def table_grids(name = model, distances = table_distances, depths = table_depths):
+    """Distance and depth nodes of the table of a model : regular grids, with
+    the depths of the discontinuities of the model (kinks of the travel times
+    as functions of the depth)."""
+    discontinuities = get_model(name).model.s_mod.v_mod.get_discontinuity_depths()
+    discontinuities = discontinuities[(discontinuities > depths[0]) & (discontinuities < depths[1])]
+    return grid(*distances), np.union1d(grid(*depths), discontinuities)
+
+
+def taup_arrivals(distance, depth, phases, model = model):
+    """First arrival (s) of each phase at a distance (°) for a source depth
+    (km), NaN for the phases not arriving."""
+    times = dict.fromkeys(phases, np.nan)
+    for arrival in get_model(model).get_travel_times(source_depth_in_km=max(depth, 0.), distance_in_degree=distance, phase_list=list(phases)):
+        # (sorted by time)
+        if arrival.name in times and np.isnan(times[arrival.name]):
+            times[arrival.name] = arrival.time
+    return [times[phase] for phase in phases]
+
+
+def _depth_row(task):
+    """Worker : first arrivals of the phases at all the distances for a depth,
+    array (phase, distance)."""
+    depth, distances, phases, model = task
+    return np.array([taup_arrivals(dist, depth, phases, model) for dist in distances]).T
+
+
+class TravelTimeTable:
+
+    def __init__(self, model, phases, distances, depths, times, errors = None):
+        """times : first arrival of each phase, array (phase, depth, distance)
+        errors : maximum error of the interpolation of each phase (see check)"""
+        self.model = model
+        self.phases = tuple(phases)
+        self.distances = np.asarray(distances, dtype=float)
+        self.depths = np.asarray(depths, dtype=float)
+        self.times = times
+        self.errors = errors if errors is not None else np.full(len(self.phases), np.nan)
+        self._first = {}
+
+    @classmethod
+    def build(cls, model = model, phases = table_phases, max_workers = 1):
+        """Table computed with TauP on the nodes of table_grids, one depth per
+        task of the workers."""
+
+        distances, depths = table_grids(model)
+        tasks = [(depth, distances, phases, model) for depth in depths]
+        if max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                rows = list(pool.map(_depth_row, tasks))
+        else:
+            rows = [_depth_row(task) for task in tasks]
+
+        return cls(model, phases, distances, depths, np.stack(rows, axis=1))
+
+    @classmethod
+    def read(cls, filename):
+        with np.load(filename) as f:
+            return cls(str(f["model"]), [str(phase) for phase in f["phases"]], f["distances"], f["depths"], f["times"], f["errors"])
+
+    def write(self, filename):
+        tmp_file = filename + f".{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, model=self.model, phases=np.array(self.phases), distances=self.distances, depths=self.depths, times=self.times, errors=self.errors)
+        os.replace(tmp_file, filename)
+
+    def first_times(self, phases):
+        """First arrival of a list of phases at the grid nodes, array (depth,
+        distance)."""
+        phases = tuple(phases)
+        if phases not in self._first:
+            rows = [self.phases.index(phase) for phase in phases]
+            with np.errstate(all="ignore"):
+                # (nanmin warning on the nodes without arrival)
+                times = np.fmin.reduce(self.times[rows], axis=0)
+            self._first[phases] = times
+        return self._first[phases]
+
+    def interpolate(self, distances, depth, phases):
+        """First arrival of the phases at each distance (°) for a source depth
+        (km), by bilinear interpolation, NaN in the cells with a node without
+        arrival and out of the grid."""
+
+        distances = np.asarray(distances, dtype=float)
+        times = self.first_times(phases)
+
+        def cell(nodes, x):
+            i = np.clip(np.searchsorted(nodes, x, side="right") - 1, 0, len(nodes) - 2)
+            return i, (x - nodes[i]) / (nodes[i+1] - nodes[i])
+
+        i, u = cell(self.distances, np.nan_to_num(distances, nan=-1.))
+        j, v = cell(self.depths, np.array([depth], dtype=float))
+        j, v = j[0], v[0]
+
+        result = (
+            (1 - v) * ((1 - u) * times[j,i] + u * times[j,i+1]) +
+            v * ((1 - u) * times[j+1,i] + u * times[j+1,i+1]))
+
+        outside = (distances < self.distances[0]) | (distances > self.distances[-1]) | (depth < self.depths[0]) | (depth > self.depths[-1])
+        result[outside] = np.nan
+        return result
+
+    def check(self, n = n_check, seed = 0):
+        """Maximum error (s) of the interpolation of each phase against TauP at
+        n random points of the grid, stored in the table."""
+
+        rng = np.random.default_rng(seed)
+        distances = rng.uniform(self.distances[0], self.distances[-1], n)
+        depths = rng.uniform(self.depths[0], self.depths[-1], n)
+
+        errors = np.zeros(len(self.phases))
+        for dist,depth in zip(distances, depths):
+            exact = taup_arrivals(dist, depth, self.phases, self.model)
+            for k,phase in enumerate(self.phases):
+                error = abs(self.interpolate([dist], depth, [phase])[0] - exact[k])
+                if not np.isnan(error):
+                    errors[k] = max(errors[k], error)
+        self.errors = errors
+        return errors
+
+
+def table_file(name = model):
+    return os.path.join(table_dir, f"{name}.npz")
+
+
+def build_table(name = model, max_workers = 1):
+    """Build (and check) the travel-time table of a model, saved in table_dir."""
+
+    filename = table_file(name)
+    print(f"Building the travel-time table of {name} in {filename}")
+    table = TravelTimeTable.build(name, max_workers=max_workers)
+    table.check()
+    os.makedirs(table_dir, exist_ok=True)
+    table.write(filename)
+
+    _tables[name] = table
+    return table
+
+
+def get_table(name = model):
+    """Travel-time table of a model read from table_dir, None if missing or
+    with other phases or grids (to be built with build_table)."""
+
+    if name in _tables:
+        return _tables[name]
+
+    filename = table_file(name)
+    table = None
+    if os.path.exists(filename):
+        table = TravelTimeTable.read(filename)
+        distances, depths = table_grids(name)
+        if table.phases != tuple(table_phases) or not np.array_equal(table.distances, distances) or not np.array_equal(table.depths, depths):
+            print(f"Travel-time table {filename} with other phases or grids, arrivals computed with TauP (rebuild it with python travel_times.py --build -m {name})")
+            table = None
+    else:
+        print(f"No travel-time table {filename}, arrivals computed with TauP (build it with python travel_times.py --build -m {name})")
+
+    _tables[name] = table
+    return table
+
+
+def first_arrivals(distances, depth, phases, model = model):
+    """Time (s after the origin) of the first arrival of the phases at each
+    distance (°) for a source depth (km), NaN where none of the phases
+    arrives."""
+
+    distances = np.asarray(distances, dtype=float)
+    times = np.full(distances.shape, np.nan)
+    todo = np.ones(distances.shape, dtype=bool)
+
+    table = get_table(model) if use_tables and set(phases) <= set(table_phases) else None
+    if table is not None:
+        times = table.interpolate(distances.ravel(), depth, phases).reshape(distances.shape)
+        todo = np.isnan(times)
+
+    # without table, or in the cells of the table with a node without arrival
+    if todo.any():
+        rounded = np.round(distances[todo] / distance_step) * distance_step
+        unique, inverse = np.unique(rounded, return_inverse=True)
+        unique_times = np.array([np.nanmin(taup_arrivals(dist, depth, phases, model) + [np.inf]) for dist in unique])
+        times[todo] = np.where(np.isinf(unique_times), np.nan, unique_times)[inverse.ravel()]
+
+    return times
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-z",dest='depth', type=float, help='source depth (km)')
+
+    parser.add_argument("--dist", type=float, nargs=2, default=(70., 120.), help='distance range (°)')
+
+    parser.add_argument("--step", type=float, default=5., help='distance step (°)')
+
+    parser.add_argument("--phases", type=str, nargs="+", default=["S", "Sdiff"], help='phases')
+
+    parser.add_argument("-m",dest='model', type=str, default=model, help='1-D model')
+
+    parser.add_argument("--build", dest='build', action='store_true', help='build the travel-time table of the model (even if it exists)')
+
+    parser.add_argument("-j",dest='max_workers', type=int, default=os.cpu_count() or 1, help='number of workers building the table')
+
+    parser.add_argument("--table-dir", dest='table_dir', type=str, default=None, help=f'directory of the tables (default : {table_dir})')
+
+    args = parser.parse_args()
+
+    if args.table_dir:
+        table_dir = args.table_dir
+
+    if args.build:
+        table = build_table(args.model, args.max_workers)
+        print(f"{len(table.depths)} depths x {len(table.distances)} distances")
+        for phase,error in zip(table.phases, table.errors):
+            print(f"{phase:<8} max error {error:.3f} s")
+
+    if args.depth is not None:
+        distances = np.arange(args.dist[0], args.dist[1] + args.step/2, args.step)
+        for dist,time in zip(distances, first_arrivals(distances, args.depth, args.phases, args.model)):
+            print(f"{dist:6.1f}° {time:8.1f} s")
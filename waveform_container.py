@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Per-event waveform container, replacing the one small MiniSEED file per channel
+(NET.STA.LOC.CHA__start__end.mseed) left by the downloaders in waveforms/.
+
+The files are packed (concatenated, the MiniSEED records being independent)
+into a single multi-record MiniSEED file next to the directory
+(waveforms.mseed), with an index (waveforms.index.json) giving for each
+original file name its trace id and its byte range in the container. Traces can
+then be read by id without reading the whole container.
+
+Packing is incremental : files downloaded afterwards are appended, a file with
+the same name replacing the previous one in the index. The files kept in the
+directory (--keep) are not appended again while unchanged (same size and
+modification time as when packed).
+
+Usage : python waveform_container.py event_dir/waveforms [--keep]
+    packs the waveform files of the directory
+"""
+
+import os
+import io
+import json
+import argparse
+from fnmatch import fnmatch
+
+from obspy import read, Stream, UTCDateTime
+
+
+#-------------------------
+# configuration
+
+container_ext = ".mseed"
+index_ext = ".index.json"
+
+#-------------------------
+
+
+def trace_id(filename):
+    """Trace id (NET.STA.LOC.CHA) of a waveform file name."""
+    return os.path.basename(filename).split("__")[0]
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def requested_window(filename):
+    """Time window (UTCDateTime start, end) requested for a waveform file
+    (from its name), None if the name has no window."""
+    parts = os.path.splitext(os.path.basename(filename))[0].split("__")
+    try:
+        return UTCDateTime(parts[1]), UTCDateTime(parts[2])
+    except (IndexError, ValueError, TypeError):
+        return None
+
+
+def requested_windows(names):
+    """Time window requested for each trace id (the union of the windows of
+    its files) of a list of waveform file names."""
+    windows = {}
+    for name in names:
+        window = requested_window(name)
+        if window is None:
+            continue
+        start, end = windows.get(trace_id(name), window)
+        windows[trace_id(name)] = (min(start, window[0]), max(end, window[1]))
+    return windows
+
+
+def match_ids(name, ids):
+    """True if the trace id of the file name matches one of the ids (wildcards allowed)."""
+    return ids is None or any(fnmatch(trace_id(name), pattern) for pattern in ids)
+
+
+def read_container_entries(container_file, entries):
+    """Traces of a list of index entries of a container."""
+
+    traces = []
+    with open(container_file, "rb") as f:
+        for entry in sorted(entries, key = lambda entry: entry["offset"]):
+            f.seek(entry["offset"])
+            traces.extend(read(io.BytesIO(f.read(entry["size"])), format="MSEED").traces)
+    return traces
+
+
+class WaveformContainer:
+
+    def __init__(self, wf_dir):
+        self.wf_dir = os.path.normpath(wf_dir)
+        self.container_file = self.wf_dir + container_ext
+        self.index_file = self.wf_dir + index_ext
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    def exists(self):
+        return bool(self.index)
+
+    def names(self):
+        """Original file names of the packed waveforms."""
+        return list(self.index)
+
+    def entries(self, ids = None):
+        """Index entries of the traces matching the ids (all if None)."""
+        return [entry for name,entry in self.index.items() if match_ids(name, ids)]
+
+    def _write_index(self):
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_file, self.index_file)
+
+    def pack(self, remove = True):
+        """Append the waveform files of the directory to the container (and
+        remove them), return the number of files packed. The files already
+        packed and unchanged are not appended again."""
+
+        if not os.path.isdir(self.wf_dir):
+            return 0
+        files = sorted(os.listdir(self.wf_dir))
+        signatures = {name : file_signature(os.path.join(self.wf_dir, name)) for name in files}
+        new_files = [name for name in files if name not in self.index or self.index[name].get("signature") != signatures[name]]
+
+        if new_files:
+            with open(self.container_file, "ab") as out:
+                # bytes after the last indexed entry (interrupted packing) are left unused
+                offset = out.tell()
+                for name in new_files:
+                    with open(os.path.join(self.wf_dir, name), "rb") as f:
+                        data = f.read()
+                    out.write(data)
+                    self.index[name] = {"id" : trace_id(name), "offset" : offset, "size" : len(data), "signature" : signatures[name]}
+                    offset += len(data)
+                out.flush()
+                os.fsync(out.fileno())
+
+            # the files are removed only once indexed
+            self._write_index()
+
+        if remove:
+            for name in files:
+                os.remove(os.path.join(self.wf_dir, name))
+
+        return len(new_files)
+
+    def read(self, ids = None):
+        """Stream of the traces matching the ids (wildcards allowed, all if None)."""
+        return Stream(traces = read_container_entries(self.container_file, self.entries(ids)))
+
+    def size(self):
+        return os.path.getsize(self.container_file) if os.path.exists(self.container_file) else 0
+
+    def unused_bytes(self):
+        """Bytes of the container not referenced by the index (replaced files)."""
+        return self.size() - sum(entry["size"] for entry in self.index.values())
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("wf_dirs", type=str, nargs="+", help='waveforms directories')
+
+    parser.add_argument("--keep", dest='keep', action='store_true', help='keep the waveform files once packed')
+
+    args = parser.parse_args()
+
+    for wf_dir in args.wf_dirs:
+        container = WaveformContainer(wf_dir)
+        n = container.pack(remove = not args.keep)
+        print(f"{container.container_file} : {n} files packed, {len(container.index)} traces, {container.size()/1e6:.1f} MB ({container.unused_bytes()/1e6:.1f} MB unused)")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 21 2022
+@author: Sylvain Brisson sylvain.brisson@ens.fr
+
+
+Work queue over a shared filesystem, to spread a list of jobs (events) over
+several nodes without any outside service.
+
+Each job has lock files in the queue directory :
+    - <job>.claim : created atomically (O_EXCL) by the worker processing the job,
+      its modification time is updated regularly (heartbeat)
+    - <job>.done / <job>.failed : written once the job is finished
+
+A claim whose heartbeat is older than stale_timeout (crashed worker) is
+reclaimed by renaming it first (only one worker can succeed).
+
+With retry_failed, a job which failed before the worker started is retried
+by the worker renaming its .failed marker first (one retry per failure and per
+run, the number of attempts being kept in the marker).
+
+Usage : python work_queue.py queue_dir
+    prints the status of the jobs of a queue
+"""
+
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+from datetime import datetime
+
+
+#-------------------------
+# configuration
+
+# a claim not updated since stale_timeout seconds is considered as abandoned
+stale_timeout = 30*60.
+
+# interval between the updates of the claim of a running job (seconds)
+heartbeat_interval = 60.
+
+#-------------------------
+
+
+class WorkQueue:
+
+    def __init__(self, queue_dir, stale_timeout = stale_timeout, heartbeat_interval = heartbeat_interval, worker_id = None):
+        self.queue_dir = queue_dir
+        self.stale_timeout = stale_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = worker_id or f"{socket.gethostname()}.{os.getpid()}"
+        self.start_time = time.time()
+        # job -> number of attempts of the jobs claimed
+        self.attempts = {}
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def _file(self, job_id, ext):
+        return os.path.join(self.queue_dir, f"{job_id}.{ext}")
+
+    def _write_info(self, fd, **info):
+        info.update(worker = self.worker_id, time = datetime.now().isoformat(timespec="seconds"))
+        os.write(fd, json.dumps(info).encode())
+
+    def state(self, job_id):
+        """"done", "failed", "running", "stale" or "pending"."""
+        for state in ("done", "failed"):
+            if os.path.exists(self._file(job_id, state)):
+                return state
+        try:
+            age = time.time() - os.path.getmtime(self._file(job_id, "claim"))
+        except FileNotFoundError:
+            return "pending"
+        return "stale" if age > self.stale_timeout else "running"
+
+    def claim(self, job_id):
+        """Try to claim a job, return True on success."""
+
+        if self.state(job_id) == "stale":
+            # rename is atomic : only one worker gets to remove the stale claim
+            stale_file = self._file(job_id, f"stale.{self.worker_id}")
+            try:
+                os.rename(self._file(job_id, "claim"), stale_file)
+            except FileNotFoundError:
+                return False
+            # another worker reclaimed it first : we just moved its fresh claim,
+            # put it back (link : without replacing a claim created since)
+            if time.time() - os.path.getmtime(stale_file) < self.stale_timeout:
+                try:
+                    os.link(stale_file, self._file(job_id, "claim"))
+                except FileExistsError:
+                    pass
+                os.remove(stale_file)
+                return False
+            os.remove(stale_file)
+            print(f"Reclaiming stale job {job_id}")
+
+        try:
+            fd = os.open(self._file(job_id, "claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        self._write_info(fd)
+        os.close(fd)
+
+        # finished by another worker between the state check and the claim
+        if self.state(job_id) in ("done", "failed"):
+            os.remove(self._file(job_id, "claim"))
+            return False
+
+        return True
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self._file(job_id, "claim"))
+        except FileNotFoundError:
+            pass
+
+    def release(self, job_id, status = "done", **info):
+        """Record the end of a job ("done" or "failed") and remove its claim."""
+        fd = os.open(self._file(job_id, status), os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
+        self._write_info(fd, **info)
+        os.close(fd)
+        try:
+            os.remove(self._file(job_id, "claim"))
+        except FileNotFoundError:
+            pass
+
+    def take_failed(self, job_id):
+        """Take a failed job for a retry : its .failed marker is renamed (only
+        one worker can succeed), if the failure happened before the worker
+        started (not retried again in the same run). Returns the number of
+        attempts already done, None if the job is not taken."""
+
+        failed_file = self._file(job_id, "failed")
+        try:
+            if os.path.getmtime(failed_file) >= self.start_time:
+                return None
+            retry_file = self._file(job_id, f"retry.{self.worker_id}")
+            os.rename(failed_file, retry_file)
+        except FileNotFoundError:
+            return None
+        with open(retry_file) as f:
+            attempts = json.load(f).get("attempts", 1)
+        os.remove(retry_file)
+        return attempts
+
+    def next_job(self, job_ids, retry_failed = False):
+        """Claim the first available job of the list, None if there is none left."""
+        for job_id in job_ids:
+            state = self.state(job_id)
+            attempts = 0
+            if state == "failed" and retry_failed:
+                attempts = self.take_failed(job_id)
+                if attempts is None:
+                    continue
+                state = self.state(job_id)
+            if state in ("pending", "stale") and self.claim(job_id):
+                self.attempts[job_id] = attempts + 1
+                return job_id
+        return None
+
+    def run(self, job_ids, function, retry_failed = False):
+        """Process the jobs of the queue until none is left.
+
+        function : function(job_id) returning a dictionnary, whose "status"
+            key ("ok" or "failed") sets the job status
+
+        Returns the list of the results of the jobs processed by this worker.
+        """
+
+        results = []
+        processed = set()
+
+        while True:
+
+            # (a job failed by this worker is not retried by it)
+            job_id = self.next_job([j for j in job_ids if j not in processed], retry_failed)
+            if job_id is None:
+                break
+            processed.add(job_id)
+
+            # keep the claim alive while processing
+            stop = threading.Event()
+            def keep_alive():
+                while not stop.wait(self.heartbeat_interval):
+                    self.heartbeat(job_id)
+            thread = threading.Thread(target=keep_alive, daemon=True)
+            thread.start()
+
+            try:
+                result = function(job_id)
+            except Exception as e:
+                result = {"status" : "failed", "message" : repr(e)}
+            finally:
+                stop.set()
+                thread.join()
+
+            status = "done" if result.get("status") == "ok" else "failed"
+            self.release(job_id, status, message = result.get("message", ""), attempts = self.attempts.get(job_id, 1))
+            results.append(result)
+
+        return results
+
+    def report(self, job_ids):
+
+        states = {job_id : self.state(job_id) for job_id in job_ids}
+
+        state_count = {}
+        for state in states.values():
+            state_count[state] = state_count.get(state, 0) + 1
+
+        print(f"{self.queue_dir} : {len(job_ids)} jobs (" + ", ".join(f"{n} {state}" for state,n in sorted(state_count.items())) + ")")
+
+        for job_id,state in sorted(states.items()):
+            if state == "failed":
+                with open(self._file(job_id, "failed")) as f:
+                    info = json.load(f)
+                print(f"  failed {job_id} ({info['worker']}, {info.get('attempts', 1)} attempts) {info.get('message', '')}")
+
+        return states
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("queue_dir", type=str, help='queue directory')
+
+    args = parser.parse_args()
+
+    job_ids = sorted(set(
+        f.rsplit(".", 1)[0] for f in os.listdir(args.queue_dir) 
+        if f.rsplit(".", 1)[-1] in ("claim", "done", "failed")))
+
+    WorkQueue(args.queue_dir).report(job_ids)